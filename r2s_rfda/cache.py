@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+DEFAULT_MAX_ENTRIES = 10000000
+_QUERY_SIZE = 500
+
+
+class VolumeCache:
+    """Persistent cache of cell volumes in mesh voxels.
+
+    Volumes are stored in sqlite database and are addressed by the key, that
+    is produced by volume_key function. When the number of entries exceeds
+    the limit, least recently used entries are evicted.
+
+    Parameters
+    ----------
+    filename : Path or str
+        Name of cache file.
+    max_entries : int
+        Maximum number of entries in the cache. Default: 10000000.
+
+    Methods
+    -------
+    get_many(keys)
+        Gets cached volumes.
+    put_many(items)
+        Stores volumes in the cache.
+    prune(max_entries)
+        Evicts least recently used entries.
+    info()
+        Gets cache statistics.
+    clear()
+        Removes all entries.
+    close()
+        Closes cache file.
+    """
+    def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES):
+        self._filename = Path(filename)
+        self._max_entries = max_entries
+        self._conn = sqlite3.connect(str(self._filename))
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS volumes '
+            '(key TEXT PRIMARY KEY, volume REAL NOT NULL, used REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS volumes_used ON volumes (used)'
+        )
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        cur = self._conn.execute('SELECT COUNT(*) FROM volumes')
+        return cur.fetchone()[0]
+
+    @property
+    def max_entries(self):
+        return self._max_entries
+
+    def get_many(self, keys):
+        """Gets cached volumes.
+
+        Parameters
+        ----------
+        keys : iterable
+            Keys of volumes.
+
+        Returns
+        -------
+        volumes : dict
+            A dictionary of found volumes. key -> volume.
+        """
+        keys = list(keys)
+        volumes = {}
+        for start in range(0, len(keys), _QUERY_SIZE):
+            part = keys[start:start + _QUERY_SIZE]
+            marks = ', '.join('?' * len(part))
+            cur = self._conn.execute(
+                'SELECT key, volume FROM volumes WHERE key IN ({0})'.format(
+                    marks
+                ), part
+            )
+            volumes.update(cur.fetchall())
+        now = time.time()
+        self._conn.executemany(
+            'UPDATE volumes SET used = ? WHERE key = ?',
+            ((now, key) for key in volumes.keys())
+        )
+        self._conn.commit()
+        return volumes
+
+    def put_many(self, items):
+        """Stores volumes in the cache.
+
+        Parameters
+        ----------
+        items : dict
+            A dictionary of volumes. key -> volume.
+        """
+        now = time.time()
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO volumes (key, volume, used) '
+            'VALUES (?, ?, ?)',
+            ((key, float(vol), now) for key, vol in items.items())
+        )
+        self._conn.commit()
+
+    def prune(self, max_entries=None):
+        """Evicts least recently used entries.
+
+        Parameters
+        ----------
+        max_entries : int
+            The number of entries to be kept. Default: None - cache limit
+            is used.
+
+        Returns
+        -------
+        removed : int
+            The number of removed entries.
+        """
+        if max_entries is None:
+            max_entries = self._max_entries
+        excess = len(self) - max_entries
+        if excess <= 0:
+            return 0
+        self._conn.execute(
+            'DELETE FROM volumes WHERE key IN '
+            '(SELECT key FROM volumes ORDER BY used LIMIT ?)', (excess,)
+        )
+        self._conn.commit()
+        self._conn.execute('VACUUM')
+        return excess
+
+    def info(self):
+        """Gets cache statistics.
+
+        Returns
+        -------
+        stat : dict
+            Cache statistics: filename, entries, size (in bytes),
+            oldest and newest usage time.
+        """
+        cur = self._conn.execute('SELECT MIN(used), MAX(used) FROM volumes')
+        oldest, newest = cur.fetchone()
+        return {
+            'filename': self._filename, 'entries': len(self),
+            'size': self._filename.stat().st_size,
+            'oldest': oldest, 'newest': newest
+        }
+
+    def clear(self):
+        """Removes all entries."""
+        self._conn.execute('DELETE FROM volumes')
+        self._conn.commit()
+        self._conn.execute('VACUUM')
+
+    def close(self):
+        """Closes cache file."""
+        self._conn.close()
+
+
+def cell_key(cell):
+    """Gets the key of cell geometry.
+
+    The key depends on the cell's shape and parameters of all its surfaces.
+    Surfaces of the cells, that are placed into universe, are already
+    transformed, so the transformation is taken into account too.
+
+    Parameters
+    ----------
+    cell : Body
+        Cell.
+
+    Returns
+    -------
+    key : str
+        Cell geometry key.
+    """
+    surfaces = sorted(s.mcnp_repr() for s in cell.shape.get_surfaces())
+    text = '\n'.join([str(cell.shape)] + surfaces)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def volume_key(c_key, box, min_volume):
+    """Gets the key of cell volume in the voxel.
+
+    Parameters
+    ----------
+    c_key : str
+        Cell geometry key.
+    box : Box
+        Voxel.
+    min_volume : float
+        Minimum volume for volume calculations.
+
+    Returns
+    -------
+    key : str
+        Volume key.
+    """
+    h = hashlib.sha1(c_key.encode('utf-8'))
+    h.update(np.asarray(box.corners, dtype=float).tobytes())
+    h.update(repr(float(min_volume)).encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+_CHUNK = 10000
+
+
+def cluster_spectra(spectra, n_clusters=None, tolerance=None, max_iter=100):
+    """Clusters normalized neutron spectra.
+
+    If tolerance is given, the number of clusters is doubled (starting from
+    n_clusters or 8) until the maximum clustering error is below tolerance.
+
+    Parameters
+    ----------
+    spectra : numpy.ndarray
+        Normalized group spectra, one spectrum per row. N x G.
+    n_clusters : int
+        The number of clusters. Default: None.
+    tolerance : float
+        Maximum clustering error allowed. Default: None.
+    max_iter : int
+        Maximum number of k-means iterations. Default: 100.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Cluster labels of spectra. len=N.
+    centroids : numpy.ndarray
+        Normalized spectra of clusters. K x G.
+    errors : numpy.ndarray
+        Clustering errors of spectra (see spectrum_errors). len=N.
+    """
+    if n_clusters is None and tolerance is None:
+        raise ValueError('Either n_clusters or tolerance must be specified.')
+    unique, inverse, counts = np.unique(
+        spectra, axis=0, return_inverse=True, return_counts=True
+    )
+    inverse = inverse.ravel()
+    k = n_clusters or 8
+    while True:
+        labels, centroids = kmeans(unique, k, weights=counts, max_iter=max_iter)
+        errors = spectrum_errors(unique, centroids, labels)
+        if tolerance is None or errors.size == 0 or \
+                np.max(errors) <= tolerance:
+            break
+        if k >= unique.shape[0]:
+            break
+        k *= 2
+    return labels[inverse], centroids, errors[inverse]
+
+
+def kmeans(points, k, weights=None, max_iter=100):
+    """Weighted k-means clustering.
+
+    Initial centroids are chosen by k-means++ method with fixed seed, so
+    the result is reproducible.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Points to be clustered. N x G.
+    k : int
+        The number of clusters. If k >= N, every point forms its own cluster.
+    weights : numpy.ndarray
+        Weights of points. Default: None - all weights are 1.
+    max_iter : int
+        Maximum number of iterations. Default: 100.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Cluster labels of points. len=N.
+    centroids : numpy.ndarray
+        Centroids of clusters. K x G.
+    """
+    points = np.asarray(points, dtype=float)
+    n = points.shape[0]
+    if weights is None:
+        weights = np.ones(n)
+    weights = np.asarray(weights, dtype=float)
+    if k >= n:
+        return np.arange(n), points.copy()
+    rnd = np.random.RandomState(0)
+    centroids = np.empty((k, points.shape[1]))
+    centroids[0] = points[rnd.choice(n, p=weights / weights.sum())]
+    dist = np.sum((points - centroids[0]) ** 2, axis=1)
+    for m in range(1, k):
+        prob = dist * weights
+        total = prob.sum()
+        if total > 0:
+            index = rnd.choice(n, p=prob / total)
+        else:
+            index = rnd.choice(n)
+        centroids[m] = points[index]
+        dist = np.minimum(dist, np.sum((points - centroids[m]) ** 2, axis=1))
+
+    labels = None
+    for _ in range(max_iter):
+        new_labels, dist = nearest_centroids(points, centroids)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        for m in range(k):
+            members = labels == m
+            w = weights[members]
+            if w.sum() > 0:
+                centroids[m] = np.dot(w, points[members]) / w.sum()
+            else:
+                far = np.argmax(dist * weights)
+                centroids[m] = points[far]
+                dist[far] = 0
+    return labels, centroids
+
+
+def nearest_centroids(points, centroids):
+    """Finds the nearest centroid for every point.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Points. N x G.
+    centroids : numpy.ndarray
+        Centroids. K x G.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Indices of the nearest centroids. len=N.
+    dist : numpy.ndarray
+        Squared distances to the nearest centroids. len=N.
+    """
+    labels = np.empty(points.shape[0], dtype=int)
+    dist = np.empty(points.shape[0])
+    c_norm = np.sum(centroids ** 2, axis=1)
+    for start in range(0, points.shape[0], _CHUNK):
+        part = points[start:start + _CHUNK]
+        d = np.sum(part ** 2, axis=1)[:, np.newaxis] - \
+            2 * np.dot(part, centroids.T) + c_norm
+        labels[start:start + _CHUNK] = np.argmin(d, axis=1)
+        dist[start:start + _CHUNK] = np.maximum(np.min(d, axis=1), 0)
+    return labels, dist
+
+
+def spectrum_errors(spectra, centroids, labels):
+    """Gets clustering errors of normalized spectra.
+
+    The error is the sum of absolute differences between the spectrum and
+    the spectrum of its cluster. It is 0 for identical spectra and 2 for
+    spectra without common groups.
+
+    Parameters
+    ----------
+    spectra : numpy.ndarray
+        Normalized spectra. N x G.
+    centroids : numpy.ndarray
+        Normalized spectra of clusters. K x G.
+    labels : numpy.ndarray
+        Cluster labels of spectra. len=N.
+
+    Returns
+    -------
+    errors : numpy.ndarray
+        Clustering errors. len=N.
+    """
+    return np.sum(np.abs(spectra - centroids[labels]), axis=1)
@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import multiprocessing
+import threading
+import time
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+)
 from itertools import accumulate
 
 import pypact as pp
@@ -12,76 +18,385 @@ from collections import defaultdict
 from . import data
 
 
-def collect(path, config):
+COLLECTED_FILE = 'collected.pkl'
+SAVE_PERIOD = 300
+
+
+def collect(path, config, parsers=1):
     """Collects all data from inventory files and writes total files on disk.
 
+    Data of outputs, that are already parsed by the run stage 
+    (collected.pkl file), is reused.
+
     Parameters
     ----------
     path : Path
         Path to folder, where to store results.
     config : dict
         Dictionary of configuration data.
+    parsers : int
+        The number of processes parsing FISPACT outputs. Default: 1.
     """
-    sp_index = data.SpatialIndex(config['volumes'].keys())
-
-    A_dict = defaultdict(lambda: defaultdict(dict))
-    N_dict = defaultdict(lambda: defaultdict(dict))
-    G_dict = defaultdict(lambda: defaultdict(dict))
-    nuclides = set()
-    print('Start data collection ...')
-    with progressbar(config['index_output'].items()) as bar:
-        for index, casepath in bar:
-            time_labels, ebins, atoms, activity, gamma_yield = read_fispact_output(casepath)
-            for (t, nuc), act in activity.items():
-                A_dict[t][nuc][index] = act
-                nuclides.add(nuc)
-            for (t, nuc), number in atoms.items():
-                N_dict[t][nuc][index] = number
-            for t, gamma_ar in gamma_yield.items():
-                for i, gam in enumerate(gamma_ar):
-                    G_dict[t][i][index] = gam
-    
-    g_labels = list(range(len(ebins) - 1))
-    nuclides = list(sorted(nuclides))
-
-    result_conf = prepare_result_folder(path, time_labels)
-    with open(path / 'result.cfg', 'bw') as f:
-        pickle.dump(result_conf, f, pickle.HIGHEST_PROTOCOL)
-
-    if config['approach'] == 'simple':
-        flux_coeffs = flatten_flux_coeffs(sp_index, config['alpha'])
-        mat_labels = list(sorted(set(config['c2m'].values())))
-        mass_coeffs = flatten_mass_coeffs(sp_index, config['beta'], config['c2m'], mat_labels)
-
-    print('Preparing gamma data ...')
-    with progressbar(G_dict.items()) as bar:
-        for t, frame_dict in bar:
-            if config['approach'] == 'full':
-                frame = get_full_frame(frame_dict, sp_index, g_labels)
-            else:
-                frame = get_simple_frame(frame_dict, flux_coeffs, mass_coeffs, mat_labels, g_labels)
-            frame_obj = data.GammaFrame(frame, sp_index, t, ebins, config['mesh'])
-            save_data(result_conf['gamma'][t], frame_obj)
-
-    print('Preparing activity data ...')
-    with progressbar(A_dict.items()) as bar:
-        for t, frame_dict in bar:
-            if config['approach'] == 'full':
-                frame = get_full_frame(frame_dict, sp_index, nuclides)
-            else:
-                frame = get_simple_frame(frame_dict, flux_coeffs, mass_coeffs, mat_labels, nuclides)
-            frame_obj = data.GammaFrame(frame, sp_index, t, nuclides, config['mesh'])
-            save_data(result_conf['activity'][t], frame_obj)
-
-    print('Preparing atoms data ...')
-    with progressbar(N_dict.items()) as bar:
-        for t, frame_dict in bar:
-            if config['approach'] == 'full':
-                frame = get_full_frame(frame_dict, sp_index, nuclides)
-            else:
-                frame = get_simple_frame(frame_dict, flux_coeffs, mass_coeffs, mat_labels, nuclides)
-            frame_obj = data.GammaFrame(frame, sp_index, t, nuclides, config['mesh'])
-            save_data(result_conf['atoms'][t], frame_obj)
+    with OutputCollector(config, parsers=parsers) as collector:
+        collector.load(path / COLLECTED_FILE)
+        print('Start data collection ...')
+        collector.finish(progress=True)
+        collector.write(path)
+
+
+class OutputCollector:
+    """Collector of FISPACT output data.
+
+    Outputs are parsed in background by parser workers as soon as they are 
+    added, and their data is accumulated. So outputs of finished cases can
+    be parsed while other cases are still running. If filename is given,
+    parsed data is saved there periodically, when cases are added.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary of configuration data.
+    parsers : int
+        The number of parser workers. If it is greater than 1, outputs are 
+        parsed in separate processes. Default: 1.
+    delete : bool
+        Whether to delete outputs of successful cases after they are 
+        parsed. Outputs are deleted only after their data is saved (see 
+        save) or written. Default: False.
+    filename : Path
+        File, where parsed data is saved periodically. Default: None.
+    save_period : float
+        Period of saving in seconds. Default: 300.
+
+    Methods
+    -------
+    add_case(cwd, failures)
+        Schedules parsing of case outputs.
+    finish(progress)
+        Parses all outputs, that are not parsed yet.
+    write(path)
+        Writes result data frames.
+    save(filename)
+        Saves parsed data.
+    load(filename)
+        Loads parsed data.
+    close()
+        Stops parser workers.
+    """
+    def __init__(
+            self, config, parsers=1, delete=False, filename=None, 
+            save_period=SAVE_PERIOD
+        ):
+        self._config = config
+        self._delete = delete
+        self._filename = filename
+        self._save_period = save_period
+        self._saved = time.monotonic()
+        self._to_delete = []
+        self._outputs = defaultdict(list)
+        self._cases = defaultdict(list)
+        for index, casepath in config['index_output'].items():
+            if casepath not in self._outputs:
+                self._cases[casepath.parent].append(casepath)
+            self._outputs[casepath].append(index)
+        self._scales = config.get('scales', {})
+        self._data = {
+            'activity': {}, 'atoms': {}, 'gamma': {}, 'nuclides': set(),
+            'time_labels': None, 'ebins': None, 'parsed': {}
+        }
+        self._lock = threading.Condition()
+        self._futures = []
+        self._pending = 0
+        self._errors = []
+        if parsers > 1:
+            self._executor = ProcessPoolExecutor(
+                parsers, mp_context=multiprocessing.get_context('spawn')
+            )
+        else:
+            self._executor = ThreadPoolExecutor(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._data['parsed'])
+
+    def add_case(self, cwd, failures=None):
+        """Schedules parsing of case outputs.
+
+        Parameters
+        ----------
+        cwd : Path
+            Case folder.
+        failures : list
+            Failures of the case. Outputs of failed inputs are not parsed, 
+            and outputs of failed cases are not deleted. Default: None.
+        """
+        delete = self._delete and not failures
+        failed = {f['input'] for f in failures or []}
+        for casepath in self._cases.get(cwd, []):
+            if casepath.stem not in failed and casepath.exists():
+                self._submit(casepath, delete)
+        if self._filename is not None and \
+                time.monotonic() - self._saved > self._save_period:
+            self.save(self._filename)
+
+    def _submit(self, casepath, delete=False):
+        with self._lock:
+            self._pending += 1
+        future = self._executor.submit(read_fispact_output, casepath)
+        with self._lock:
+            self._futures.append(future)
+        future.add_done_callback(
+            lambda f: self._parsed(casepath, f, delete)
+        )
+
+    def _parsed(self, casepath, future, delete):
+        try:
+            self._accumulate(casepath, future.result(), delete)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._lock.notify_all()
+
+    def _accumulate(self, casepath, parsed, delete):
+        time_labels, ebins, atoms, activity, gamma_yield = parsed
+        with self._lock:
+            store = self._data
+            store['time_labels'] = time_labels
+            store['ebins'] = ebins
+            for index in self._outputs[casepath]:
+                f = self._scales.get(index, 1.0)
+                for (t, nuc), act in activity.items():
+                    frame = store['activity'].setdefault(t, {})
+                    frame.setdefault(nuc, {})[index] = act * f
+                    store['nuclides'].add(nuc)
+                for (t, nuc), number in atoms.items():
+                    frame = store['atoms'].setdefault(t, {})
+                    frame.setdefault(nuc, {})[index] = number * f
+                for t, gamma_ar in gamma_yield.items():
+                    frame = store['gamma'].setdefault(t, {})
+                    for i, gam in enumerate(gamma_ar):
+                        frame.setdefault(i, {})[index] = gam * f
+            store['parsed'][casepath] = casepath.stat().st_mtime
+            if delete:
+                self._to_delete.append(casepath)
+
+    def _is_parsed(self, casepath):
+        mtime = self._data['parsed'].get(casepath, None)
+        return mtime is not None and is_current(casepath, mtime)
+
+    def _delete_saved(self):
+        with self._lock:
+            to_delete, self._to_delete = self._to_delete, []
+        for casepath in to_delete:
+            casepath.unlink()
+
+    def parsed(self):
+        """Gets outputs, whose data is collected.
+
+        Returns
+        -------
+        outputs : set
+            Outputs, that are parsed and are not changed since then.
+        """
+        with self._lock:
+            parsed = list(self._data['parsed'].keys())
+        return {p for p in parsed if self._is_parsed(p)}
+
+    def finish(self, progress=False):
+        """Parses all outputs, that are not parsed yet.
+
+        Parameters
+        ----------
+        progress : bool
+            Whether to show progress bar. Default: False.
+        """
+        self.wait()
+        for casepath in self._outputs.keys():
+            if not self._is_parsed(casepath):
+                self._submit(casepath)
+        if progress:
+            with progressbar(length=len(self._futures)) as bar:
+                for _ in as_completed(list(self._futures)):
+                    bar.update(1)
+        self.wait()
+
+    def wait(self):
+        """Waits until all scheduled outputs are parsed.
+
+        The first parsing error, if any, is raised.
+        """
+        with self._lock:
+            self._wait_pending()
+            if self._errors:
+                raise self._errors[0]
+
+    def _wait_pending(self):
+        while self._pending > 0:
+            self._lock.wait()
+        self._futures = []
+
+    def write(self, path):
+        """Writes result data frames.
+
+        Parameters
+        ----------
+        path : Path
+            Path to folder, where to store results.
+        """
+        config = self._config
+        store = self._data
+        sp_index = data.SpatialIndex(config['volumes'].keys())
+        time_labels = store['time_labels']
+        ebins = store['ebins']
+        g_labels = list(range(len(ebins) - 1))
+        nuclides = list(sorted(store['nuclides']))
+
+        result_conf = prepare_result_folder(path, time_labels)
+        with open(path / 'result.cfg', 'bw') as f:
+            pickle.dump(result_conf, f, pickle.HIGHEST_PROTOCOL)
+
+        coeffs = superposition_coeffs(config, sp_index)
+
+        print('Preparing gamma data ...')
+        with progressbar(store['gamma'].items()) as bar:
+            for t, frame_dict in bar:
+                frame = get_frame(frame_dict, sp_index, g_labels, coeffs)
+                frame_obj = data.GammaFrame(frame, sp_index, t, ebins, config['mesh'])
+                save_data(result_conf['gamma'][t], frame_obj)
+
+        print('Preparing activity data ...')
+        with progressbar(store['activity'].items()) as bar:
+            for t, frame_dict in bar:
+                frame = get_frame(frame_dict, sp_index, nuclides, coeffs)
+                frame_obj = data.GammaFrame(frame, sp_index, t, nuclides, config['mesh'])
+                save_data(result_conf['activity'][t], frame_obj)
+
+        print('Preparing atoms data ...')
+        with progressbar(store['atoms'].items()) as bar:
+            for t, frame_dict in bar:
+                frame = get_frame(frame_dict, sp_index, nuclides, coeffs)
+                frame_obj = data.GammaFrame(frame, sp_index, t, nuclides, config['mesh'])
+                save_data(result_conf['atoms'][t], frame_obj)
+
+        self._delete_saved()
+        collected = path / COLLECTED_FILE
+        if collected.exists():
+            collected.unlink()
+
+    def save(self, filename):
+        """Saves parsed data.
+
+        Outputs, that are parsed and must be deleted, are deleted after
+        their data is saved. Outputs, that can not be parsed, are skipped;
+        their errors are raised by wait.
+
+        Parameters
+        ----------
+        filename : Path
+            Name of file.
+        """
+        with self._lock:
+            self._wait_pending()
+            tmp = filename.with_suffix('.tmp')
+            save_data(tmp, self._data)
+            tmp.replace(filename)
+            self._saved = time.monotonic()
+        self._delete_saved()
+
+    def load(self, filename):
+        """Loads parsed data, if the file exists.
+
+        Parameters
+        ----------
+        filename : Path
+            Name of file.
+        """
+        if filename.exists():
+            with self._lock:
+                self._data = load_data(filename)
+
+    def close(self):
+        """Stops parser workers."""
+        self._executor.shutdown()
+
+
+def superposition_coeffs(config, sp_index):
+    """Gets flux and mass coefficients for the calculation approach.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary of configuration data.
+    sp_index : SpatialIndex
+        Spatial index.
+
+    Returns
+    -------
+    coeffs : dict
+        Coefficients. 'approach' - calculation approach; for simple, hybrid
+        and clustered approaches also: 'mat_labels', 'mass' and 'flux' 
+        coefficients; for clustered approach 'labels' of clusters and 
+        'n_clusters'.
+    """
+    approach = config['approach']
+    coeffs = {'approach': approach}
+    if approach == 'full':
+        return coeffs
+    mat_labels = list(sorted(set(config['c2m'].values())))
+    coeffs['mat_labels'] = mat_labels
+    coeffs['mass'] = flatten_mass_coeffs(
+        sp_index, config['beta'], config['c2m'], mat_labels
+    )
+    if approach in ('simple', 'hybrid'):
+        coeffs['flux'] = flatten_flux_coeffs(sp_index, config['alpha'])
+    elif approach == 'clustered':
+        coeffs['labels'], coeffs['flux'] = flatten_cluster_coeffs(
+            sp_index, config['labels'], config['flux_ratio']
+        )
+        coeffs['n_clusters'] = config['n_clusters']
+    return coeffs
+
+
+def get_frame(frame_dict, sp_index, var_labels, coeffs):
+    """Gets data frame according to the calculation approach.
+
+    Parameters
+    ----------
+    frame_dict : dict
+        Data of inventories. var_label -> {output_index -> value}.
+    sp_index : SpatialIndex
+        Spatial index.
+    var_labels : list
+        Labels of variables (gamma groups or nuclides).
+    coeffs : dict
+        Coefficients produced by superposition_coeffs.
+
+    Returns
+    -------
+    frame : numpy.ndarray
+        Data frame. len(var_labels) x len(sp_index).
+    """
+    if coeffs['approach'] == 'full':
+        return get_full_frame(frame_dict, sp_index, var_labels)
+    elif coeffs['approach'] == 'hybrid':
+        return get_hybrid_frame(frame_dict, sp_index, var_labels, coeffs)
+    elif coeffs['approach'] == 'clustered':
+        return get_cluster_frame(
+            frame_dict, coeffs['labels'], coeffs['flux'], coeffs['mass'],
+            coeffs['mat_labels'], coeffs['n_clusters'], var_labels
+        )
+    return get_simple_frame(
+        frame_dict, coeffs['flux'], coeffs['mass'], coeffs['mat_labels'], 
+        var_labels
+    )
 
 
 def get_full_frame(frame_dict, s_index, var_labels):
@@ -104,7 +419,39 @@ def get_simple_frame(frame_dict, flux_coeffs, mass_coeffs, mat_labels, var_label
     frame = produce_slice_array(g_data, var_labels)
     return frame
 
-            
+
+def get_hybrid_frame(frame_dict, s_index, var_labels, coeffs):
+    full_dict = {}
+    simple_dict = {}
+    for g, data_dict in frame_dict.items():
+        full = {k: v for k, v in data_dict.items() if len(k) == 4}
+        simple = {k: v for k, v in data_dict.items() if len(k) == 2}
+        if full:
+            full_dict[g] = full
+        if simple:
+            simple_dict[g] = simple
+    frame = get_full_frame(full_dict, s_index, var_labels)
+    if simple_dict:
+        frame += get_simple_frame(
+            simple_dict, coeffs['flux'], coeffs['mass'], coeffs['mat_labels'],
+            var_labels
+        )
+    return frame
+
+
+def get_cluster_frame(
+        frame_dict, labels, flux_coeffs, mass_coeffs, mat_labels, n_clusters,
+        var_labels
+    ):
+    g_data = {}
+    shape = (len(mat_labels), n_clusters)
+    for g, data_dict in frame_dict.items():
+        data_arr = dict_to_array(data_dict, shape, mat_labels)
+        g_data[g] = apply_clusters(data_arr, labels, flux_coeffs, mass_coeffs)
+    frame = produce_slice_array(g_data, var_labels)
+    return frame
+
+
 def prepare_result_folder(path, timelabels):
     folder = path / 'results'
     folder.mkdir()
@@ -127,7 +474,7 @@ def dict_to_array(data_dict, shape, mat_labels):
 
 def flatten_mass_coeffs(sindex, mass_coeffs, c2m, mat_labels):
     mat_index = {m: i for i, m in enumerate(mat_labels)}
-    data = np.empty((len(mat_labels), len(sindex)))
+    data = np.zeros((len(mat_labels), len(sindex)))
     for q, (c, i, j, k) in enumerate(sindex):
         coeff = mass_coeffs[(c, i, j, k)]
         m = c2m[c]
@@ -143,6 +490,16 @@ def flatten_flux_coeffs(sindex, flux_coeffs):
     return result
 
 
+def flatten_cluster_coeffs(sindex, labels, flux_ratio):
+    n = len(sindex)
+    cl_labels = np.empty(n, dtype=int)
+    result = np.empty(n)
+    for q, (c, i, j, k) in enumerate(sindex):
+        cl_labels[q] = labels[i, j, k]
+        result[q] = flux_ratio[i, j, k]
+    return cl_labels, result
+
+
 def produce_slice_array(data_dict, labels):
     lind = {lab: i for i, lab in enumerate(labels)}
     g = len(labels)
@@ -176,6 +533,30 @@ def apply_superposition(data, flux, mass):
     return np.sum(result, axis=0)
 
 
+def apply_clusters(data, labels, flux, mass):
+    """Applies cluster results to data piece.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Calculated data. m x n, where n is the number of clusters.
+    labels : np.ndarray
+        Cluster labels. len=q
+    flux : np.ndarray
+        Flux ratios. len=q
+    mass : np.ndarray
+        Mass data. m x q
+
+    Returns
+    -------
+    result : np.ndarray
+        Resulting data. len=q
+    """
+    result = data[:, labels] * flux
+    result *= mass
+    return np.sum(result, axis=0)
+
+
 def read_fispact_output(path):
     """Reads FISPACT output file.
 
@@ -220,6 +601,44 @@ def read_fispact_output(path):
     return time_labels, ebins, atoms, activity, gamma_yield
 
 
+def is_current(casepath, mtime):
+    """Checks whether the parsed output is not changed since parsing.
+
+    Parameters
+    ----------
+    casepath : Path
+        Output file.
+    mtime : float
+        Modification time of the output, when it was parsed.
+
+    Returns
+    -------
+    current : bool
+        True, if the output is deleted or is not modified.
+    """
+    return not casepath.exists() or casepath.stat().st_mtime == mtime
+
+
+def parsed_outputs(filename):
+    """Gets outputs, whose data is saved in collected data file.
+
+    Parameters
+    ----------
+    filename : Path
+        Name of collected data file.
+
+    Returns
+    -------
+    outputs : set
+        Outputs, that are parsed and are not changed since then. It is 
+        empty, if the file does not exist.
+    """
+    if not filename.exists():
+        return set()
+    parsed = load_data(filename)['parsed']
+    return {p for p, mtime in parsed.items() if is_current(p, mtime)}
+
+
 def load_data(path):
     """Loads data from path.
 
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
+import json
 import pickle
 import configparser
+import shutil
+from functools import partial
 from pathlib import Path
 
-from . import prepare, run, fetch, source, utils
+from . import prepare, run, fetch, source, report, utils
+from .cache import VolumeCache, DEFAULT_MAX_ENTRIES
+from .workqueue import WorkQueue, DEFAULT_EXPIRY
 
 
 def load_task(filename):
@@ -82,19 +88,125 @@ def arg_parser():
     parser_run = subparsers.add_parser('run', parents=[parser_common])
     parser_fetch = subparsers.add_parser('fetch', parents=[parser_common])
     parser_source = subparsers.add_parser('source', parents=[parser_common])
+    parser_rescenario = subparsers.add_parser(
+        'rescenario', parents=[parser_common]
+    )
+    parser_report = subparsers.add_parser('report', parents=[parser_common])
+    parser_cache = subparsers.add_parser('cache')
 
     # prepare arguments
     parser_prepare.add_argument(
         '--config', type=str, help='Configuration file.', default='config.ini'
     )    
+    parser_prepare.add_argument(
+        '-t', '--threads', type=int, default=None, 
+        help='the number of worker processes for volume calculations'
+    )
+    parser_prepare.add_argument(
+        '--resume', action='store_true', 
+        help='continue volume calculations from the last checkpoint'
+    )
+    parser_prepare.add_argument(
+        '--incremental', action='store_true', 
+        help='update existing task, regenerate only changed cases'
+    )
 
     # run arguments
     parser_run.add_argument(
         '-t', '--threads', nargs='?', type=int, default=1, 
         help='the number of worker processes to be run'
     )
+    parser_run.add_argument(
+        '--resume', action='store_true', 
+        help='run only cases, that are not completed'
+    )
+    parser_run.add_argument(
+        '--only-failed', action='store_true', 
+        help='run only cases, that failed in the previous runs'
+    )
+    parser_run.add_argument(
+        '--retries', type=int, default=1,
+        help='the number of retries after crash of FISPACT process'
+    )
+    parser_run.add_argument(
+        '--fail-fast', action='store_true', 
+        help='cancel outstanding cases on the first failure'
+    )
+    parser_run.add_argument(
+        '--backend', choices=['threads', 'asyncio'], default='threads',
+        help='how FISPACT processes are driven: by worker threads or by '
+             'asyncio event loop'
+    )
+    parser_run.add_argument(
+        '--worker', action='store_true', 
+        help='claim cases from the task folder shared with other workers'
+    )
+    parser_run.add_argument(
+        '--lease-expiry', type=float, default=DEFAULT_EXPIRY,
+        help='time in seconds, after which the case of silent worker can be '
+             'claimed by other workers'
+    )
+    parser_run.add_argument(
+        '--scratch', type=Path, default=None,
+        help='local folder (e.g. /dev/shm), where cases are run; only '
+             'outputs are copied back to the task folder'
+    )
+    parser_run.add_argument(
+        '--discard-intermediates', action='store_true',
+        help='do not copy back COLLAPX and ARRAYX files from scratch folder'
+    )
+    parser_run.add_argument(
+        '--fetch', action='store_true', 
+        help='parse outputs of finished cases during the run and collect '
+             'results at the end'
+    )
+    parser_run.add_argument(
+        '--parsers', type=int, default=1,
+        help='the number of processes parsing FISPACT outputs'
+    )
+    parser_run.add_argument(
+        '--delete-outputs', action='store_true', 
+        help='delete outputs of successful cases after they are parsed'
+    )
 
     # fetch arguments
+    parser_fetch.add_argument(
+        '--parsers', type=int, default=1,
+        help='the number of processes parsing FISPACT outputs'
+    )
+
+    # rescenario arguments
+    parser_rescenario.add_argument(
+        '--config', type=str, help='Configuration file.', default='config.ini'
+    )
+    parser_rescenario.add_argument(
+        '-i', '--inventory', type=str, default=None,
+        help='new inventory template (default: inventory from configuration)'
+    )
+
+    # report arguments
+    parser_report.add_argument(
+        '--top', type=int, default=10,
+        help='the number of the slowest cases and inputs to be shown'
+    )
+    parser_report.add_argument(
+        '--bins', type=int, default=20,
+        help='the number of time intervals of utilization timeline'
+    )
+    parser_report.add_argument(
+        '--all', action='store_true', dest='all_runs',
+        help='summarize all recorded runs, not only the last one'
+    )
+
+    # cache arguments
+    parser_cache.add_argument('cache', type=str, help='volume cache file')
+    parser_cache.add_argument(
+        '-p', '--prune', type=int, default=None, 
+        help='the number of the most recently used entries to be kept'
+    )
+    parser_cache.add_argument(
+        '--clear', action='store_true', help='remove all cache entries'
+    )
     
     # source arguments
     parser_source.add_argument(
@@ -127,13 +239,31 @@ def arg_parser():
 
 def main():
     command = arg_parser()
+    if command['action'] == 'cache':
+        manage_cache(command['cache'], command['prune'], command['clear'])
+        return
     path = Path(command['folder'])
     if command['action'] == 'prepare':
-        prepare_task(path, command['config'])
+        prepare_task(
+            path, command['config'], command['threads'], command['resume'],
+            command['incremental']
+        )
     elif command['action'] == 'run':
-        run_task(path, command['threads'])
+        run_task(
+            path, command['threads'], command['resume'], 
+            command['only_failed'], command['retries'], command['fail_fast'],
+            command['backend'], command['worker'], command['lease_expiry'],
+            command['scratch'], command['discard_intermediates'],
+            command['fetch'], command['parsers'], command['delete_outputs']
+        )
+    elif command['action'] == 'report':
+        report_task(
+            path, command['top'], command['bins'], command['all_runs']
+        )
     elif command['action'] == 'fetch':
-        fetch_task(path)
+        fetch_task(path, command['parsers'])
+    elif command['action'] == 'rescenario':
+        rescenario_task(path, command['config'], command['inventory'])
     elif command['action'] == 'source':
         create_source(
             path, command['time'], command['source'], command['distribution'], 
@@ -141,15 +271,189 @@ def main():
         )
 
 
-def fetch_task(path):
+def manage_cache(filename, prune=None, clear=False):
+    with VolumeCache(filename) as cache:
+        if clear:
+            cache.clear()
+        elif prune is not None:
+            removed = cache.prune(prune)
+            print('Removed entries: {0}'.format(removed))
+        stat = cache.info()
+    print('Volume cache: {0}'.format(stat['filename']))
+    print('Entries:      {0}'.format(stat['entries']))
+    print('Size:         {0:.2f} MB'.format(stat['size'] / 1024**2))
+
+
+def fetch_task(path, parsers=1):
     config = load_config(path)
-    fetch.collect(path, config)
+    fetch.collect(path, config, parsers=parsers)
+
+
+def report_task(path, top=10, bins=20, all_runs=False):
+    runs, records = report.load_metrics(path, all_runs=all_runs)
+    summary = report.summarize(runs, records, top=top, bins=bins)
+    print(report.format_report(summary))
+
+
+def remove_collected(path):
+    collected = path / fetch.COLLECTED_FILE
+    if collected.exists():
+        collected.unlink()
+
+
+def remove_leases(path):
+    leases = path / 'leases'
+    if leases.exists():
+        shutil.rmtree(leases)
 
 
-def run_task(path, threads):
+def run_task(
+        path, threads, resume=False, only_failed=False, retries=1, 
+        fail_fast=False, backend='threads', worker=False, 
+        lease_expiry=DEFAULT_EXPIRY, scratch=None, discard_intermediates=False,
+        fetch_results=False, parsers=1, delete_outputs=False
+    ):
     config = load_config(path)
-    task_list = config['task_list']
-    run.run_tasks(task_list, threads=threads)
+    render = None
+    sizes = None
+    specs = config.get('specs', None)
+    if specs is not None:
+        sizes = prepare.inventory_sizes(specs)
+        if specs.get('deferred', True):
+            render = partial(prepare.write_case_inputs, specs=specs)
+    scratch_area = None
+    if scratch is not None:
+        scratch_area = run.ScratchArea(
+            scratch, condense=config.get('condense', None), 
+            keep_intermediates=not discard_intermediates
+        )
+    try:
+        if worker:
+            if fetch_results:
+                print('--fetch is ignored by workers. Run fetch at the end.')
+            collected = fetch.parsed_outputs(path / fetch.COLLECTED_FILE)
+            task_list = config.get('pending', config['task_list'])
+            if resume:
+                task_list = run.remaining_tasks(task_list, collected=collected)
+            with WorkQueue(path / 'leases', expiry=lease_expiry) as queue:
+                if only_failed:
+                    task_list = [
+                        t for t in config['task_list'] 
+                        if queue.status(t[0].name) == 'failed'
+                    ]
+                    for cwd, _ in task_list:
+                        queue.reopen(cwd.name, failed=True)
+                    task_list = run.remaining_tasks(
+                        task_list, collected=collected
+                    )
+                print('Worker {0}: {1} cases in the task'.format(
+                    queue.worker, len(task_list))
+                )
+                metrics_file = path / 'metrics-{0}.jsonl'.format(queue.worker)
+                with run.MetricsLog(metrics_file, threads) as metrics:
+                    failures = run.run_worker(
+                        task_list, queue, threads=threads, render=render,
+                        condense=config.get('condense', None), 
+                        retries=retries, sizes=sizes, scratch=scratch_area, 
+                        metrics=metrics
+                    )
+                tmp = path / 'failures.json.{0}'.format(queue.worker)
+                with open(tmp, 'w') as f:
+                    json.dump(queue.failures(), f, indent=1)
+                tmp.replace(path / 'failures.json')
+            if failures:
+                print('Failed inputs: {0}. See failures.json'.format(
+                    len(failures))
+                )
+            return
+        collected_file = path / fetch.COLLECTED_FILE
+        collector = None
+        if fetch_results:
+            collector = fetch.OutputCollector(
+                config, parsers=parsers, delete=delete_outputs, 
+                filename=collected_file
+            )
+        with contextlib.ExitStack() as stack:
+            if collector is not None:
+                stack.enter_context(collector)
+                collector.load(collected_file)
+                collected = collector.parsed()
+            else:
+                collected = fetch.parsed_outputs(collected_file)
+            state = stack.enter_context(run.RunState(path / 'run.state'))
+            metrics = stack.enter_context(
+                run.MetricsLog(path / 'metrics.jsonl', threads)
+            )
+            if only_failed:
+                failed = state.failed()
+                task_list = run.remaining_tasks(
+                    [t for t in config['task_list'] if t[0].name in failed],
+                    collected=collected
+                )
+            elif resume:
+                task_list = run.remaining_tasks(
+                    config['task_list'], collected=collected
+                )
+            else:
+                task_list = config.get('pending', config['task_list'])
+            print('Cases to run: {0} of {1}'.format(
+                len(task_list), len(config['task_list']))
+            )
+            try:
+                failures = run.run_tasks(
+                    task_list, threads=threads, render=render, 
+                    condense=config.get('condense', None), state=state, 
+                    retries=retries, fail_fast=fail_fast, sizes=sizes, 
+                    backend=backend, verbose=True, scratch=scratch_area,
+                    on_case=collector.add_case if collector else None, 
+                    metrics=metrics
+                )
+            except BaseException:
+                if collector is not None:
+                    collector.save(collected_file)
+                    print('Run is interrupted. Parsed outputs are saved.')
+                raise
+            with open(path / 'failures.json', 'w') as f:
+                json.dump(failures, f, indent=1)
+            if failures:
+                print('Failed inputs: {0}. See failures.json'.format(
+                    len(failures))
+                )
+            if collector is not None:
+                if failures:
+                    collector.save(collected_file)
+                    print('Results are not collected. Parsed outputs are '
+                          'saved and will be reused.')
+                else:
+                    print('Collecting the rest of outputs ...')
+                    collector.finish(progress=True)
+                    collector.write(path)
+    finally:
+        if scratch_area is not None:
+            scratch_area.close()
+
+
+def rescenario_task(path, config_name, inventory=None):
+    config = load_config(path)
+    specs = config.get('specs', None)
+    if specs is None:
+        print('Task has no case specifications. Run prepare --incremental first.')
+        return
+    model, datalib, fispact = load_task(path / config_name)
+    if inventory is None:
+        inventory = path / fispact['inventory']
+    with open(inventory) as f:
+        text = f.read()
+    templates = specs['templates'].replace_scenario(
+        text, float(fispact['norm_flux'])
+    )
+    changed = prepare.change_scenario(path / 'cases', specs, templates)
+    print('Changed inventories: {0}'.format(changed))
+    config['zero'] = utils.find_zero_step(text)
+    config['pending'] = prepare.pending_tasks(config['task_list'])
+    save_config(path, **config)
+    remove_collected(path)
+    remove_leases(path)
 
 
 def create_source(path, time, sdefname, sd, zero, int_filter, vol_filter):
@@ -170,12 +474,36 @@ def create_source(path, time, sdefname, sd, zero, int_filter, vol_filter):
         f.write(sdef)
 
 
-def prepare_task(path, config_name):
+def prepare_task(
+        path, config_name, threads=None, resume=False, incremental=False
+    ):
     print('path: ', path)
     casepath = Path(path / 'cases')
     print('casepath: ', casepath)
-    casepath.mkdir()
+    previous = None
+    if incremental and (path / 'settings.cfg').exists():
+        previous = load_config(path)
+    casepath.mkdir(exist_ok=resume or incremental)
+    checkpoint = path / 'checkpoint'
+    if not resume and checkpoint.exists():
+        shutil.rmtree(checkpoint)
     model, datalib, fispact = load_task(path / config_name)
+    if threads is None:
+        threads = int(model.get('threads', 1))
+    volume_cache = model.get('volume_cache', None)
+    if volume_cache:
+        volume_cache = path / volume_cache
+    clusters = model.get('clusters', None)
+    if clusters:
+        clusters = int(clusters)
+    cluster_error = model.get('cluster_error', None)
+    if cluster_error:
+        cluster_error = float(cluster_error)
+    elif not clusters:
+        cluster_error = 0.05
+    hybrid_threshold = model.get('hybrid_threshold', None)
+    if hybrid_threshold:
+        hybrid_threshold = float(hybrid_threshold)
     # try:
     config = prepare.create_tasks(
         casepath, 
@@ -187,8 +515,25 @@ def prepare_task(path, config_name):
         libxs=fispact['libxs'],
         inventory=path / fispact['inventory'],
         approach=model['approach'],
-        norm_flux=float(fispact['norm_flux'])
+        norm_flux=float(fispact['norm_flux']),
+        threads=threads,
+        volume_cache=volume_cache,
+        cache_size=int(model.get('cache_size', DEFAULT_MAX_ENTRIES)),
+        checkpoint=checkpoint,
+        previous=previous,
+        volume_method=model.get('volume_method', 'exact'),
+        volume_error=float(model.get('volume_error', 0.01)),
+        max_points=int(model.get('max_points', 1000000)),
+        clusters=clusters,
+        cluster_error=cluster_error,
+        hybrid_fraction=float(model.get('hybrid_fraction', 0.9)),
+        hybrid_threshold=hybrid_threshold,
+        deferred=fispact.get('inputs', 'files') == 'deferred'
     )
     # except:
     #    pass
     save_config(path, **config)
+    remove_collected(path)
+    remove_leases(path)
+    if checkpoint.exists():
+        shutil.rmtree(checkpoint)
@@ -1,16 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import os
+import pickle
+import shutil
 from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 
 import numpy as np
 from click import progressbar
 from mckit import read_mcnp
+from mckit.geometry import Box
 from mckit.parser.meshtal_parser import read_meshtal
 from mckit.material import AVOGADRO
 
 from . import template
 from . import data
 from . import utils
+from . import cluster
+from .cache import VolumeCache, DEFAULT_MAX_ENTRIES, cell_key, volume_key
+
+
+_INPUT_FILES = ('files', 'arb_flux')
+_STOCHASTIC_BATCH = 10000
 
 
 def create_tasks(path, **kwargs):
@@ -21,29 +34,74 @@ def create_tasks(path, **kwargs):
     path : Path
         Path, where tasks must be created.
     **kwargs : dict
-        A dictionary of input data.
+        A dictionary of input data. If it contains 'previous' - configuration
+        of the previous prepare run, then the task is updated incrementally:
+        volumes of unchanged cells are reused, only changed input files are
+        rewritten and stale outputs, cases and inventories are removed.
     
     Returns
     -------
     config : dict
         Task configuration.
     """
+    previous = kwargs.get('previous', None)
     model = read_mcnp_input(kwargs['mcnp_name'])
     
     fmesh = read_fmesh_tally(kwargs['fmesh_name'], kwargs['tally_name'])
 
     # set templates
-    zero_index = init_templates(
+    templates, zero_index = init_templates(
         kwargs['inventory'], kwargs['norm_flux'], kwargs['libs'], 
         kwargs['libxs'], fmesh._data.shape[0]
     )
 
     bbox = fmesh.mesh.bounding_box()
     print('Selecting cells ...')
-    cells = select_cells(model, bbox)
+    cells = select_cells(model, bbox, threads=kwargs.get('threads', 1))
+    cell_keys = get_cell_keys(cells)
+    volume_params = {
+        'method': kwargs.get('volume_method', 'exact'),
+        'min_volume': kwargs['min_volume'],
+        'rel_error': kwargs.get('volume_error', 0.01),
+        'max_points': kwargs.get('max_points', 1000000)
+    }
+    unchanged = unchanged_cells(previous, cell_keys, fmesh.mesh, volume_params)
+    if unchanged:
+        print('Volumes of {0} unchanged cells are reused'.format(len(unchanged)))
 
     print('Calculate volumes ...')
-    vol_dict = calculate_volumes(cells, fmesh.mesh, kwargs['min_volume'])
+    cache_name = kwargs.get('volume_cache', None)
+    cache = None
+    if cache_name:
+        cache_size = kwargs.get('cache_size', DEFAULT_MAX_ENTRIES)
+        cache = VolumeCache(cache_name, cache_size)
+    vol_errors = {}
+    try:
+        vol_dict = calculate_volumes(
+            [c for c in cells if c.name() not in unchanged], 
+            fmesh.mesh, kwargs['min_volume'], 
+            threads=kwargs.get('threads', 1), cache=cache,
+            checkpoint=kwargs.get('checkpoint', None),
+            method=volume_params['method'], 
+            rel_error=volume_params['rel_error'],
+            max_points=volume_params['max_points'], errors=vol_errors
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+    for index, vol in (previous or {}).get('volumes', {}).items():
+        if index[0] in unchanged:
+            vol_dict[index] = vol
+    for index, err in (previous or {}).get('volume_errors', {}).items():
+        if index[0] in unchanged:
+            vol_errors[index] = err
+    rel_errors = [
+        err / vol_dict[index] for index, err in vol_errors.items()
+        if vol_dict.get(index, 0) > 0
+    ]
+    if rel_errors:
+        max_error = max(rel_errors)
+        print('Maximum relative error of volumes: {0:.3e}'.format(max_error))
 
     mat_dict = get_materials(cells)
     den_dict = get_densities(cells)
@@ -52,15 +110,21 @@ def create_tasks(path, **kwargs):
     # Set configuration
     config = {
         'mesh': fmesh.mesh, 'volumes': vol_dict, 'masses': mass_dict, 
-        'approach': kwargs['approach'], 'zero': zero_index
+        'approach': kwargs['approach'], 'zero': zero_index,
+        'cell_keys': cell_keys, 'min_volume': kwargs['min_volume'],
+        'volume_params': volume_params, 'volume_errors': vol_errors
     }
 
     # Create input files
     print('Creating input files ...')
+    specs = new_specs(
+        fmesh._ebins, templates, deferred=kwargs.get('deferred', False)
+    )
     if kwargs['approach'] == 'full':
-        task_list, index_output = create_full_tasks(
-            path, fmesh, mass_dict, mat_dict, den_dict
+        task_list, index_output, scales = create_full_tasks(
+            path, templates, fmesh, mass_dict, mat_dict, den_dict, specs=specs
         )
+        config['scales'] = scales
     elif kwargs['approach'] == 'simple':
         F0 = np.max(fmesh._data)
         M0 = max(mass_dict.values())
@@ -72,14 +136,145 @@ def create_tasks(path, **kwargs):
 
         mats = {m.name(): m for m in mat_dict.values()}
         task_list, index_output = create_simple_tasks(
-            path, ebins, mats, F0, M0
+            path, templates, ebins, mats, F0, M0, specs=specs
+        )
+    elif kwargs['approach'] == 'hybrid':
+        important = select_important(
+            mass_dict, np.sum(fmesh._data, axis=0), 
+            fraction=kwargs.get('hybrid_fraction'), 
+            threshold=kwargs.get('hybrid_threshold')
+        )
+        print('Cell pieces calculated in full: {0} of {1}'.format(
+            len(important), len(mass_dict))
+        )
+        full_masses = {k: v for k, v in mass_dict.items() if k in important}
+        rest = {k: v for k, v in mass_dict.items() if k not in important}
+        task_list, index_output, scales = create_full_tasks(
+            path, templates, fmesh, full_masses, mat_dict, den_dict, specs=specs
+        )
+        F0 = np.max(fmesh._data)
+        M0 = max(rest.values()) if rest else 1.0
+        ebins = fmesh._ebins
+
+        config['scales'] = scales
+        config['alpha'] = fmesh._data / F0
+        config['beta'] = {k: rest.get(k, 0.0) / M0 for k in mass_dict.keys()}
+        config['c2m'] = {c: m.name() for c, m in mat_dict.items()}
+
+        mats = {mat_dict[c].name(): mat_dict[c] for c, i, j, k in rest.keys()}
+        if mats:
+            simple_list, simple_output = create_simple_tasks(
+                path, templates, ebins, mats, F0, M0, specs=specs
+            )
+            task_list.extend(simple_list)
+            index_output.update(simple_output)
+    elif kwargs['approach'] == 'clustered':
+        ebins = fmesh._ebins
+        fluxes = np.sum(fmesh._data, axis=0)
+        labels, centroids, stats = cluster_voxel_spectra(
+            fmesh._data, mass_dict.keys(), kwargs.get('clusters'), 
+            kwargs.get('cluster_error')
         )
+        print('Number of clusters: {0}'.format(centroids.shape[0]))
+        print('Clustering error: mean {mean:.3e}, flux-weighted {weighted:.3e}'
+              ', max {max:.3e}'.format(**stats))
+        F0 = np.max(fluxes)
+        M0 = max(mass_dict.values())
+
+        config['labels'] = labels
+        config['n_clusters'] = centroids.shape[0]
+        config['flux_ratio'] = fluxes / F0
+        config['cluster_errors'] = stats
+        config['beta'] = {k: v / M0 for k, v in mass_dict.items()}
+        config['c2m'] = {c: m.name() for c, m in mat_dict.items()}
 
+        mats = {m.name(): m for m in mat_dict.values()}
+        task_list, index_output = create_spectrum_tasks(
+            path, templates, ebins, centroids * F0, mats, M0, specs=specs
+        )
+
+    finish_specs(specs)
+    if specs['deferred'] and previous is not None:
+        remove_changed_outputs(path, specs, previous.get('specs', None))
+    config['specs'] = specs
+    condense = prepare_condense(path, templates)
+    if previous is not None:
+        remove_stale_tasks(path, task_list + [(condense, ['condense'])])
+    config['condense'] = condense
     config['task_list'] = task_list
     config['index_output'] = index_output
+    config['pending'] = pending_tasks(task_list)
     return config
 
 
+def get_cell_keys(cells):
+    """Gets geometry keys of cells.
+
+    Parameters
+    ----------
+    cells : list
+        A list of cells.
+
+    Returns
+    -------
+    cell_keys : dict
+        A dictionary of cell keys. cell_name -> tuple of geometry keys of all
+        cells with this name.
+    """
+    cell_keys = defaultdict(list)
+    for c in cells:
+        cell_keys[c.name()].append(cell_key(c))
+    return {name: tuple(sorted(keys)) for name, keys in cell_keys.items()}
+
+
+def unchanged_cells(previous, cell_keys, mesh, volume_params):
+    """Finds cells, whose volumes can be taken from the previous run.
+
+    Parameters
+    ----------
+    previous : dict
+        Configuration of the previous run. If None, no cells are reused.
+    cell_keys : dict
+        Geometry keys of cells. cell_name -> tuple of keys.
+    mesh : RectMesh
+        Mesh.
+    volume_params : dict
+        Parameters of volume calculations.
+
+    Returns
+    -------
+    names : set
+        Names of cells, that are not changed.
+    """
+    if previous is None or 'cell_keys' not in previous:
+        return set()
+    if previous.get('volume_params', None) != volume_params:
+        return set()
+    if not same_mesh(previous['mesh'], mesh):
+        return set()
+    old_keys = previous['cell_keys']
+    return {name for name, keys in cell_keys.items() if old_keys.get(name) == keys}
+
+
+def same_mesh(mesh1, mesh2):
+    """Checks if two meshes have the same bins.
+
+    Parameters
+    ----------
+    mesh1, mesh2 : RectMesh
+        Meshes to be compared.
+
+    Returns
+    -------
+    result : bool
+        True, if meshes are the same.
+    """
+    for attr in ('_xbins', '_ybins', '_zbins', '_ex', '_ey', '_ez'):
+        if not np.array_equal(getattr(mesh1, attr), getattr(mesh2, attr)):
+            return False
+    return True
+
+
 def read_mcnp_input(inp_filename):
     print('Reading MCNP model ({0}) ...'.format(inp_filename))
     return read_mcnp(inp_filename)
@@ -94,15 +289,24 @@ def read_fmesh_tally(fmesh_filename, tally_name):
 def init_templates(inv_filename, norm_flux, libs, libxs, nerg_groups):
     with open(inv_filename) as f:
         text = f.read()
-    template.init_inventory_template(text, norm_flux)
-    template.init_files_template(libs)
-    template.init_collapse_template(libxs, nerg_groups)
-    return utils.find_zero_step(text)
+    templates = template.TemplateSet.create(
+        text, norm_flux, libs, libxs, nerg_groups
+    )
+    return templates, utils.find_zero_step(text)
 
 
-def calculate_volumes(cells, mesh, min_volume):
+def calculate_volumes(
+        cells, mesh, min_volume, threads=1, cache=None, checkpoint=None,
+        method='exact', rel_error=0.01, max_points=1000000, errors=None
+    ):
     """Calculates volumes of model cells in every mesh voxel.
 
+    Voxels are classified by select_voxel_cells first. If a voxel lies 
+    entirely inside a cell, the cell's volume is the voxel volume and no 
+    integration is needed. Otherwise only candidate cells are integrated over
+    the voxel. Voxels are grouped into columns (i, j, *). If threads is
+    greater than 1, columns are distributed among worker processes.
+
     Parameters
     ----------
     cells : list
@@ -111,45 +315,602 @@ def calculate_volumes(cells, mesh, min_volume):
         Mesh.
     min_volume : float
         Minimum volume for volume calculations.
+    threads : int
+        The number of worker processes. Default: 1.
+    cache : VolumeCache
+        Persistent cache of volumes. Cached volumes are not calculated, and 
+        calculated volumes are stored in the cache. It is used only for 
+        exact method. Default: None.
+    checkpoint : Path
+        Folder for checkpoint files. Volumes of every completed mesh slab
+        (all voxels with the same index i), including volumes found in the 
+        cache, are saved there. Slabs, that are already saved in this 
+        folder, are not calculated again. Default: None.
+    method : str
+        Volume calculation method. 'exact' - adaptive integration by mckit
+        down to min_volume; 'stochastic' - estimation by random points 
+        (see estimate_voxel_volumes). Default: 'exact'.
+    rel_error : float
+        Target relative error of stochastic volumes. Default: 0.01.
+    max_points : int
+        Maximum number of random points per voxel for stochastic volumes. 
+        Default: 1000000.
+    errors : dict
+        If given, standard deviations of stochastic volumes are stored
+        there. c, i, j, k -> error. Default: None.
 
     Returns
     -------
     volumes : dict
         A dictionary of cell volumes. 
     """
+    if method == 'exact':
+        params = {'method': method, 'min_volume': min_volume}
+    elif method == 'stochastic':
+        params = {
+            'method': method, 'rel_error': rel_error, 'max_points': max_points
+        }
+        cache = None
+    else:
+        raise ValueError('Unknown volume method: {0}'.format(method))
     volumes = defaultdict(int)
-    nx, ny, nz = mesh.shape
-    with progressbar(length=nx*ny*nz) as bar:
-        for i in range(mesh.shape[0]):
-            for j in range(mesh.shape[1]):
-                for k in range(mesh.shape[2]):
-                    box = mesh.get_voxel(i, j, k)
-                    for c in cells:
-                        vol = c.shape.volume(box=box, min_volume=min_volume)
-                        if vol > 0:
-                            index = (c.name(), i, j, k)
-                            volumes[index] += vol
-                    bar.update(1)
+    voxel_cells, filled = select_voxel_cells(cells, mesh)
+    for (i, j, k), q in filled.items():
+        index = (cells[q].name(), i, j, k)
+        volumes[index] += mesh.get_voxel(i, j, k).volume
+    total = len(voxel_cells) + len(filled)
+    calculated = {}
+    calc_errors = {}
+    if checkpoint is not None:
+        header = dict(params, cells=[c.name() for c in cells], shape=mesh.shape)
+        saved = load_checkpoint(checkpoint, header)
+        for slab_volumes, slab_errors in saved.values():
+            calculated.update(slab_volumes)
+            calc_errors.update(slab_errors)
+        voxel_cells = {
+            index: candidates for index, candidates in voxel_cells.items() 
+            if index[0] not in saved
+        }
+    if cache is not None:
+        voxel_cells, found, keys = lookup_volumes(
+            cache, cells, mesh, voxel_cells, min_volume
+        )
+        merge_volumes(volumes, found, cells)
+    columns = defaultdict(list)
+    for (i, j, k), candidates in sorted(voxel_cells.items()):
+        columns[(i, j)].append(((i, j, k), candidates))
+    slab_columns = defaultdict(int)
+    for i, j in columns.keys():
+        slab_columns[i] += 1
+    slabs = defaultdict(lambda: ({}, {}))
+    if checkpoint is not None and cache is not None:
+        # Cached volumes are saved with the slab too, because voxels of 
+        # saved slabs are not looked up in the cache on resume.
+        for index, vol in found.items():
+            slabs[index[1]][0][index] = vol
+        for i in list(slabs.keys()):
+            if slab_columns[i] == 0:
+                save_checkpoint(checkpoint, i, header, slabs.pop(i))
+    with progressbar(length=total) as bar:
+        bar.update(total - len(voxel_cells))
+        for chunk, part, part_errors in iter_voxel_volumes(
+                cells, mesh, list(columns.values()), params, threads
+            ):
+            calculated.update(part)
+            calc_errors.update(part_errors)
+            bar.update(len(chunk))
+            if checkpoint is not None:
+                i = chunk[0][0][0]
+                slabs[i][0].update(part)
+                slabs[i][1].update(part_errors)
+                slab_columns[i] -= 1
+                if slab_columns[i] == 0:
+                    save_checkpoint(checkpoint, i, header, slabs.pop(i))
+    merge_volumes(volumes, calculated, cells)
+    if errors is not None:
+        merge_errors(errors, calc_errors, cells)
+    if cache is not None:
+        cache.put_many({
+            keys[index]: vol for index, vol in calculated.items() 
+            if index in keys
+        })
+        cache.prune()
+    return volumes
+
+
+def iter_voxel_volumes(cells, mesh, chunks, params, threads=1):
+    """Calculates volumes of candidate cells chunk by chunk.
+
+    Parameters
+    ----------
+    cells : list
+        List of cells in mesh.
+    mesh : RectMesh
+        Mesh.
+    chunks : list
+        A list of chunks of voxels. Every chunk is a list of voxels as
+        accepted by calculate_voxel_volumes.
+    params : dict
+        Parameters of volume calculation method (see chunk_volumes).
+    threads : int
+        The number of worker processes. Default: 1.
+
+    Returns
+    -------
+    chunk : list
+        Chunk of voxels.
+    volumes : dict
+        Volumes of the chunk. q, i, j, k -> vol.
+    errors : dict
+        Errors of the chunk's volumes. q, i, j, k -> error.
+    """
+    if threads > 1:
+        with ProcessPoolExecutor(
+            max_workers=threads, initializer=_init_volume_worker, 
+            initargs=(cells, mesh, params)
+        ) as pool:
+            futures = {
+                pool.submit(_voxel_volumes, chunk): chunk for chunk in chunks
+            }
+            for future in as_completed(futures):
+                yield (futures[future], *future.result())
+    else:
+        for chunk in chunks:
+            yield (chunk, *chunk_volumes(cells, mesh, chunk, params))
+
+
+def chunk_volumes(cells, mesh, voxels, params):
+    """Calculates volumes of candidate cells by the specified method.
+
+    Parameters
+    ----------
+    cells : list
+        List of cells in mesh.
+    mesh : RectMesh
+        Mesh.
+    voxels : list
+        A list of voxels as accepted by calculate_voxel_volumes.
+    params : dict
+        Method parameters. 'method' - 'exact' or 'stochastic'; 'min_volume'
+        for exact method; 'rel_error' and 'max_points' for stochastic one.
+
+    Returns
+    -------
+    volumes : dict
+        Volumes. q, i, j, k -> vol.
+    errors : dict
+        Errors of volumes. q, i, j, k -> error. It is empty for exact method.
+    """
+    if params['method'] == 'stochastic':
+        return estimate_voxel_volumes(
+            cells, mesh, voxels, params['rel_error'], params['max_points']
+        )
+    volumes = calculate_voxel_volumes(cells, mesh, voxels, params['min_volume'])
+    return volumes, {}
+
+
+def load_checkpoint(folder, header):
+    """Loads volumes of completed mesh slabs.
+
+    Checkpoint files with different header are ignored.
+
+    Parameters
+    ----------
+    folder : Path
+        Checkpoint folder.
+    header : dict
+        Parameters of volume calculations.
+
+    Returns
+    -------
+    slabs : dict
+        Volumes of completed slabs and their errors. 
+        i -> ({(q, i, j, k) -> vol}, {(q, i, j, k) -> error}).
+    """
+    slabs = {}
+    for filename in sorted(folder.glob('slab-*.pkl')):
+        with open(filename, 'br') as f:
+            saved_header, slab = pickle.load(f)
+        if saved_header != header:
+            print('Checkpoint {0} does not match the task.'.format(filename))
+            continue
+        slabs[int(filename.stem.split('-')[1])] = slab
+    if slabs:
+        print('Volumes of {0} mesh slabs are loaded from checkpoint'.format(
+            len(slabs))
+        )
+    return slabs
+
+
+def save_checkpoint(folder, i, header, slab):
+    """Saves volumes of completed mesh slab.
+
+    Parameters
+    ----------
+    folder : Path
+        Checkpoint folder.
+    i : int
+        Index of the slab.
+    header : dict
+        Parameters of volume calculations.
+    slab : tuple
+        Volumes of the slab and their errors. 
+        ({(q, i, j, k) -> vol}, {(q, i, j, k) -> error})
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    filename = folder / 'slab-{0}.pkl'.format(i)
+    temp = filename.with_suffix('.tmp')
+    with open(temp, 'bw') as f:
+        pickle.dump((header, slab), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, filename)
+
+
+def calculate_voxel_volumes(cells, mesh, voxels, min_volume):
+    """Calculates volumes of candidate cells in the given voxels.
+
+    Parameters
+    ----------
+    cells : list
+        List of cells in mesh.
+    mesh : RectMesh
+        Mesh.
+    voxels : list
+        A list of voxels to be calculated. Each item is a tuple
+        ((i, j, k), candidates), where candidates is a list of indices of
+        cells which can intersect the voxel.
+    min_volume : float
+        Minimum volume for volume calculations.
+
+    Returns
+    -------
+    volumes : dict
+        A dictionary of cell volumes including zero ones. q, i, j, k -> vol,
+        where q is the index of the cell.
+    """
+    volumes = {}
+    for (i, j, k), candidates in voxels:
+        box = mesh.get_voxel(i, j, k)
+        for q in candidates:
+            vol = cells[q].shape.volume(box=box, min_volume=min_volume)
+            volumes[(q, i, j, k)] = vol
     return volumes
 
 
-def select_cells(model, box):
+def estimate_voxel_volumes(
+        cells, mesh, voxels, rel_error, max_points, batch=_STOCHASTIC_BATCH
+    ):
+    """Estimates volumes of candidate cells in the given voxels by sampling.
+
+    Random points are generated in the voxel by batches. Every batch is 
+    classified against all candidate cells; since cells do not overlap,
+    a point found inside a cell is not tested against other cells. Sampling
+    stops when relative errors of all nonzero volumes are less than 
+    rel_error or the number of points reaches max_points.
+
+    Parameters
+    ----------
+    cells : list
+        List of cells in mesh.
+    mesh : RectMesh
+        Mesh.
+    voxels : list
+        A list of voxels as accepted by calculate_voxel_volumes.
+    rel_error : float
+        Target relative error.
+    max_points : int
+        Maximum number of points per voxel.
+    batch : int
+        The number of points in the batch. Default: 10000.
+
+    Returns
+    -------
+    volumes : dict
+        Volumes. q, i, j, k -> vol.
+    errors : dict
+        Standard deviations of volumes. q, i, j, k -> error.
+    """
+    volumes = {}
+    errors = {}
+    for (i, j, k), candidates in voxels:
+        box = mesh.get_voxel(i, j, k)
+        hits = np.zeros(len(candidates))
+        total = 0
+        while total < max_points:
+            points = box.generate_random_points(batch)
+            free = np.ones(points.shape[0], dtype=bool)
+            for m, q in enumerate(candidates):
+                if not np.any(free):
+                    break
+                inside = np.zeros_like(free)
+                inside[free] = cells[q].shape.test_points(points[free]) > 0
+                hits[m] += np.count_nonzero(inside)
+                free &= ~inside
+            total += points.shape[0]
+            if np.all(sampling_errors(hits, total) <= rel_error):
+                break
+        fraction = hits / total
+        std = np.sqrt(fraction * (1 - fraction) / total)
+        for m, q in enumerate(candidates):
+            volumes[(q, i, j, k)] = fraction[m] * box.volume
+            errors[(q, i, j, k)] = std[m] * box.volume
+    return volumes, errors
+
+
+def sampling_errors(hits, total):
+    """Gets relative errors of volume fractions estimated by sampling.
+
+    Parameters
+    ----------
+    hits : numpy.ndarray
+        The number of points that fall in every cell.
+    total : int
+        The total number of points.
+
+    Returns
+    -------
+    errors : numpy.ndarray
+        Relative errors. Errors of cells without hits are zero.
+    """
+    hits = np.asarray(hits, dtype=float)
+    errors = np.zeros_like(hits)
+    nonzero = hits > 0
+    errors[nonzero] = np.sqrt((1 - hits[nonzero] / total) / hits[nonzero])
+    return errors
+
+
+def lookup_volumes(cache, cells, mesh, voxel_cells, min_volume):
+    """Finds volumes of candidate cells in the cache.
+
+    Parameters
+    ----------
+    cache : VolumeCache
+        Volume cache.
+    cells : list
+        List of cells in mesh.
+    mesh : RectMesh
+        Mesh.
+    voxel_cells : dict
+        A dictionary of candidate cells. (i, j, k) -> list of cell indices.
+    min_volume : float
+        Minimum volume for volume calculations.
+
+    Returns
+    -------
+    remaining : dict
+        Candidate cells, whose volumes are not cached. 
+        (i, j, k) -> list of cell indices.
+    found : dict
+        Cached volumes. q, i, j, k -> vol.
+    keys : dict
+        Cache keys of volumes to be calculated. q, i, j, k -> key.
+    """
+    cell_keys = [cell_key(c) for c in cells]
+    keys = {}
+    for (i, j, k), candidates in voxel_cells.items():
+        box = mesh.get_voxel(i, j, k)
+        for q in candidates:
+            keys[(q, i, j, k)] = volume_key(
+                cell_keys[q], box, min_volume
+            )
+    cached = cache.get_many(keys.values())
+    found = {}
+    remaining = defaultdict(list)
+    for (q, i, j, k), key in keys.items():
+        if key in cached:
+            found[(q, i, j, k)] = cached[key]
+        else:
+            remaining[(i, j, k)].append(q)
+    keys = {index: key for index, key in keys.items() if index not in found}
+    return dict(remaining), found, keys
+
+
+def select_voxel_cells(cells, mesh):
+    """Finds cells that can intersect every mesh voxel.
+
+    The mesh is recursively split into blocks of voxels. Cells that are 
+    outside the block are excluded from further checks of all voxels of 
+    the block. If the block lies entirely inside a cell, all voxels of the
+    block are filled with this cell and other cells are not checked.
+
+    Parameters
+    ----------
+    cells : list
+        List of cells in mesh.
+    mesh : RectMesh
+        Mesh.
+
+    Returns
+    -------
+    voxel_cells : dict
+        A dictionary of candidate cells. (i, j, k) -> list of cell indices.
+        Voxels without candidates and filled voxels are absent.
+    filled : dict
+        A dictionary of voxels that lie entirely inside a cell. 
+        (i, j, k) -> cell index.
+    """
+    voxel_cells = {}
+    filled = {}
+    nx, ny, nz = mesh.shape
+    blocks = deque([((0, nx, 0, ny, 0, nz), list(range(len(cells))))])
+    while len(blocks) > 0:
+        block, candidates = blocks.popleft()
+        box = block_box(mesh, *block)
+        inner = []
+        owner = None
+        for q in candidates:
+            test = cells[q].shape.test_box(box)
+            if test == +1:
+                owner = q
+                break
+            elif test == 0:
+                inner.append(q)
+        if owner is not None:
+            for i in range(block[0], block[1]):
+                for j in range(block[2], block[3]):
+                    for k in range(block[4], block[5]):
+                        filled[(i, j, k)] = owner
+            continue
+        if not inner:
+            continue
+        sizes = [block[1] - block[0], block[3] - block[2], block[5] - block[4]]
+        dim = int(np.argmax(sizes))
+        if sizes[dim] == 1:
+            voxel_cells[(block[0], block[2], block[4])] = inner
+            continue
+        low, high = block[2 * dim], block[2 * dim + 1]
+        mid = (low + high) // 2
+        left = list(block)
+        left[2 * dim + 1] = mid
+        right = list(block)
+        right[2 * dim] = mid
+        blocks.append((tuple(left), inner))
+        blocks.append((tuple(right), inner))
+    return voxel_cells, filled
+
+
+def block_box(mesh, i0, i1, j0, j1, k0, k1):
+    """Gets the box of the block of mesh voxels.
+
+    Parameters
+    ----------
+    mesh : RectMesh
+        Mesh.
+    i0, i1, j0, j1, k0, k1 : int
+        Index ranges of the block: [i0, i1), [j0, j1), [k0, k1).
+
+    Returns
+    -------
+    box : Box
+        The box that describes the block.
+    """
+    first = mesh.get_voxel(i0, j0, k0)
+    if (i1 - i0) * (j1 - j0) * (k1 - k0) == 1:
+        return first
+    xdim = mesh._xbins[i1] - mesh._xbins[i0]
+    ydim = mesh._ybins[j1] - mesh._ybins[j0]
+    zdim = mesh._zbins[k1] - mesh._zbins[k0]
+    # Shifts of the block center from the center of its first voxel along 
+    # mesh axes. They are taken from bin edges, because bins may be 
+    # non-uniform.
+    dx = 0.5 * (mesh._xbins[i1] - mesh._xbins[i0 + 1])
+    dy = 0.5 * (mesh._ybins[j1] - mesh._ybins[j0 + 1])
+    dz = 0.5 * (mesh._zbins[k1] - mesh._zbins[k0 + 1])
+    center = np.array(first.center) + dx * np.array(mesh._ex) + \
+        dy * np.array(mesh._ey) + dz * np.array(mesh._ez)
+    return Box(
+        center, xdim, ydim, zdim, ex=mesh._ex, ey=mesh._ey, ez=mesh._ez
+    )
+
+
+def merge_volumes(volumes, part, cells):
+    """Adds nonzero volumes of the part to the total volumes.
+
+    Parameters
+    ----------
+    volumes : dict
+        Total volumes. c, i, j, k -> vol. It is modified in place.
+    part : dict
+        Volumes to be added. q, i, j, k -> vol, where q is cell index.
+    cells : list
+        List of cells.
+    """
+    for (q, i, j, k), vol in part.items():
+        if vol > 0:
+            volumes[(cells[q].name(), i, j, k)] += vol
+
+
+def merge_errors(errors, part, cells):
+    """Adds errors of the part to the total errors.
+
+    Errors of cells with the same name in the same voxel are summed in 
+    quadrature.
+
+    Parameters
+    ----------
+    errors : dict
+        Total errors. c, i, j, k -> error. It is modified in place.
+    part : dict
+        Errors to be added. q, i, j, k -> error, where q is cell index.
+    cells : list
+        List of cells.
+    """
+    for (q, i, j, k), err in part.items():
+        if err > 0:
+            index = (cells[q].name(), i, j, k)
+            errors[index] = np.sqrt(errors.get(index, 0) ** 2 + err ** 2)
+
+
+_volume_worker = {}
+
+
+def _init_volume_worker(cells, mesh, params):
+    """Stores volume calculation data in the worker process."""
+    _volume_worker['cells'] = cells
+    _volume_worker['mesh'] = mesh
+    _volume_worker['params'] = params
+
+
+def _voxel_volumes(voxels):
+    """Calculates volumes of the voxels in the worker process."""
+    return chunk_volumes(
+        _volume_worker['cells'], _volume_worker['mesh'], voxels,
+        _volume_worker['params']
+    )
+
+
+def select_cells(model, box, threads=1):
     """Finds all cells that intersect the box.
 
+    Top-level cells of the model are checked independently. If threads is
+    greater than 1, they are distributed among worker processes.
+
     Parameters
     ----------
     model : Universe
         The model to be checked.
     box : Box
         Box to be checked.
+    threads : int
+        The number of worker processes. Default: 1.
     
+    Returns
+    -------
+    cells : list
+        A list of selected cells.
+    """
+    top_cells = list(model)
+    if threads > 1:
+        with ProcessPoolExecutor(
+            max_workers=threads, initializer=_init_select_worker, 
+            initargs=(top_cells, box)
+        ) as pool:
+            parts = list(pool.map(_select_cells, range(len(top_cells))))
+    else:
+        memo = {}
+        parts = [select_cell_tree(c, box, memo) for c in top_cells]
+    return [c for part in parts for c in part]
+
+
+def select_cell_tree(cell, box, memo):
+    """Finds all cells of the cell's filling tree that intersect the box.
+
+    Parameters
+    ----------
+    cell : Body
+        Cell to be checked.
+    box : Box
+        Box to be checked.
+    memo : dict
+        Memo of transformed universes (see filling_cells). It is shared 
+        between calls for different cells of the same model.
+
     Returns
     -------
     cells : list
         A list of selected cells.
     """
     cells = []
-    cells_to_check = deque(c for c in model)
+    cells_to_check = deque([cell])
     while len(cells_to_check) > 0:
         c = cells_to_check.popleft()
         fill_opt = c.options.get('FILL', None)
@@ -157,17 +918,62 @@ def select_cells(model, box):
         if test == -1:
             continue
         if fill_opt:
-            u = fill_opt['universe']
-            tr = fill_opt.get('transform', None)
-            if tr:
-                u = u.transform(tr)
-            for uc in u:
+            for uc in filling_cells(fill_opt, box, memo):
                 cells_to_check.append(uc.intersection(c))
         elif c.material():
             cells.append(c)
     return cells
 
 
+def filling_cells(fill_opt, box, memo):
+    """Gets cells of the filling universe that can intersect the box.
+
+    Transformed universes are memoized by (universe, transformation), so
+    the same universe is transformed and tested against the box only once.
+
+    Parameters
+    ----------
+    fill_opt : dict
+        FILL option of the cell.
+    box : Box
+        Box to be checked.
+    memo : dict
+        Memo of transformed universes. It is modified in place.
+
+    Returns
+    -------
+    cells : list
+        Cells of the transformed universe, that are not outside the box.
+    """
+    u = fill_opt['universe']
+    tr = fill_opt.get('transform', None)
+    key = (id(u), id(tr))
+    if key not in memo:
+        tu = u.transform(tr) if tr else u
+        selected = [uc for uc in tu if uc.shape.test_box(box) != -1]
+        # u and tr are kept to prevent reuse of their ids.
+        memo[key] = (u, tr, selected)
+    return memo[key][2]
+
+
+_select_worker = {}
+
+
+def _init_select_worker(top_cells, box):
+    """Stores cell selection data in the worker process."""
+    _select_worker['cells'] = top_cells
+    _select_worker['box'] = box
+    _select_worker['memo'] = {}
+
+
+def _select_cells(index):
+    """Selects cells of the top-level cell in the worker process."""
+    return select_cell_tree(
+        _select_worker['cells'][index], _select_worker['box'], 
+        _select_worker['memo']
+    )
+
+
 def get_materials(cells):
     """Gets materials of cells.
 
@@ -231,13 +1037,22 @@ def get_masses(vol_dict, den_dict):
     return masses
 
 
-def create_full_tasks(path, fmesh, masses, materials, densities):
+def create_full_tasks(
+    path, templates, fmesh, masses, materials, densities, specs=None
+):
     """Creates fispact tasks.
 
+    Voxels with identical neutron spectra share one case folder, and cells
+    of such voxels with identical material and density share one inventory.
+    The inventory is calculated for the mass of the first cell piece; 
+    results for other pieces are obtained by scaling with mass ratio.
+
     Parameters
     ----------
     path : Path
         Path, where tasks must be created.
+    templates : TemplateSet
+        FISPACT input templates.
     fmesh : FMesh
         Fmesh tally.
     masses : dict
@@ -246,6 +1061,9 @@ def create_full_tasks(path, fmesh, masses, materials, densities):
         Dictionary of materials of every cell. cell_name -> material.
     densities : dict
         A dictionary of cell densities of every cell. cell_name -> density.
+    specs : dict
+        Specifications of inputs (see new_specs). If given, case 
+        specifications are stored in specs. Default: None.
     
     Returns
     -------
@@ -254,49 +1072,175 @@ def create_full_tasks(path, fmesh, masses, materials, densities):
         (case_folder_name, [inventory_names])
     index_output : dict
         A dictionary (c, i, j, k) -> output_file_name.
+    scales : dict
+        A dictionary of scale factors for shared outputs. 
+        (c, i, j, k) -> mass / mass of calculated inventory.
     """
     task_list = []
     index_output = {}
+    scales = {}
     ebins = fmesh._ebins
     fdata = fmesh._data
     spatial_to_cell = defaultdict(list)
-    for (c, i, j, k), mass in masses.items():
+    for (c, i, j, k), mass in sorted(masses.items()):
         spatial_to_cell[(i, j, k)].append((c, mass))
-    
-    for (i, j, k), cell_mass in spatial_to_cell.items():
-        spectrum = fdata[:, i, j, k]
-        flux = np.sum(spectrum)
 
-        task_item = prepare_folder(
-            path, 'case-{0}-{1}-{2}'.format(i, j, k), ebins, spectrum
+    voxels = sorted(spatial_to_cell.keys())
+    spectrum_keys = [
+        hashlib.sha1(np.ascontiguousarray(fdata[:, i, j, k]).tobytes()).digest()
+        for i, j, k in voxels
+    ]
+    arb_flux = {}
+    if specs is None or not specs['deferred']:
+        first = {}
+        for index, key in zip(voxels, spectrum_keys):
+            first.setdefault(key, index)
+        texts = arbflux_texts(
+            ebins, [fdata[:, i, j, k] for i, j, k in first.values()]
         )
+        arb_flux = dict(zip(first.keys(), texts))
+
+    spectrum_cases = {}
+    inventories = {}
+    for (i, j, k), spectrum_key in zip(voxels, spectrum_keys):
+        cell_mass = spatial_to_cell[(i, j, k)]
+        spectrum = fdata[:, i, j, k]
+        flux = np.sum(spectrum)
+        if spectrum_key not in spectrum_cases:
+            task_item = prepare_folder(
+                path, templates, 'case-{0}-{1}-{2}'.format(i, j, k), ebins, 
+                spectrum,
+                specs=specs, arb_flux=arb_flux.get(spectrum_key, None)
+            )
+            spectrum_cases[spectrum_key] = task_item
+            task_list.append(task_item)
+        task_item = spectrum_cases[spectrum_key]
 
         for c, mass in cell_mass:
             den = densities[c]
-            mat_text = material_description(materials[c], mass, density=den)
-            inventory_name = 'inventory_{0}'.format(c)
-            add_inventory_case(
-                task_item, inventory_name, flux, mat_text
-            )
-            index_output[(c, i, j, k)] = task_item[0] / (inventory_name + '.out')
-        task_list.append(task_item)
-        
-    return task_list, index_output
+            inv_key = (spectrum_key, materials[c], den)
+            if inv_key not in inventories:
+                inventory_name = 'inventory_{0}'.format(c)
+                add_inventory_case(
+                    task_item, templates, inventory_name, flux, materials[c], 
+                    mass, density=den, specs=specs
+                )
+                output = task_item[0] / (inventory_name + '.out')
+                inventories[inv_key] = (output, mass)
+            output, ref_mass = inventories[inv_key]
+            index_output[(c, i, j, k)] = output
+            if mass != ref_mass:
+                scales[(c, i, j, k)] = mass / ref_mass
+
+    print('Unique spectra: {0} of {1} voxels'.format(
+        len(spectrum_cases), len(spatial_to_cell))
+    )
+    print('Unique inventories: {0} of {1} cell pieces'.format(
+        len(inventories), len(index_output))
+    )
+    return task_list, index_output, scales
+
+
+def select_important(masses, fluxes, fraction=None, threshold=None):
+    """Selects cell pieces, that dominate the expected gamma source.
+
+    Importance of the cell piece is estimated as the product of its mass and
+    total neutron flux in the voxel.
+
+    Parameters
+    ----------
+    masses : dict
+        A dictionary of cell masses in each voxel. c, i, j, k -> mass.
+    fluxes : numpy.ndarray
+        Total neutron flux in voxels. NX x NY x NZ.
+    fraction : float
+        Fraction of total importance to be covered by selected pieces. 
+        The most important pieces are selected first. Default: None.
+    threshold : float
+        Minimum importance of selected pieces relative to the maximum 
+        importance. If given, fraction is ignored. Default: None. Either 
+        fraction or threshold must be given, otherwise ValueError is raised.
+
+    Returns
+    -------
+    selected : set
+        Indices (c, i, j, k) of selected cell pieces.
+    """
+    if fraction is None and threshold is None:
+        raise ValueError('Either fraction or threshold must be specified.')
+    importance = {
+        (c, i, j, k): mass * fluxes[i, j, k] 
+        for (c, i, j, k), mass in masses.items()
+    }
+    if not importance:
+        return set()
+    if threshold is not None:
+        limit = threshold * max(importance.values())
+        return {k for k, v in importance.items() if v > 0 and v >= limit}
+    limit = fraction * sum(importance.values())
+    selected = set()
+    covered = 0
+    for index, value in sorted(importance.items(), key=lambda x: (-x[1], x[0])):
+        if covered >= limit:
+            break
+        selected.add(index)
+        covered += value
+    return selected
 
 
-def prepare_folder(path, name, ebins, spectrum):
+def prepare_condense(path, templates):
+    """Prepares folder for condensing of decay data.
+
+    Decay data is condensed once, and ARRAYX file is shared by all cases.
+
+    Parameters
+    ----------
+    path : Path
+        Path, where tasks must be created.
+    templates : TemplateSet
+        FISPACT input templates.
+
+    Returns
+    -------
+    folder : Path
+        Condense folder.
+    """
+    folder = path / 'condense'
+    folder.mkdir(exist_ok=True)
+    changed = update_file(folder / 'files', templates.fispact_files())
+    changed |= update_file(folder / 'condense.i', templates.fispact_condense())
+    if changed:
+        remove_outputs(folder)
+    return folder
+
+
+def prepare_folder(
+    path, templates, name, ebins, spectrum, specs=None, arb_flux=None
+):
     """Prepares folder for FISPACT case.
 
+    If the folder already exists, only changed files are rewritten. In this 
+    case all outputs of the folder are removed, because they are not valid
+    anymore.
+
     Parameters
     ----------
     path : Path
         Path, where tasks must be created.
+    templates : TemplateSet
+        FISPACT input templates.
     name : str
         Name of the particular case.
     ebins : array_like
         Neutron energy bin boundaries.
     spectrum : array_like
         Neutron group spectrum.
+    specs : dict
+        Specifications of inputs. If given, the case is added to specs. If
+        inputs are deferred, the folder is not created. Default: None.
+    arb_flux : str
+        Text of arb_flux file, if it is already rendered (see 
+        arbflux_texts). Default: None.
     
     Returns
     -------
@@ -304,48 +1248,382 @@ def prepare_folder(path, name, ebins, spectrum):
         folder_path, list of tasks to run.
     """
     folder = path / name
-    folder.mkdir()
+    if specs is not None:
+        specs['cases'][name] = (len(specs['spectra']), {})
+        specs['spectra'].append(np.array(spectrum, dtype=float))
+        if specs['deferred']:
+            return folder, ['collapse']
 
-    files = folder / 'files'
-    files.write_text(template.fispact_files())
-    collapse = folder / 'collapse.i'
-    collapse.write_text(template.fispact_collapse())
-    arb_flux = folder / 'arb_flux'
+    folder.mkdir(exist_ok=True)
 
-    ebins = ebins.copy()
-    ebins[0] = 1.e-11
-    arb_flux.write_text(template.create_arbflux_text(ebins, spectrum))
+    if arb_flux is None:
+        arb_flux = arbflux_texts(ebins, [spectrum])[0]
+    changed = update_file(folder / 'files', templates.fispact_files())
+    changed |= update_file(folder / 'collapse.i', templates.fispact_collapse())
+    changed |= update_file(folder / 'arb_flux', arb_flux)
+    if changed:
+        remove_outputs(folder)
 
     return folder, ['collapse']
 
 
-def add_inventory_case(task_item, name, flux, mat):
+def arbflux_texts(ebins, spectra):
+    """Renders arb_flux files for a set of spectra.
+
+    Parameters
+    ----------
+    ebins : array_like
+        Neutron energy bin boundaries. The lowest boundary is replaced by
+        1.e-11 MeV.
+    spectra : array_like
+        Neutron group spectra, one spectrum per row.
+
+    Returns
+    -------
+    texts : list
+        Texts of arb_flux files.
+    """
+    ebins = np.array(ebins, dtype=float)
+    ebins[0] = 1.e-11
+    return template.create_arbflux_texts(ebins, spectra)
+
+
+def add_inventory_case(
+    task_item, templates, name, flux, material, mass, density=1.0, specs=None
+):
     """Adds new task case to task_item.
 
+    If the inventory file is changed, its outputs are removed.
+
     Parameters
     ----------
     task_item : tuple
         folder path, case list.
+    templates : TemplateSet
+        FISPACT input templates.
     name : str
         Inventory file name.
     flux : float
         Nominal flux value.
-    mat : str
-        Material description.
+    material : mckit.Composition
+        Material.
+    mass : float
+        Mass of the material.
+    density : float
+        Density of the material. Default: 1.0 g/cc.
+    specs : dict
+        Specifications of inputs. If given, the inventory is added to specs.
+        If inputs are deferred, inventory file is not written. 
+        Default: None.
     """
     folder, cases = task_item
-    inventory = folder / (name + '.i')
-    inventory.write_text(template.fispact_inventory(flux, mat))
     cases.append(name)
+    if specs is not None:
+        mat_index = specs['mat_index'].setdefault(
+            material, len(specs['mat_index'])
+        )
+        specs['cases'][folder.name][1][name] = (flux, mat_index, mass, density)
+        if specs['deferred']:
+            return
+    mat = material_description(material, mass, density=density)
+    inventory = folder / (name + '.i')
+    if update_file(inventory, templates.fispact_inventory(flux, mat)):
+        remove_outputs(folder, name)
+
+
+def new_specs(ebins, templates, deferred=False):
+    """Creates empty specifications of inputs.
+
+    Specifications are compact description of all cases. They allow to 
+    rewrite inventory inputs without recalculation of the task (see
+    change_scenario). With deferred inputs case folders and input files are
+    not created by prepare, and the input files are written by 
+    write_case_inputs just before FISPACT run.
+
+    Parameters
+    ----------
+    ebins : array_like
+        Neutron energy bin boundaries.
+    templates : TemplateSet
+        FISPACT input templates.
+    deferred : bool
+        Whether input files are deferred. Default: False.
+
+    Returns
+    -------
+    specs : dict
+        Specifications: 'deferred', 'ebins', 'templates',
+        'spectra' - spectra of cases, 'materials' - list of materials and
+        'cases' - case_name -> (spectrum_index, inventories), where
+        inventories is a dictionary 
+        inventory_name -> (flux, material_index, mass, density).
+    """
+    ebins = np.array(ebins, dtype=float)
+    ebins[0] = 1.e-11
+    return {
+        'deferred': deferred, 'ebins': ebins, 'templates': templates, 
+        'spectra': [], 'mat_index': {}, 'cases': {}
+    }
+
+
+def finish_specs(specs):
+    """Converts specifications to compact form after all cases are added.
+
+    Parameters
+    ----------
+    specs : dict
+        Specifications of deferred inputs.
+    """
+    mat_index = specs.pop('mat_index')
+    materials = [None] * len(mat_index)
+    for mat, index in mat_index.items():
+        materials[index] = mat
+    specs['materials'] = materials
+    specs['spectra'] = np.array(specs['spectra'])
+
+
+def write_case_inputs(folder, cases, specs):
+    """Writes input files of deferred FISPACT case.
+
+    Parameters
+    ----------
+    folder : Path
+        Case folder.
+    cases : list
+        Names of inputs to be run.
+    specs : dict
+        Specifications of deferred inputs.
+
+    Returns
+    -------
+    filenames : list
+        Names of written files.
+    """
+    spectrum_index, inventories = specs['cases'][folder.name]
+    folder.mkdir(exist_ok=True)
+    templates = specs['templates']
+    texts = {'files': templates.fispact_files()}
+    if 'collapse' in cases:
+        texts['collapse.i'] = templates.fispact_collapse()
+        texts['arb_flux'] = template.create_arbflux_text(
+            specs['ebins'], specs['spectra'][spectrum_index]
+        )
+    for name in cases:
+        if name not in inventories:
+            continue
+        flux, mat_index, mass, density = inventories[name]
+        mat = material_description(
+            specs['materials'][mat_index], mass, density=density
+        )
+        texts[name + '.i'] = templates.fispact_inventory(flux, mat)
+    filenames = []
+    for name, text in texts.items():
+        filename = folder / name
+        filename.write_text(text)
+        filenames.append(filename)
+    return filenames
+
+
+def change_scenario(path, specs, templates):
+    """Replaces irradiation scenario of the prepared task.
+
+    Case folders and collapsed cross sections are kept. Inventory inputs 
+    are rewritten with new templates, and outputs of inventories are 
+    removed, so only inventories are calculated by the next run.
+
+    Parameters
+    ----------
+    path : Path
+        Path, where tasks are created.
+    specs : dict
+        Specifications of inputs. Templates of specs are replaced.
+    templates : TemplateSet
+        New FISPACT input templates.
+
+    Returns
+    -------
+    changed : int
+        The number of changed inventories.
+    """
+    if specs['templates'] == templates:
+        return 0
+    specs['templates'] = templates
+    changed = 0
+    for name, (spectrum_index, inventories) in specs['cases'].items():
+        folder = path / name
+        for inv_name, (flux, mat_index, mass, density) in inventories.items():
+            if specs['deferred']:
+                if folder.exists():
+                    remove_outputs(folder, inv_name)
+                changed += 1
+                continue
+            mat = material_description(
+                specs['materials'][mat_index], mass, density=density
+            )
+            text = templates.fispact_inventory(flux, mat)
+            if update_file(folder / (inv_name + '.i'), text):
+                remove_outputs(folder, inv_name)
+                changed += 1
+    return changed
+
+
+def inventory_sizes(specs):
+    """Gets sizes of inventories - the number of nuclides in materials.
+
+    Parameters
+    ----------
+    specs : dict
+        Specifications of inputs.
+
+    Returns
+    -------
+    sizes : dict
+        Sizes of inventories. (case_name, inventory_name) -> size.
+    """
+    nuclides = [len(expanded_material(m)[0]) for m in specs['materials']]
+    return {
+        (name, inv_name): nuclides[inv_spec[1]]
+        for name, (spectrum_index, inventories) in specs['cases'].items()
+        for inv_name, inv_spec in inventories.items()
+    }
+
+
+def remove_changed_outputs(path, specs, previous):
+    """Removes outputs of deferred cases, whose specifications are changed.
+
+    Parameters
+    ----------
+    path : Path
+        Path, where tasks are created.
+    specs : dict
+        New specifications of deferred inputs.
+    previous : dict
+        Specifications of the previous prepare run. If None, outputs of all
+        existing cases are removed.
+    """
+    same_common = previous is not None and \
+        previous['templates'] == specs['templates'] and \
+        np.array_equal(previous['ebins'], specs['ebins'])
+    for name, (spectrum_index, inventories) in specs['cases'].items():
+        folder = path / name
+        if not folder.exists():
+            continue
+        old = previous['cases'].get(name, None) if same_common else None
+        if old is None or not np.array_equal(
+            previous['spectra'][old[0]], specs['spectra'][spectrum_index]
+        ):
+            remove_outputs(folder)
+            continue
+        for inv_name, (flux, mat_index, mass, density) in inventories.items():
+            old_inv = old[1].get(inv_name, None)
+            if old_inv is None or old_inv[0] != flux or \
+                    old_inv[2] != mass or old_inv[3] != density or \
+                    previous['materials'][old_inv[1]] != \
+                    specs['materials'][mat_index]:
+                remove_outputs(folder, inv_name)
+
+
+def update_file(filename, text):
+    """Writes text to the file, if the file's content is different.
+
+    Parameters
+    ----------
+    filename : Path
+        File name.
+    text : str
+        Text to be written.
+
+    Returns
+    -------
+    changed : bool
+        True, if the file was written.
+    """
+    if filename.exists() and filename.read_text() == text:
+        return False
+    filename.write_text(text)
+    return True
+
+
+def remove_outputs(folder, name=None):
+    """Removes FISPACT outputs from the case folder.
+
+    Parameters
+    ----------
+    folder : Path
+        Case folder.
+    name : str
+        Name of inventory, whose outputs must be removed. If None, all 
+        outputs of the folder are removed. Default: None.
+    """
+    pattern = '*' if name is None else name + '.*'
+    for filename in folder.glob(pattern):
+        if filename.name in _INPUT_FILES or filename.suffix == '.i':
+            continue
+        filename.unlink()
+
+
+def remove_stale_tasks(path, task_list):
+    """Removes case folders and inventories that are not in the task list.
+
+    Only case-* folders are considered stale, other entries of the path 
+    (configuration, state files, condense folder, etc.) are kept.
+
+    Parameters
+    ----------
+    path : Path
+        Path, where tasks are created.
+    task_list : list
+        List of tasks.
+    """
+    tasks = {folder.name: set(cases) for folder, cases in task_list}
+    for folder in path.iterdir():
+        if folder.name not in tasks:
+            if folder.is_dir() and folder.name.startswith('case-'):
+                shutil.rmtree(folder)
+            continue
+        for filename in folder.glob('inventory_*'):
+            if filename.name.split('.')[0] not in tasks[folder.name]:
+                filename.unlink()
+
+
+def pending_tasks(task_list):
+    """Finds tasks, which have no output yet.
+
+    Parameters
+    ----------
+    task_list : list
+        List of tasks.
+
+    Returns
+    -------
+    pending : list
+        List of tasks to be run. If collapse of the case must be run (its 
+        output or COLLAPX file is missing), all inventories of the case are
+        included.
+    """
+    pending = []
+    for folder, cases in task_list:
+        if not (folder / 'collapse.out').exists() or \
+                not (folder / 'COLLAPX').exists():
+            pending.append((folder, list(cases)))
+            continue
+        names = [c for c in cases if not (folder / (c + '.out')).exists()]
+        if names:
+            pending.append((folder, names))
+    return pending
 
 
-def create_simple_tasks(path, ebins, materials, flux, mass):
+def create_simple_tasks(
+    path, templates, ebins, materials, flux, mass, specs=None
+):
     """Creates fispact tasks for superposition method.
 
     Parameters
     ----------
     path : Path
         Path, where tasks must be created.
+    templates : TemplateSet
+        FISPACT input templates.
     ebins : array_like
         Energy bins.
     materials : dict
@@ -354,6 +1632,8 @@ def create_simple_tasks(path, ebins, materials, flux, mass):
         Value of flux, assumed for all calculations.
     mass : float
         Value of mass, assumed for all calculations.
+    specs : dict
+        Specifications of inputs. Default: None.
 
     Returns
     -------
@@ -363,22 +1643,62 @@ def create_simple_tasks(path, ebins, materials, flux, mass):
     index_output : dict
         A dictionary (n_erg_bin, mat_name) -> output_file_name.
     """
-    task_list = []
-    index_output = {}
     nf = len(ebins) - 1
-    for i in range(nf):
-        spectrum = np.zeros(nf)
-        spectrum[i] = flux
+    return create_spectrum_tasks(
+        path, templates, ebins, np.eye(nf) * flux, materials, mass, specs=specs
+    )
+
+
+def create_spectrum_tasks(
+    path, templates, ebins, spectra, materials, mass, specs=None
+):
+    """Creates fispact tasks for the set of neutron spectra.
+
+    Every spectrum gets its own case folder, and every material is 
+    irradiated by every spectrum.
+
+    Parameters
+    ----------
+    path : Path
+        Path, where tasks must be created.
+    templates : TemplateSet
+        FISPACT input templates.
+    ebins : array_like
+        Energy bins.
+    spectra : numpy.ndarray
+        Neutron spectra, one spectrum per row.
+    materials : dict
+        A dictionary of materials. material_name -> material.
+    mass : float
+        Value of mass, assumed for all calculations.
+    specs : dict
+        Specifications of inputs. Default: None.
 
+    Returns
+    -------
+    task_list : list
+        List of tasks to be executed. List of tuples:
+        (case_folder_name, [inventory_names])
+    index_output : dict
+        A dictionary (n_spectrum, mat_name) -> output_file_name.
+    """
+    task_list = []
+    index_output = {}
+    texts = None
+    if specs is None or not specs['deferred']:
+        texts = arbflux_texts(ebins, spectra)
+    for i, spectrum in enumerate(spectra):
         task_item = prepare_folder(
-            path, 'case-{0}'.format(i), ebins, spectrum
+            path, templates, 'case-{0}'.format(i), ebins, spectrum, specs=specs,
+            arb_flux=texts[i] if texts else None
         )
+        flux = np.sum(spectrum)
 
         for name, mat in materials.items():
-            mat_text = material_description(mat, mass)
             inventory_name = 'inventory_{0}'.format(name)
             add_inventory_case(
-                task_item, inventory_name, flux, mat_text
+                task_item, templates, inventory_name, flux, mat, mass, 
+                specs=specs
             )
             index_output[(i, name)] = task_item[0] / (inventory_name + '.out')
         task_list.append(task_item)
@@ -386,6 +1706,57 @@ def create_simple_tasks(path, ebins, materials, flux, mass):
     return task_list, index_output
 
 
+def cluster_voxel_spectra(fdata, indices, n_clusters=None, tolerance=None):
+    """Clusters neutron spectra of voxels, that contain materials.
+
+    If no voxel with materials has nonzero neutron flux, there is nothing to
+    cluster and ValueError is raised.
+
+    Parameters
+    ----------
+    fdata : numpy.ndarray
+        Neutron flux data. G x NX x NY x NZ.
+    indices : iterable
+        Indices (c, i, j, k) of material-containing cells in voxels.
+    n_clusters : int
+        The number of clusters. Default: None.
+    tolerance : float
+        Maximum clustering error allowed. Default: None.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Cluster labels of voxels. NX x NY x NZ. Voxels without flux or 
+        materials get label 0.
+    centroids : numpy.ndarray
+        Normalized spectra of clusters, one spectrum per row.
+    stats : dict
+        Clustering error statistics: mean, flux-weighted mean and max.
+    """
+    fluxes = np.sum(fdata, axis=0)
+    voxels = sorted({(i, j, k) for c, i, j, k in indices})
+    voxels = [v for v in voxels if fluxes[v] > 0]
+    if not voxels:
+        raise ValueError(
+            'Neutron flux is zero in all voxels with materials: '
+            'there are no spectra to cluster.'
+        )
+    labels = np.zeros(fluxes.shape, dtype=int)
+    stats = {'mean': 0.0, 'weighted': 0.0, 'max': 0.0}
+
+    index = tuple(np.array(voxels).T)
+    flux = fluxes[index]
+    spectra = fdata[(slice(None),) + index].T / flux[:, np.newaxis]
+    v_labels, centroids, errors = cluster.cluster_spectra(
+        spectra, n_clusters=n_clusters, tolerance=tolerance
+    )
+    labels[index] = v_labels
+    stats['mean'] = np.mean(errors)
+    stats['weighted'] = np.sum(errors * flux) / np.sum(flux)
+    stats['max'] = np.max(errors)
+    return labels, centroids, stats
+
+
 def material_description(material, mass, density=1.0):
     """Creates FISPACT material description.
 
@@ -403,13 +1774,40 @@ def material_description(material, mass, density=1.0):
     mat_text : str
         Fispact material description.
     """
-    lines = deque()
-    expanded_mat = material.expand()
-    tot_atoms = mass / expanded_mat.molar_mass * AVOGADRO
-    for elem, conc in expanded_mat:
-        elem_name = elem.fispact_repr()
-        atom_qty = tot_atoms * conc
-        lines.append('  {0} {1:.4e}'.format(elem_name, atom_qty))
-    lines.appendleft('FUEL {0}'.format(len(lines)))
-    lines.appendleft('DENSITY {0:.4e}'.format(density))
+    names, conc, molar_mass = expanded_material(material)
+    atom_qty = mass / molar_mass * AVOGADRO * conc
+    lines = ['DENSITY {0:.4e}'.format(density), 'FUEL {0}'.format(len(names))]
+    lines.extend(
+        '  {0} {1:.4e}'.format(name, qty) for name, qty in zip(names, atom_qty)
+    )
     return '\n'.join(lines)
+
+
+@lru_cache(maxsize=None)
+def expanded_material(material):
+    """Gets expanded composition of the material.
+
+    The result is cached, because the same composition is used for many
+    cell pieces, which differ only in mass.
+
+    Parameters
+    ----------
+    material : mckit.Composition
+        Material.
+
+    Returns
+    -------
+    names : tuple
+        FISPACT names of nuclides.
+    conc : numpy.ndarray
+        Atomic fractions of nuclides.
+    molar_mass : float
+        Molar mass of the material.
+    """
+    expanded_mat = material.expand()
+    names = []
+    conc = []
+    for elem, c in expanded_mat:
+        names.append(elem.fispact_repr())
+        conc.append(c)
+    return tuple(names), np.array(conc), expanded_mat.molar_mass
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import json
+from collections import defaultdict
+
+import numpy as np
+
+
+METRICS_PATTERN = 'metrics*.jsonl'
+
+
+def load_metrics(path, all_runs=False):
+    """Loads metrics of FISPACT runs (see run.MetricsLog).
+
+    All metrics files of the task folder are read: metrics.jsonl of the run
+    stage and metrics-<worker>.jsonl files of workers. The last run is the
+    run, that started last, together with runs of other files (workers), 
+    which overlap with it in time.
+
+    Parameters
+    ----------
+    path : Path
+        Task folder.
+    all_runs : bool
+        Whether to load all runs. Default: False - only the last run is 
+        loaded.
+
+    Returns
+    -------
+    runs : list
+        Descriptions of runs: 'run' - start time, 'threads', 'host', 'end' -
+        end time of the last FISPACT run.
+    records : list
+        Records of FISPACT runs.
+    """
+    segments = []
+    for filename in sorted(path.glob(METRICS_PATTERN)):
+        current = None
+        with open(filename) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                if 'run' in item:
+                    current = (dict(item, end=item['run']), [])
+                    segments.append(current)
+                elif current is not None:
+                    current[1].append(item)
+                    current[0]['end'] = max(
+                        current[0]['end'], item['start'] + item['wall']
+                    )
+    if not all_runs and segments:
+        begin = max(run['run'] for run, _ in segments)
+        changed = True
+        while changed:
+            changed = False
+            for run, _ in segments:
+                if run['end'] >= begin and run['run'] < begin:
+                    begin = run['run']
+                    changed = True
+        segments = [s for s in segments if s[0]['end'] >= begin]
+    runs = [run for run, _ in segments]
+    records = [r for _, run_records in segments for r in run_records]
+    return runs, records
+
+
+def max_threads(runs):
+    """Gets maximum number of threads of runs going at the same time.
+
+    Parameters
+    ----------
+    runs : list
+        Descriptions of runs (see load_metrics). Runs without end time are
+        considered not finished.
+
+    Returns
+    -------
+    threads : int
+        Maximum number of concurrent threads.
+    """
+    events = []
+    for r in runs:
+        threads = r.get('threads', 1)
+        events.append((r['run'], threads))
+        events.append((r.get('end', np.inf), -threads))
+    current = 0
+    result = 0
+    for _, delta in sorted(events):
+        current += delta
+        result = max(result, current)
+    return result
+
+
+def summarize(runs, records, top=10, bins=20):
+    """Summarizes metrics of FISPACT runs.
+
+    Parameters
+    ----------
+    runs : list
+        Descriptions of runs.
+    records : list
+        Records of FISPACT runs.
+    top : int
+        The number of the slowest cases and inputs to be reported.
+        Default: 10.
+    bins : int
+        The number of time intervals for utilization timeline. Default: 20.
+
+    Returns
+    -------
+    summary : dict
+        Summary: 'inputs' - the number of FISPACT runs, 'status' - the
+        number of runs by status, 'span' - elapsed time, 'threads' - the
+        maximum number of concurrent inputs, 'throughput' - successful inputs per
+        hour, 'kinds' - wall and CPU time of collapse and inventory runs
+        (CPU time is None if it is recorded for none of the runs, e.g. for
+        asyncio backend),
+        'cases' - the slowest cases, 'slowest' - the slowest inputs,
+        'peak_rss' - maximum peak RSS or None, if it is not recorded,
+        'timeline' - list of (time from start, busy slots, utilization).
+    """
+    summary = {'inputs': len(records), 'status': defaultdict(int)}
+    if not records:
+        return summary
+    starts = np.array([r['start'] for r in records], dtype=float)
+    walls = np.array([r['wall'] for r in records], dtype=float)
+    ends = starts + walls
+    begin = starts.min()
+    span = max(ends.max() - begin, 1.e-9)
+    threads = max_threads(runs) or 1
+
+    kinds = {
+        kind: {'count': 0, 'wall': 0.0, 'cpu': None}
+        for kind in ('collapse', 'inventory')
+    }
+    cases = defaultdict(lambda: {'wall': 0.0, 'inputs': 0})
+    for r in records:
+        summary['status'][r['status']] += 1
+        kind = kinds['collapse' if r['input'] == 'collapse' else 'inventory']
+        kind['count'] += 1
+        kind['wall'] += r['wall']
+        if r.get('cpu') is not None:
+            kind['cpu'] = (kind['cpu'] or 0.0) + r['cpu']
+        cases[r['case']]['wall'] += r['wall']
+        cases[r['case']]['inputs'] += 1
+
+    summary['status'] = dict(summary['status'])
+    summary['span'] = span
+    summary['threads'] = threads
+    summary['throughput'] = summary['status'].get('ok', 0) / span * 3600
+    summary['kinds'] = kinds
+    summary['cases'] = sorted(
+        ((name, c['wall'], c['inputs']) for name, c in cases.items()),
+        key=lambda c: -c[1]
+    )[:top]
+    summary['slowest'] = sorted(records, key=lambda r: -r['wall'])[:top]
+    rss = [r['rss'] for r in records if r.get('rss') is not None]
+    summary['peak_rss'] = max(rss) if rss else None
+
+    edges = np.linspace(begin, begin + span, bins + 1)
+    overlap = np.minimum(ends[:, np.newaxis], edges[1:]) - \
+        np.maximum(starts[:, np.newaxis], edges[:-1])
+    busy = np.sum(np.maximum(overlap, 0), axis=0) / (span / bins)
+    summary['timeline'] = [
+        (t - begin, b, b / threads) for t, b in zip(edges[:-1], busy)
+    ]
+    return summary
+
+
+def format_report(summary):
+    """Formats summary of FISPACT runs.
+
+    Parameters
+    ----------
+    summary : dict
+        Summary produced by summarize function.
+
+    Returns
+    -------
+    text : str
+        Report text.
+    """
+    if not summary['inputs']:
+        return 'No FISPACT runs are recorded.'
+    lines = [
+        'FISPACT runs:  {0}'.format(summary['inputs']),
+        'Status:        {0}'.format(', '.join(
+            '{0} {1}'.format(k, v) for k, v in sorted(summary['status'].items())
+        )),
+        'Elapsed:       {0:.1f} s'.format(summary['span']),
+        'Threads:       {0}'.format(summary['threads']),
+        'Throughput:    {0:.1f} inputs/hour'.format(summary['throughput']),
+    ]
+    if summary['peak_rss'] is not None:
+        lines.append('Peak RSS:      {0:.1f} MB'.format(
+            summary['peak_rss'] / 1024)
+        )
+    else:
+        lines.append('Peak RSS:      n/a')
+    lines.append('')
+    lines.append('{0:<10} {1:>8} {2:>12} {3:>12} {4:>10}'.format(
+        'Kind', 'Runs', 'Wall, s', 'CPU, s', 'Wall, %')
+    )
+    total = sum(k['wall'] for k in summary['kinds'].values()) or 1.0
+    for name, kind in summary['kinds'].items():
+        cpu = 'n/a' if kind['cpu'] is None else '{0:.1f}'.format(kind['cpu'])
+        lines.append('{0:<10} {1:>8} {2:>12.1f} {3:>12} {4:>10.1f}'.format(
+            name, kind['count'], kind['wall'], cpu,
+            kind['wall'] / total * 100
+        ))
+    lines.append('')
+    lines.append('Slowest cases:')
+    for name, wall, inputs in summary['cases']:
+        lines.append('  {0:<20} {1:>10.1f} s  {2} inputs'.format(
+            name, wall, inputs
+        ))
+    lines.append('')
+    lines.append('Slowest inputs:')
+    for r in summary['slowest']:
+        rss = '' if r.get('rss') is None else \
+            '  {0:.1f} MB'.format(r['rss'] / 1024)
+        lines.append('  {0:<20} {1:<15} {2:>10.1f} s  {3}{4}'.format(
+            r['case'], r['input'], r['wall'], r['status'], rss
+        ))
+    lines.append('')
+    lines.append('Utilization:')
+    for t, busy, util in summary['timeline']:
+        bar = '#' * int(round(min(util, 1) * 40))
+        lines.append('  {0:>10.1f} s {1:>8.2f} busy  {2:<40} {3:>5.1f} %'
+                     .format(t, busy, bar, util * 100))
+    return '\n'.join(lines)
@@ -1,18 +1,41 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import contextlib
+import heapq
+import itertools
+import json
+import os
 import re
+import shutil
+import socket
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from click import progressbar
+
+
+_OUTPUT_SUFFIXES = ('.out', '.log', '.stdout', '.done')
+_RESULT_SUFFIXES = ('.out', '.done')
+_INTERMEDIATES = ('COLLAPX', 'ARRAYX')
 
 
 class FispactError(Exception):
     pass
 
 
-def run_fispact(input_file, files='files', cwd=None, verbose=False):
+def run_fispact(input_file, files='files', cwd=None, verbose=False, usage=None):
     """Runs FISPACT code.
 
-    If run ends with errors, then FispactError exception is raised.
+    FISPACT output is streamed line by line to <input_file>.stdout file in
+    the working directory and is checked for fatal errors as it arrives.
+    If run ends with errors, then FispactError exception is raised. After 
+    normal end of the run completion marker <input_file>.done is created 
+    (see is_completed).
 
     Parameters
     ----------
@@ -23,20 +46,115 @@ def run_fispact(input_file, files='files', cwd=None, verbose=False):
     cwd : Path-like or str
         Working directory. Default: None.
     verbose : bool
-        Whether to print calculation status to stdout.
+        Whether to print FISPACT output to stdout.
+    usage : dict
+        If given, resource usage of FISPACT process is stored in it: 'cpu' -
+        CPU time in seconds, 'rss' - peak resident set size in kB. It is
+        not available on Windows. Default: None.
+    """
+    args = ['fispact', input_file, files]
+    marker = completion_marker(cwd, input_file)
+    if marker.exists():
+        marker.unlink()
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        encoding='utf-8', errors='replace', cwd=cwd
+    )
+    error = None
+    with proc.stdout, \
+            open(os.path.join(cwd or '', input_file + '.stdout'), 'w') as log:
+        for line in proc.stdout:
+            log.write(line)
+            if verbose:
+                print(line, end='')
+            if error is None:
+                try:
+                    check_fispact_status(line)
+                except FispactError as e:
+                    error = e
+    if hasattr(os, 'wait4'):
+        _, code, rusage = os.wait4(proc.pid, 0)
+        if os.WIFEXITED(code):
+            proc.returncode = os.WEXITSTATUS(code)
+        else:
+            proc.returncode = -os.WTERMSIG(code)
+        if usage is not None:
+            usage['cpu'] = rusage.ru_utime + rusage.ru_stime
+            usage['rss'] = rusage.ru_maxrss
+    else:
+        proc.wait()
+    if error is not None:
+        raise error
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    marker.touch()
+
+
+async def run_fispact_async(input_file, files='files', cwd=None, verbose=False):
+    """Runs FISPACT code as asyncio subprocess.
+
+    FISPACT output is streamed line by line to <input_file>.stdout file in
+    the working directory and is checked for fatal errors as it arrives.
+    If run ends with errors, then FispactError exception is raised. After 
+    normal end of the run completion marker <input_file>.done is created.
+    Unlike run_fispact, resource usage (CPU time and peak RSS) of FISPACT
+    process is not collected: asyncio child watcher reaps the process.
+
+    Parameters
+    ----------
+    input_file : str
+        The name of input file.
+    files : str
+        The name of FISPACT files file. Default: 'files'.
+    cwd : Path-like or str
+        Working directory. Default: None.
+    verbose : bool
+        Whether to print FISPACT output to stdout.
+    """
+    args = ['fispact', input_file, files]
+    marker = completion_marker(cwd, input_file)
+    if marker.exists():
+        marker.unlink()
+    proc = await asyncio.create_subprocess_exec(
+        *args, cwd=cwd, stdout=asyncio.subprocess.PIPE, 
+        stderr=asyncio.subprocess.STDOUT
+    )
+    error = None
+    with open(os.path.join(cwd or '', input_file + '.stdout'), 'w') as log:
+        async for raw in proc.stdout:
+            line = raw.decode('utf-8', errors='replace')
+            log.write(line)
+            if verbose:
+                print(line, end='')
+            if error is None:
+                try:
+                    check_fispact_status(line)
+                except FispactError as e:
+                    error = e
+    code = await proc.wait()
+    if error is not None:
+        raise error
+    if code:
+        raise subprocess.CalledProcessError(code, args)
+    marker.touch()
+
+
+def completion_marker(cwd, input_file):
+    """Gets the name of the file, that marks normal end of FISPACT run.
+
+    Parameters
+    ----------
+    cwd : Path-like or str
+        Working directory.
+    input_file : str
+        The name of input file.
 
     Returns
     -------
-    status : str
-        Run status message.
+    marker : Path
+        Name of completion marker.
     """
-    status = subprocess.check_output(
-        ['fispact', input_file, files], encoding='utf-8', cwd=cwd
-    )
-    if verbose:
-        print(status)
-    check_fispact_status(status)
-    return status
+    return Path(cwd or '') / (input_file + '.done')
 
 
 def check_fispact_status(text):
@@ -52,23 +170,545 @@ def check_fispact_status(text):
         raise FispactError(match.group(0))
 
 
-def run_tasks(task_list, verbose=False, threads=1):
+def run_tasks(
+        task_list, verbose=False, threads=1, render=None, condense=None, 
+        state=None, retries=0, fail_fast=False, sizes=None, 
+        backend='threads', scratch=None, on_case=None, metrics=None
+    ):
     """Runs FISPACT calculations.
 
+    Inputs are scheduled by Scheduler: the most expensive work is started
+    first, and inventories of the case are run in parallel after its 
+    collapse. Failure of an inventory does not stop other inventories of 
+    the case. If collapse of the case fails, its inventories are skipped.
+
     Parameters
     ----------
     task_list : list
         List of tasks.
     verbose : bool
-        Output verbosity. Default: True.
+        Output verbosity. If True, run progress is shown. Default: False.
     threads : int
-        The number of threads to execute. Default: 1.
+        The number of inputs to be run concurrently. Default: 1.
+    render : callable
+        Function render(cwd, tasks), that writes input files of the case 
+        just before the run and returns the list of written files. Written
+        files are removed after successful run. Default: None - input files
+        are already in case folders.
+    condense : Path
+        Folder, where decay data is condensed. It is run once before all 
+        cases, if it has no output yet, and its ARRAYX file is shared with 
+        cases. Default: None - every case condenses decay data itself.
+    state : RunState
+        Run state, where results of cases and run times of inputs are 
+        recorded. Run times of previous runs are used to estimate costs.
+        Default: None.
+    retries : int
+        The number of retries of transient failures (crash of FISPACT 
+        process). FISPACT fatal errors are not retried. Default: 0.
+    fail_fast : bool
+        If True, outstanding work is cancelled on the first failure. 
+        Default: False.
+    sizes : dict
+        Relative sizes of inventories (case_name, input) -> size, e.g. the 
+        number of nuclides in the material. Default: None.
+    backend : str
+        How FISPACT processes are driven: 'threads' - by worker threads, 
+        'asyncio' - by asyncio event loop, FISPACT output is streamed to
+        <input>.stdout files. Default: 'threads'.
+    scratch : ScratchArea
+        Local folder, where cases are run. Only outputs are copied back to
+        case folders. Default: None - cases are run in their folders.
+    on_case : callable
+        Function on_case(cwd, failures), that is called, when all inputs of
+        the case are finished and its outputs are in the case folder. 
+        Default: None.
+    metrics : MetricsLog
+        Log, where resource usage of every FISPACT run is recorded.
+        Default: None.
+
+    Returns
+    -------
+    failures : list
+        List of failures (see run_case). If condensing of decay data fails,
+        no case is run, and the only failure is the one of condense.
+    """
+    if condense is not None and not is_completed(condense, 'condense'):
+        failure = run_input(
+            condense, 'condense', retries=retries, metrics=metrics
+        )
+        if failure is not None:
+            return [failure]
+    timings = state.timings() if state is not None else {}
+    costs = estimate_costs(task_list, timings=timings, sizes=sizes)
+    scheduler = Scheduler(
+        task_list, costs, render=render, condense=condense, state=state,
+        retries=retries, fail_fast=fail_fast, scratch=scratch, 
+        on_case=on_case, metrics=metrics
+    )
+    if backend == 'asyncio':
+        return scheduler.run_async(threads, progress=verbose)
+    elif backend == 'threads':
+        return scheduler.run(threads, progress=verbose)
+    raise ValueError('Unknown backend: {0}'.format(backend))
+
+
+def run_worker(
+        task_list, queue, threads=1, render=None, condense=None, retries=0, 
+        sizes=None, poll=5, scratch=None, metrics=None
+    ):
+    """Runs cases claimed from the work queue shared by several workers.
+
+    Cases are claimed in order of decreasing estimated cost. Cases, which 
+    are finished or claimed by other workers, are skipped. Cases marked as
+    done, whose outputs are not completed (e.g. removed or stale), are 
+    claimed again. Decay data is condensed by the first worker, other 
+    workers wait for it.
+
+    Parameters
+    ----------
+    task_list : list
+        List of tasks.
+    queue : WorkQueue
+        Work queue.
+    threads : int
+        The number of cases to be run concurrently by this worker. 
+        Default: 1.
+    render : callable
+        Function, that writes input files of the case. Default: None.
+    condense : Path
+        Folder, where decay data is condensed. Default: None.
+    retries : int
+        The number of retries of transient failures. Default: 0.
+    sizes : dict
+        Relative sizes of inventories. Default: None.
+    poll : float
+        Period in seconds of checking, whether condense is completed by 
+        other worker. Default: 5.
+    scratch : ScratchArea
+        Local folder, where cases are run. Default: None.
+    metrics : MetricsLog
+        Log of resource usage. Default: None.
+
+    Returns
+    -------
+    failures : list
+        List of failures of cases run by this worker (see run_case).
+    """
+    if condense is not None:
+        while not is_completed(condense, 'condense'):
+            status = queue.status('condense')
+            if status == 'failed':
+                raise FispactError('condense failed')
+            if status == 'done':
+                queue.reopen('condense')
+            if queue.claim('condense'):
+                try:
+                    run_fispact('condense', cwd=condense)
+                except Exception as e:
+                    failure = failure_item(condense, 'condense', e, 'error')
+                    queue.release('condense', [failure])
+                    raise
+                queue.release('condense')
+            else:
+                time.sleep(poll)
+    costs = estimate_costs(task_list, sizes=sizes)
+    ordered = sorted(
+        task_list, key=lambda t: -sum(costs[(t[0].name, n)] for n in t[1])
+    )
+    cases = iter(ordered)
+    lock = threading.Lock()
+    failures = []
+
+    def work():
+        while True:
+            with lock:
+                task_case = next(cases, None)
+            if task_case is None:
+                return
+            name = task_case[0].name
+            if queue.status(name) == 'done' and not all(
+                is_completed(task_case[0], t) for t in task_case[1]
+            ):
+                queue.reopen(name)
+            if not queue.claim(name):
+                continue
+            try:
+                case_failures = run_case(
+                    task_case, render=render, condense=condense, 
+                    retries=retries, scratch=scratch, metrics=metrics
+                )
+            except Exception as e:
+                case_failures = [
+                    failure_item(task_case[0], t, e, 'error') 
+                    for t in task_case[1]
+                ]
+            queue.release(name, case_failures)
+            with lock:
+                failures.extend(case_failures)
+
+    workers = [threading.Thread(target=work) for _ in range(max(threads, 1))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return failures
+
+
+def estimate_costs(task_list, timings=None, sizes=None):
+    """Estimates run time of FISPACT inputs.
+
+    Measured run time of the input is used, if it is known from previous
+    runs. Otherwise the cost is the mean measured time of inputs of the 
+    same kind (collapse or inventory), and the cost of inventory is scaled
+    by its relative size.
+
+    Parameters
+    ----------
+    task_list : list
+        List of tasks.
+    timings : dict
+        Measured run times. (case_name, input) -> seconds. Default: None.
+    sizes : dict
+        Relative sizes of inventories. (case_name, input) -> size.
+        Default: None.
+
+    Returns
+    -------
+    costs : dict
+        Estimated costs. (case_name, input) -> cost.
     """
-    with ThreadPoolExecutor(max_workers=threads) as pool:
-        pool.map(run_case, task_list)
+    timings = timings or {}
+    sizes = sizes or {}
+    total = defaultdict(float)
+    count = defaultdict(int)
+    for (case, name), t in timings.items():
+        kind = 'collapse' if name == 'collapse' else 'inventory'
+        total[kind] += t
+        count[kind] += 1
+    mean_time = {
+        kind: total[kind] / count[kind] if count[kind] else 1.0 
+        for kind in ('collapse', 'inventory')
+    }
+    mean_size = sum(sizes.values()) / len(sizes) if sizes else 1.0
+    costs = {}
+    for cwd, tasks in task_list:
+        for name in tasks:
+            key = (cwd.name, name)
+            if key in timings:
+                costs[key] = timings[key]
+            elif name == 'collapse':
+                costs[key] = mean_time['collapse']
+            else:
+                costs[key] = mean_time['inventory'] * \
+                    sizes.get(key, mean_size) / mean_size
+    return costs
+
+
+class Scheduler:
+    """Cost-aware scheduler of FISPACT inputs.
+
+    Ready jobs of started cases are taken by workers first, in order of 
+    decreasing cost. A new case is started only when there is no such job,
+    and cases with more work (total cost of all their inputs) are started
+    earlier. Collapse of the case is run first. After it is completed, 
+    inventories of the case become separate jobs, which are run by any 
+    free worker. So large cases do not leave most workers idle at the end 
+    of the run, and the number of cases in progress is about the number 
+    of workers: cases are finished (and their outputs can be collected) 
+    one after another. Workers are either threads (run) or coroutines of
+    asyncio event loop (run_async).
+
+    Parameters
+    ----------
+    task_list : list
+        List of tasks.
+    costs : dict
+        Estimated costs of inputs. (case_name, input) -> cost.
+    render : callable
+        Function, that writes input files of the case. Default: None.
+    condense : Path
+        Folder with condensed decay data. Default: None.
+    state : RunState
+        Run state. Default: None.
+    retries : int
+        The number of retries of transient failures. Default: 0.
+    fail_fast : bool
+        Whether to cancel outstanding jobs on the first failure. 
+        Default: False.
+    scratch : ScratchArea
+        Local folder, where cases are run. Default: None - cases are run
+        in their folders.
+    on_case : callable
+        Function, that is called with case folder and case failures, when 
+        the case is finished. Default: None.
+    metrics : MetricsLog
+        Log of resource usage. Default: None.
+
+    Methods
+    -------
+    run(threads, progress)
+        Runs all jobs by worker threads.
+    run_async(concurrency, progress)
+        Runs all jobs by asyncio workers.
+    """
+    def __init__(
+            self, task_list, costs, render=None, condense=None, state=None,
+            retries=0, fail_fast=False, scratch=None, on_case=None, 
+            metrics=None
+        ):
+        self._costs = costs
+        self._metrics = metrics
+        self._scratch = scratch
+        self._on_case = on_case
+        self._render = render
+        self._condense = condense
+        self._state = state
+        self._retries = retries
+        self._fail_fast = fail_fast
+        self._stop = threading.Event()
+        self._cond = threading.Condition()
+        self._queue = []
+        self._new = []
+        self._counter = itertools.count()
+        self._active = 0
+        self._cases = {}
+        self._failures = []
+        self._failed = 0
+        self._wakeup = None
+        self._bar = None
+        self._bar_lock = threading.Lock()
+        self._total = sum(len(tasks) for _, tasks in task_list)
+        for cwd, tasks in task_list:
+            case = {
+                'tasks': list(tasks), 'remaining': len(tasks), 'waiting': [],
+                'failures': [], 'inputs': [], 'folder': None, 
+                'lock': threading.Lock()
+            }
+            self._cases[cwd] = case
+            if tasks:
+                cost = sum(costs[(cwd.name, t)] for t in tasks)
+                heapq.heappush(self._new, (-cost, next(self._counter), cwd))
+
+    def run(self, threads, progress=False):
+        """Runs all jobs by worker threads.
+
+        Parameters
+        ----------
+        threads : int
+            The number of worker threads.
+        progress : bool
+            Whether to show run progress. Default: False.
+
+        Returns
+        -------
+        failures : list
+            List of failures (see run_case).
+        """
+        workers = [
+            threading.Thread(target=self._work) for _ in range(max(threads, 1))
+        ]
+        with self._progress(progress):
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        return self._failures
+
+    def run_async(self, concurrency, progress=False):
+        """Runs all jobs by asyncio workers.
+
+        A single thread drives all FISPACT processes, so concurrency is not
+        limited by the number of threads.
+
+        Parameters
+        ----------
+        concurrency : int
+            Maximum number of FISPACT processes run at once.
+        progress : bool
+            Whether to show run progress. Default: False.
+
+        Returns
+        -------
+        failures : list
+            List of failures (see run_case).
+        """
+        with self._progress(progress):
+            asyncio.run(self._run_workers(max(concurrency, 1)))
+        return self._failures
+
+    async def _run_workers(self, concurrency):
+        self._wakeup = asyncio.Event()
+        await asyncio.gather(
+            *(self._work_async() for _ in range(concurrency))
+        )
 
+    @contextlib.contextmanager
+    def _progress(self, show):
+        if not show:
+            yield
+            return
+        with progressbar(
+                length=self._total, label='Running FISPACT', 
+                item_show_func=self._status
+            ) as self._bar:
+            yield
+        self._bar = None
 
-def run_case(task_case):
+    def _status(self, item=None):
+        return 'running {0}, failed {1}'.format(self._active, self._failed)
+
+    def _push(self, cost, cwd, name):
+        heapq.heappush(self._queue, (-cost, next(self._counter), cwd, name))
+
+    def _start_case(self, cwd):
+        case = self._cases[cwd]
+        if 'collapse' in case['tasks']:
+            case['waiting'] = [t for t in case['tasks'] if t != 'collapse']
+            self._push(self._costs[(cwd.name, 'collapse')], cwd, 'collapse')
+        else:
+            for name in case['tasks']:
+                self._push(self._costs[(cwd.name, name)], cwd, name)
+
+    def _pop(self):
+        if not self._queue:
+            self._start_case(heapq.heappop(self._new)[2])
+        return heapq.heappop(self._queue)[2:]
+
+    def _next_job(self):
+        with self._cond:
+            while not self._queue and not self._new and self._active > 0:
+                self._cond.wait()
+            if not self._queue and not self._new:
+                return None
+            self._active += 1
+            return self._pop()
+
+    async def _next_job_async(self):
+        while not self._queue and not self._new and self._active > 0:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        if not self._queue and not self._new:
+            return None
+        self._active += 1
+        return self._pop()
+
+    async def _work_async(self):
+        while True:
+            job = await self._next_job_async()
+            if job is None:
+                return
+            cwd, name = job
+            if self._stop.is_set():
+                failure = failure_item(cwd, name, 'cancelled', 'cancelled')
+            else:
+                try:
+                    folder = self._prepare_case(cwd)
+                    failure = await run_input_async(
+                        folder, name, retries=self._retries, state=self._state,
+                        metrics=self._metrics
+                    )
+                except Exception as e:
+                    failure = failure_item(cwd, name, e, 'error')
+            self._finish_job(cwd, name, failure)
+            self._wakeup.set()
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            cwd, name = job
+            if self._stop.is_set():
+                failure = failure_item(cwd, name, 'cancelled', 'cancelled')
+            else:
+                try:
+                    folder = self._prepare_case(cwd)
+                    failure = run_input(
+                        folder, name, retries=self._retries, state=self._state,
+                        metrics=self._metrics
+                    )
+                except Exception as e:
+                    failure = failure_item(cwd, name, e, 'error')
+            self._finish_job(cwd, name, failure)
+
+    def _prepare_case(self, cwd):
+        case = self._cases[cwd]
+        with case['lock']:
+            if case['folder'] is not None:
+                return case['folder']
+            if self._scratch is not None:
+                case['folder'] = self._scratch.stage(
+                    cwd, case['tasks'], render=self._render
+                )
+                return case['folder']
+            if self._render:
+                case['inputs'] = self._render(cwd, case['tasks'])
+            if self._condense is not None:
+                share_file(self._condense / 'ARRAYX', cwd / 'ARRAYX')
+            case['folder'] = cwd
+            return cwd
+
+    def _finish_job(self, cwd, name, failure):
+        case = self._cases[cwd]
+        with self._cond:
+            self._active -= 1
+            finished = 1
+            failed = len(case['failures'])
+            if failure is not None:
+                case['failures'].append(failure)
+                if self._fail_fast and failure['kind'] != 'cancelled':
+                    self._stop.set()
+            if name == 'collapse':
+                waiting, case['waiting'] = case['waiting'], []
+                if failure is None:
+                    for t in waiting:
+                        self._push(self._costs[(cwd.name, t)], cwd, t)
+                else:
+                    if failure['kind'] == 'cancelled':
+                        error, kind = 'cancelled', 'cancelled'
+                    else:
+                        error, kind = 'collapse failed', 'skipped'
+                    case['failures'].extend(
+                        failure_item(cwd, t, error, kind) for t in waiting
+                    )
+                    finished += len(waiting)
+            self._failed += len(case['failures']) - failed
+            case['remaining'] -= finished
+            case_done = case['remaining'] == 0
+            if case_done:
+                self._failures.extend(case['failures'])
+            self._cond.notify_all()
+        if self._bar is not None:
+            with self._bar_lock:
+                self._bar.update(finished, name)
+        if case_done:
+            self._finish_case(cwd, case)
+
+    def _finish_case(self, cwd, case):
+        failures = case['failures']
+        errors = [
+            '{0}: {1}'.format(f['input'], f['error']) 
+            for f in failures if f['kind'] != 'cancelled'
+        ]
+        if self._state is not None and len(errors) == len(failures):
+            self._state.record(cwd.name, '; '.join(errors) if errors else None)
+        if self._scratch is not None:
+            if case['folder'] is not None:
+                self._scratch.unstage(
+                    case['folder'], cwd, failed=bool(failures)
+                )
+        elif not failures:
+            for filename in case['inputs']:
+                filename.unlink()
+        if self._on_case is not None:
+            self._on_case(cwd, failures)
+
+
+def run_case(
+        task_case, render=None, condense=None, retries=0, stop=None, 
+        scratch=None, metrics=None
+    ):
     """Runs FISPACT calculations for the specific case.
 
     Parameters
@@ -76,7 +716,615 @@ def run_case(task_case):
     task_case : tuple
         A tuple of tasks to be executed for one particular case.
         (cwd, tasks) - cwd - working directory (Path), tasks - list of tasks.
+    render : callable
+        Function, that writes input files of the case. Default: None.
+    condense : Path
+        Folder with condensed decay data. Default: None.
+    retries : int
+        The number of retries of transient failures. Default: 0.
+    stop : threading.Event
+        If the event is set, remaining inputs are cancelled. Default: None.
+    scratch : ScratchArea
+        Local folder, where the case is run. Default: None.
+    metrics : MetricsLog
+        Log of resource usage. Default: None.
+
+    Returns
+    -------
+    failures : list
+        List of failures. Every failure is a dictionary (see failure_item).
+        kind of failure: 'fispact' - FISPACT fatal error, 'process' - crash
+        of FISPACT process, 'skipped' - inventory is not run because 
+        collapse failed, 'cancelled' - run is cancelled, 'error' - other
+        error.
     """
     cwd, tasks = task_case
+    if scratch is not None:
+        folder = scratch.stage(cwd, tasks, render=render)
+        inputs = []
+    else:
+        folder = cwd
+        inputs = render(cwd, tasks) if render else []
+        if condense is not None:
+            share_file(condense / 'ARRAYX', cwd / 'ARRAYX')
+    failures = []
+    collapse_failed = False
     for input_file in tasks:
-        run_fispact(input_file, cwd=cwd)
+        if stop is not None and stop.is_set():
+            failures.append(
+                failure_item(cwd, input_file, 'cancelled', 'cancelled')
+            )
+            continue
+        if collapse_failed:
+            failures.append(
+                failure_item(cwd, input_file, 'collapse failed', 'skipped')
+            )
+            continue
+        failure = run_input(
+            folder, input_file, retries=retries, metrics=metrics
+        )
+        if failure is not None:
+            failures.append(failure)
+            collapse_failed = input_file == 'collapse'
+    if scratch is not None:
+        scratch.unstage(folder, cwd, failed=bool(failures))
+    elif not failures:
+        for filename in inputs:
+            filename.unlink()
+    return failures
+
+
+def run_input(cwd, input_file, retries=0, state=None, metrics=None):
+    """Runs FISPACT input, retrying transient failures.
+
+    Parameters
+    ----------
+    cwd : Path
+        Case folder.
+    input_file : str
+        Name of FISPACT input.
+    retries : int
+        The number of retries after crash of FISPACT process. Default: 0.
+    state : RunState
+        Run state, where run time is recorded. Default: None.
+    metrics : MetricsLog
+        Log, where resource usage of every attempt is recorded. 
+        Default: None.
+
+    Returns
+    -------
+    failure : dict
+        Failure description (see failure_item) or None, if the run is 
+        successful.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        usage = {}
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            run_fispact(input_file, cwd=cwd, usage=usage)
+        except FispactError as e:
+            _record_metrics(
+                metrics, cwd, input_file, started, start, 'fispact', usage
+            )
+            return failure_item(cwd, input_file, e, 'fispact', attempts)
+        except (subprocess.CalledProcessError, OSError) as e:
+            _record_metrics(
+                metrics, cwd, input_file, started, start, 'process', usage
+            )
+            if attempts > retries:
+                return failure_item(cwd, input_file, e, 'process', attempts)
+            continue
+        _record_metrics(metrics, cwd, input_file, started, start, 'ok', usage)
+        if state is not None:
+            state.record_time(
+                cwd.name, input_file, time.perf_counter() - start
+            )
+        return None
+
+
+async def run_input_async(
+        cwd, input_file, retries=0, state=None, metrics=None
+    ):
+    """Runs FISPACT input in asyncio subprocess, retrying transient failures.
+
+    Parameters
+    ----------
+    cwd : Path
+        Case folder.
+    input_file : str
+        Name of FISPACT input.
+    retries : int
+        The number of retries after crash of FISPACT process. Default: 0.
+    state : RunState
+        Run state, where run time is recorded. Default: None.
+    metrics : MetricsLog
+        Log, where wall time of every attempt is recorded. CPU time and 
+        memory usage are not available for asyncio subprocesses. 
+        Default: None.
+
+    Returns
+    -------
+    failure : dict
+        Failure description (see failure_item) or None, if the run is 
+        successful.
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            await run_fispact_async(input_file, cwd=cwd)
+        except FispactError as e:
+            _record_metrics(
+                metrics, cwd, input_file, started, start, 'fispact'
+            )
+            return failure_item(cwd, input_file, e, 'fispact', attempts)
+        except (subprocess.CalledProcessError, OSError) as e:
+            _record_metrics(
+                metrics, cwd, input_file, started, start, 'process'
+            )
+            if attempts > retries:
+                return failure_item(cwd, input_file, e, 'process', attempts)
+            continue
+        _record_metrics(metrics, cwd, input_file, started, start, 'ok')
+        if state is not None:
+            state.record_time(
+                cwd.name, input_file, time.perf_counter() - start
+            )
+        return None
+
+
+def _record_metrics(metrics, cwd, input_file, started, start, status, 
+                    usage=None):
+    if metrics is None:
+        return
+    usage = usage or {}
+    metrics.record(
+        cwd.name, input_file, started, time.perf_counter() - start, 
+        status, cpu=usage.get('cpu'), rss=usage.get('rss')
+    )
+
+
+class ScratchArea:
+    """Local folder, where FISPACT cases are run.
+
+    Case inputs are copied (or rendered) to the subfolder of scratch area 
+    before the run. After the run only outputs are copied back to the case
+    folder, so the load on the shared file system is reduced. Condensed 
+    decay data is copied to scratch area once, when the first case is 
+    staged, and is shared by all cases.
+
+    Parameters
+    ----------
+    folder : Path or str
+        Local folder, e.g. /dev/shm. Temporary subfolder is created in it.
+    condense : Path
+        Folder with condensed decay data. Default: None.
+    keep_intermediates : bool
+        Whether to copy back COLLAPX and ARRAYX files, which are needed to
+        rerun inventories of the case without collapse. Default: True.
+
+    Methods
+    -------
+    stage(cwd, tasks, render)
+        Prepares the case for the run in scratch area.
+    unstage(folder, cwd, failed)
+        Copies results of the case back and removes its scratch folder.
+    close()
+        Removes scratch area.
+    """
+    def __init__(self, folder, condense=None, keep_intermediates=True):
+        self._root = Path(tempfile.mkdtemp(prefix='r2s-', dir=str(folder)))
+        self._keep = keep_intermediates
+        self._condense = condense
+        self._arrayx = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def root(self):
+        return self._root
+
+    def stage(self, cwd, tasks, render=None):
+        """Prepares the case for the run in scratch area.
+
+        Completion markers of inputs to be run are removed from the case
+        folder, so their outputs are not considered completed until the 
+        results are copied back.
+
+        Parameters
+        ----------
+        cwd : Path
+            Case folder.
+        tasks : list
+            Names of inputs to be run.
+        render : callable
+            Function, that writes input files of the case. Default: None.
+
+        Returns
+        -------
+        folder : Path
+            Scratch folder of the case.
+        """
+        folder = self._root / cwd.name
+        if folder.exists():
+            shutil.rmtree(folder)
+        folder.mkdir()
+        for name in tasks:
+            marker = completion_marker(cwd, name)
+            if marker.exists():
+                marker.unlink()
+        regenerated = _INTERMEDIATES if 'collapse' in tasks else ()
+        if cwd.exists():
+            for item in cwd.iterdir():
+                if item.is_dir() or item.suffix in _OUTPUT_SUFFIXES or \
+                        item.name in regenerated:
+                    continue
+                if item.name == 'ARRAYX' and self._condense is not None:
+                    continue
+                shutil.copyfile(item, folder / item.name)
+        if render:
+            render(folder, tasks)
+        if self._condense is not None:
+            share_file(self._local_arrayx(), folder / 'ARRAYX')
+        return folder
+
+    def _local_arrayx(self):
+        with self._lock:
+            if self._arrayx is None:
+                arrayx = self._root / 'ARRAYX'
+                shutil.copyfile(self._condense / 'ARRAYX', arrayx)
+                self._arrayx = arrayx
+        return self._arrayx
+
+    def unstage(self, folder, cwd, failed=False):
+        """Copies results of the case back and removes its scratch folder.
+
+        Outputs are copied back. Intermediate files are copied, if they 
+        are kept. If the case failed, all its files are copied back for 
+        diagnostics.
+
+        Parameters
+        ----------
+        folder : Path
+            Scratch folder of the case.
+        cwd : Path
+            Case folder.
+        failed : bool
+            Whether the case failed. Default: False.
+        """
+        cwd.mkdir(parents=True, exist_ok=True)
+        for item in folder.iterdir():
+            if item.is_symlink() or item.is_dir():
+                continue
+            if failed or item.suffix in _RESULT_SUFFIXES or \
+                    self._keep and item.name in _INTERMEDIATES:
+                shutil.copyfile(item, cwd / item.name)
+        shutil.rmtree(folder)
+
+    def close(self):
+        """Removes scratch area."""
+        shutil.rmtree(self._root, ignore_errors=True)
+
+
+def failure_item(cwd, input_file, error, kind, attempts=0):
+    """Creates description of failure.
+
+    Parameters
+    ----------
+    cwd : Path
+        Case folder.
+    input_file : str
+        Name of FISPACT input.
+    error : Exception or str
+        Error.
+    kind : str
+        Kind of failure.
+    attempts : int
+        The number of attempts made. Default: 0.
+
+    Returns
+    -------
+    failure : dict
+        Failure: 'case', 'input', 'kind', 'error', 'attempts'.
+    """
+    return {
+        'case': cwd.name, 'input': input_file, 'kind': kind, 
+        'error': str(error), 'attempts': attempts
+    }
+
+
+def share_file(source, target):
+    """Makes the file available in other folder.
+
+    Relative symbolic link is created. If links are not supported, the file
+    is copied.
+
+    Parameters
+    ----------
+    source : Path
+        Shared file.
+    target : Path
+        Name of the file in other folder.
+    """
+    if target.is_symlink() or target.exists():
+        target.unlink()
+    try:
+        os.symlink(os.path.relpath(source, target.parent), target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def is_completed(cwd, name):
+    """Checks whether FISPACT input is calculated successfully.
+
+    The input is completed, if its output exists, is newer than the input 
+    file and the run ended normally: completion marker is created after 
+    FISPACT process exits successfully without fatal error. Outputs of 
+    runs, that are killed or crashed, have no marker.
+
+    Parameters
+    ----------
+    cwd : Path
+        Case folder.
+    name : str
+        Name of FISPACT input.
+
+    Returns
+    -------
+    completed : bool
+        True, if the input is completed.
+    """
+    output = cwd / (name + '.out')
+    if not output.exists() or not completion_marker(cwd, name).exists():
+        return False
+    out_stat = output.stat()
+    if out_stat.st_size == 0:
+        return False
+    inp = cwd / (name + '.i')
+    if inp.exists() and inp.stat().st_mtime > out_stat.st_mtime:
+        return False
+    return True
+
+
+def remaining_tasks(task_list, collected=None):
+    """Finds tasks, which are not completed yet.
+
+    Parameters
+    ----------
+    task_list : list
+        List of tasks.
+    collected : set
+        Outputs, whose data is already collected (see 
+        fetch.parsed_outputs). Their inputs are considered completed, even 
+        if outputs are deleted. Default: None.
+
+    Returns
+    -------
+    remaining : list
+        List of tasks to be run. If collapse of the case is not completed 
+        or its COLLAPX file is missing, all not collected inputs of the 
+        case are included.
+    """
+    collected = collected or set()
+    remaining = []
+    for cwd, tasks in task_list:
+        uncollected = [t for t in tasks if cwd / (t + '.out') not in collected]
+        if uncollected == ['collapse'] and len(tasks) > 1:
+            continue
+        if 'collapse' in uncollected and not (
+            is_completed(cwd, 'collapse') and (cwd / 'COLLAPX').exists()
+        ):
+            remaining.append((cwd, uncollected))
+            continue
+        names = [t for t in uncollected if not is_completed(cwd, t)]
+        if names:
+            remaining.append((cwd, names))
+    return remaining
+
+
+class RunState:
+    """Log of case results of the run stage.
+
+    Every result is appended to the file as JSON line immediately, so the
+    state survives interruption of the run. The last record of the case 
+    determines its state. Run times of inputs are recorded too.
+
+    Parameters
+    ----------
+    filename : Path or str
+        Name of state file.
+
+    Methods
+    -------
+    record(name, error)
+        Records the result of the case.
+    record_time(name, input_file, seconds)
+        Records run time of the input.
+    failed()
+        Gets failed cases.
+    timings()
+        Gets run times of inputs.
+    close()
+        Closes state file.
+    """
+    def __init__(self, filename):
+        self._results = {}
+        self._timings = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'time' in item:
+                        self._timings[(item['case'], item['input'])] = \
+                            item['time']
+                    else:
+                        self._results[item['case']] = item
+        self._lock = threading.Lock()
+        self._file = open(filename, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._results)
+
+    def record(self, name, error=None):
+        """Records the result of the case.
+
+        Parameters
+        ----------
+        name : str
+            Name of the case.
+        error : Exception
+            Error of the case. Default: None - case is completed 
+            successfully.
+        """
+        item = {
+            'case': name, 'status': 'failed' if error else 'done',
+            'error': str(error) if error else None
+        }
+        with self._lock:
+            self._results[name] = item
+            self._file.write(json.dumps(item) + '\n')
+            self._file.flush()
+
+    def record_time(self, name, input_file, seconds):
+        """Records run time of the input.
+
+        Parameters
+        ----------
+        name : str
+            Name of the case.
+        input_file : str
+            Name of the input.
+        seconds : float
+            Run time.
+        """
+        item = {'case': name, 'input': input_file, 'time': seconds}
+        with self._lock:
+            self._timings[(name, input_file)] = seconds
+            self._file.write(json.dumps(item) + '\n')
+            self._file.flush()
+
+    def timings(self):
+        """Gets run times of inputs.
+
+        Returns
+        -------
+        timings : dict
+            Run times of the last runs. (case_name, input) -> seconds.
+        """
+        return dict(self._timings)
+
+    def failed(self):
+        """Gets failed cases.
+
+        Returns
+        -------
+        failed : dict
+            A dictionary of failed cases. case_name -> error message.
+        """
+        return {
+            name: item['error'] for name, item in self._results.items() 
+            if item['status'] == 'failed'
+        }
+
+    def close(self):
+        """Closes state file."""
+        self._file.close()
+
+
+class MetricsLog:
+    """Log of resource usage of FISPACT runs.
+
+    Every run of FISPACT input is appended to the file as compact JSON 
+    line: case, input, start time, wall and CPU time in seconds, peak 
+    resident set size in kB and status ('ok', 'fispact' - fatal error, 
+    'process' - crash of FISPACT process). Every run of the stage starts 
+    with the line describing it: start time, the number of threads and 
+    host name. CPU time and peak RSS are null, if they are not available:
+    for --backend asyncio (the event loop reaps FISPACT processes itself, so
+    their resource usage can't be obtained) and on Windows. The log is 
+    summarized by report module.
+
+    Parameters
+    ----------
+    filename : Path or str
+        Name of metrics file.
+    threads : int
+        The number of inputs run concurrently. Default: 1.
+
+    Methods
+    -------
+    record(case, input_file, start, wall, status, cpu, rss)
+        Records FISPACT run.
+    close()
+        Closes metrics file.
+    """
+    def __init__(self, filename, threads=1):
+        self._lock = threading.Lock()
+        self._file = open(filename, 'a')
+        self._write({
+            'run': time.time(), 'threads': threads, 
+            'host': socket.gethostname()
+        })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write(self, item):
+        with self._lock:
+            self._file.write(json.dumps(item, separators=(',', ':')) + '\n')
+            self._file.flush()
+
+    def record(
+            self, case, input_file, start, wall, status, cpu=None, rss=None
+        ):
+        """Records FISPACT run.
+
+        Parameters
+        ----------
+        case : str
+            Name of the case.
+        input_file : str
+            Name of the input.
+        start : float
+            Start time (seconds since the epoch).
+        wall : float
+            Wall time in seconds.
+        status : str
+            Run status.
+        cpu : float
+            CPU time in seconds. Default: None - not available.
+        rss : int
+            Peak resident set size in kB. Default: None - not available.
+        """
+        self._write({
+            'case': case, 'input': input_file, 'start': round(start, 3),
+            'wall': round(wall, 3), 
+            'cpu': None if cpu is None else round(cpu, 3), 
+            'rss': rss, 'status': status
+        })
+
+    def close(self):
+        """Closes metrics file."""
+        self._file.close()
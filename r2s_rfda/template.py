@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import re
+from string import Formatter
 from pkg_resources import resource_filename
 import numpy as np
 
@@ -11,12 +12,6 @@ def read_template(temp_name):
     return template
 
 
-files_temp = None     # read_template('files.temp')
-collapse_temp = None  # read_template('collapse.temp')
-condense_temp = None  # read_template('condense.temp')
-inventory_temp = None
-flux_coeffs = None
-
 order = [
     'ind_nuc', 'xs_endf', 'xs_endfb', 'prob_tab', 'fy_endf', 'sf_endf', 'dk_endf',
     'hazards', 'clear', 'a2data', 'absorp'
@@ -31,14 +26,165 @@ FLT_NUMBER = r'(' + \
              INT_NUMBER + r'?' + FRACTION + INT_NUMBER + EXPONENT + r'?|' +\
              INT_NUMBER + FRACTION + r'?' + EXPONENT + r'|' + \
              INT_NUMBER + FRACTION + r')(?=[ \n-+])'
-             
 
-def init_inventory_template(inptemp, norm_flux):
-    """Initialize new template with replaced fluxes in irradiation scenario.
 
-    New template is stored in module local variable since the template will not
-    be changed for particular task. The irradiation profile is also stored at
-    module level.
+class TemplateSet:
+    """Set of FISPACT input templates of the task.
+
+    The object holds no references to module state, so it can be pickled
+    and sent to worker processes, and several tasks can be prepared in one
+    interpreter.
+
+    Parameters
+    ----------
+    files : str
+        Text of FISPACT files file.
+    collapse : str
+        Text of collapse input file.
+    inventory : str
+        Inventory template with fluxes replaced by placeholders (see 
+        init_inventory_template).
+    flux_coeffs : array_like
+        Irradiation profile - fluxes of the scenario normalized to 
+        nominal flux.
+    condense : str
+        Text of condense input file. Default: None.
+
+    Methods
+    -------
+    create(inventory, norm_flux, datalib, libxs, nestrc)
+        Creates templates from task data.
+    replace_scenario(inventory, norm_flux)
+        Creates templates with new irradiation scenario.
+    fispact_files()
+        Gets fispact files text.
+    fispact_collapse()
+        Gets fispact collapse text.
+    fispact_condense()
+        Gets fispact condense text.
+    fispact_inventory(flux, material)
+        Creates text of inventory input file.
+    """
+    def __init__(self, files, collapse, inventory, flux_coeffs, condense=None):
+        self._files = files
+        self._collapse = collapse
+        self._condense = condense
+        self._inventory = inventory
+        self._flux_coeffs = np.array(flux_coeffs, dtype=float)
+        self._format, self._fields = compile_inventory_template(inventory)
+
+    @classmethod
+    def create(cls, inventory, norm_flux, datalib, libxs, nestrc):
+        """Creates templates from task data.
+
+        Decay data is condensed once by the condense input, and collapse
+        input reads condensed data from ARRAYX file.
+
+        Parameters
+        ----------
+        inventory : str
+            Input template of inventory input file.
+        norm_flux : float
+            Flux value for normalization.
+        datalib : dict
+            A dictionary of libraries to be used in FISPACT calculations.
+        libxs : int
+            If -1 - to use binary library, if 1 - use text library.
+        nestrc : int
+            The number of energy groups in neutron spectrum.
+
+        Returns
+        -------
+        templates : TemplateSet
+            Templates.
+        """
+        inventory, flux_coeffs = init_inventory_template(inventory, norm_flux)
+        return cls(
+            init_files_template(datalib), 
+            init_collapse_template(libxs, nestrc, getdecay=0), inventory, 
+            flux_coeffs, condense=init_condense_template()
+        )
+
+    def replace_scenario(self, inventory, norm_flux):
+        """Creates templates with new irradiation scenario.
+
+        Parameters
+        ----------
+        inventory : str
+            Input template of inventory input file.
+        norm_flux : float
+            Flux value for normalization.
+
+        Returns
+        -------
+        templates : TemplateSet
+            New templates. Files, collapse and condense texts are the same.
+        """
+        inventory, flux_coeffs = init_inventory_template(inventory, norm_flux)
+        return TemplateSet(
+            self._files, self._collapse, inventory, flux_coeffs, 
+            condense=self._condense
+        )
+
+    def __getstate__(self):
+        return self._files, self._collapse, self._inventory, \
+            self._flux_coeffs, self._condense
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __eq__(self, other):
+        return isinstance(other, TemplateSet) and \
+            self._files == other._files and \
+            self._collapse == other._collapse and \
+            self._condense == other._condense and \
+            self._inventory == other._inventory and \
+            np.array_equal(self._flux_coeffs, other._flux_coeffs)
+
+    @property
+    def inventory_temp(self):
+        return self._inventory
+
+    @property
+    def flux_coeffs(self):
+        return self._flux_coeffs
+
+    def fispact_files(self):
+        """Gets fispact files text."""
+        return self._files
+
+    def fispact_collapse(self):
+        """Gets fispact collapse text."""
+        return self._collapse
+
+    def fispact_condense(self):
+        """Gets fispact condense text."""
+        return self._condense
+
+    def fispact_inventory(self, flux, material):
+        """Creates text of inventory input file.
+
+        Parameters
+        ----------
+        flux : float
+            Nominal flux value for the scenario at particular point.
+        material : str
+            Material description.
+
+        Returns
+        -------
+        text : str
+            Text of inventory file.
+        """
+        fluxes = (flux * self._flux_coeffs).tolist()
+        values = tuple(
+            material if f is None else fluxes[f] for f in self._fields
+        )
+        return self._format % values
+
+
+def init_inventory_template(inptemp, norm_flux):
+    """Creates new template with replaced fluxes in irradiation scenario.
 
     Parameters
     ----------
@@ -46,9 +192,14 @@ def init_inventory_template(inptemp, norm_flux):
         Input template of inventory input file.
     norm_flux : float
         Flux value for normalization.
+
+    Returns
+    -------
+    inventory_temp : str
+        Inventory template. Fluxes are replaced by {i} placeholders.
+    flux_coeffs : numpy.ndarray
+        Irradiation profile - fluxes normalized to norm_flux.
     """
-    global inventory_temp
-    global flux_coeffs
     flux_pattern = re.compile('(FLUX +)', flags=re.IGNORECASE)
     zero_pattern = re.compile('0[ \n]')
     float_pattern = re.compile(FLT_NUMBER, flags=re.IGNORECASE)
@@ -60,12 +211,10 @@ def init_inventory_template(inptemp, norm_flux):
     i = 0
     for string in substrings:
         if try_number:
-            print('"{0}"'.format(string))
             if zero_pattern.match(string):
                 result.append(string)
             else:
                 match = float_pattern.match(string)
-                print(match.group(0))
                 if not match:
                     raise ValueError('Scenario template contains incorrect data')
                 flux_coeffs.append(float(match.group(0)) / norm_flux)
@@ -78,19 +227,55 @@ def init_inventory_template(inptemp, norm_flux):
             try_number = True
         else:
             try_number = False
-    inventory_temp = ''.join(result)
-    flux_coeffs = np.array(flux_coeffs)
+    return ''.join(result), np.array(flux_coeffs)
+
+
+def compile_inventory_template(inventory_temp):
+    """Compiles inventory template into printf-style format string.
+
+    The template is parsed only once, and rendering of the inventory is
+    reduced to single formatting operation.
+
+    Parameters
+    ----------
+    inventory_temp : str
+        Inventory template.
+
+    Returns
+    -------
+    inventory_format : str
+        Format string. Fluxes are formatted as %.4e, material as %s.
+    inventory_fields : tuple
+        Order of values: flux index or None for material.
+    """
+    pieces = []
+    fields = []
+    for literal, field, spec, conv in Formatter().parse(inventory_temp):
+        pieces.append(literal.replace('%', '%%'))
+        if field is None:
+            continue
+        if field == 'material':
+            pieces.append('%s')
+            fields.append(None)
+        else:
+            pieces.append('%.4e')
+            fields.append(int(field))
+    return ''.join(pieces), tuple(fields)
 
 
 def init_files_template(datalib):
-    """Initializes files template.
+    """Creates files text.
 
     Parameters
     ----------
     datalib : dict
         A dictionary of libraries to be used in FISPACT calculations.
+
+    Returns
+    -------
+    files : str
+        Text of FISPACT files file.
     """
-    global files_temp
     max_len = max(map(len, datalib.keys()))
     lib_str = []
     for name in order:
@@ -98,11 +283,11 @@ def init_files_template(datalib):
             spaces = ' ' * (max_len - len(name) + 2)
             lib_str.append(name + spaces + datalib[name])
     temp = read_template('files.temp')
-    files_temp = temp.format(datalib='\n'.join(lib_str))
+    return temp.format(datalib='\n'.join(lib_str))
 
 
-def init_collapse_template(libxs, nestrc):
-    """Initializes collapse input file.
+def init_collapse_template(libxs, nestrc, getdecay=1):
+    """Creates collapse input file.
 
     Parameters
     ----------
@@ -110,39 +295,28 @@ def init_collapse_template(libxs, nestrc):
         If -1 - to use binary library, if 1 - use text library.
     nestrc : int
         The number of energy groups in neutron spectrum.
+    getdecay : int
+        If 1 - decay data is condensed during collapse run, if 0 - condensed
+        data is read from ARRAYX file. Default: 1.
+
+    Returns
+    -------
+    collapse : str
+        Text of collapse input file.
     """
-    global collapse_temp
     temp = read_template('collapse.temp')
-    collapse_temp = temp.format(nestrc=nestrc, libxs=libxs)
+    return temp.format(nestrc=nestrc, libxs=libxs, getdecay=getdecay)
 
 
-def fispact_inventory(flux, material):
-    """Creates text of inventory input file.
-
-    Parameters
-    ----------
-    flux : float
-        Nominal flux value for the scenario at particular point.
-    material : str
-        Material description.
+def init_condense_template():
+    """Creates condense input file.
 
     Returns
     -------
-    text : str
-        Text of inventory file.
+    condense : str
+        Text of condense input file.
     """
-    fluxes = map('{0:.4e}'.format, flux * flux_coeffs)
-    return inventory_temp.format(*fluxes, material=material)
-
-
-def fispact_files():
-    """Gets fispact files text."""
-    return files_temp
-
-
-def fispact_collapse():
-    """Gets fispact collapse text."""
-    return collapse_temp
+    return read_template('condense.temp')
 
 
 def create_arbflux_text(ebins, flux):
@@ -160,20 +334,43 @@ def create_arbflux_text(ebins, flux):
     arb_flux : str
         Text for arb_flux file.
     """
-    ncols = 6
-    text = []
-    for i, e in enumerate(reversed(ebins)):
-        s = '\n' if (i + 1) % ncols == 0 else ' '
-        text.append('{0:.6e}'.format(e * 1.e+6))  # Because fispact needs
-        text.append(s)                            # eV, not MeV
-    text[-1] = '\n'
-   
-    for i, e in enumerate(reversed(flux)):
-        s = '\n' if (i + 1) % ncols == 0 else ' '
-        text.append('{0:.6e}'.format(e))
-        text.append(s)
-    text[-1] = '\n'
-    text.append('1.0\n')
-    text.append('total flux={0:.6e}'.format(np.sum(flux)))
-
-    return ''.join(text)
+    return create_arbflux_texts(ebins, [flux])[0]
+
+
+def create_arbflux_texts(ebins, spectra):
+    """Creates arb_flux files for a set of spectra at once.
+
+    Energy bins are formatted once, and the format string for spectra is 
+    built once for all spectra.
+
+    Parameters
+    ----------
+    ebins : array_like[float]
+        Energy bins in MeV.
+    spectra : array_like[float]
+        Group spectra, one spectrum per row.
+
+    Returns
+    -------
+    texts : list[str]
+        Texts of arb_flux files.
+    """
+    if len(spectra) == 0:
+        return []
+    ebins = np.asarray(ebins, dtype=float)
+    spectra = np.asarray(spectra, dtype=float)
+    # Because fispact needs eV, not MeV
+    head = _values_format(ebins.size) % tuple((ebins[::-1] * 1.e+6).tolist())
+    flux_format = head.replace('%', '%%') + \
+        _values_format(spectra.shape[1]) + '1.0\ntotal flux=%.6e'
+    values = np.empty((spectra.shape[0], spectra.shape[1] + 1))
+    values[:, :-1] = spectra[:, ::-1]
+    values[:, -1] = [np.sum(s) for s in spectra]
+    return [flux_format % tuple(row) for row in values.tolist()]
+
+
+def _values_format(n, ncols=6):
+    """Gets format string for n values, ncols values per line."""
+    seps = ['\n' if (i + 1) % ncols == 0 else ' ' for i in range(n)]
+    seps[-1] = '\n'
+    return ''.join('%.6e' + sep for sep in seps)
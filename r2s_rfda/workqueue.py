@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+
+DEFAULT_EXPIRY = 300
+DEFAULT_HEARTBEAT = 30
+
+
+class WorkQueue:
+    """Queue of cases shared by workers through the file system.
+
+    Workers on different hosts claim cases of the same task folder. The
+    claim is a lease file, that is created atomically, so only one worker
+    can hold it. The worker periodically updates modification time of its
+    leases (heartbeat). If the lease is not updated during expiry period,
+    its worker is considered dead and the case can be claimed by other
+    worker. When the case is finished, its lease is replaced by marker
+    file with the result of the case.
+
+    Parameters
+    ----------
+    folder : Path or str
+        Folder, where lease and marker files are stored.
+    worker : str
+        Worker name. Default: None - unique name is generated from host
+        name and process id.
+    expiry : float
+        Time in seconds, after which not updated lease is considered stale.
+        Default: 300.
+    heartbeat : float
+        Period of lease updates in seconds. Default: 30.
+
+    Methods
+    -------
+    claim(name)
+        Claims the case.
+    release(name, failures)
+        Finishes the case and records its result.
+    reopen(name, failed)
+        Allows the finished case to be claimed again.
+    status(name)
+        Gets status of the case.
+    failures()
+        Gets failures of all finished cases.
+    close()
+        Stops heartbeat.
+    """
+    def __init__(
+            self, folder, worker=None, expiry=DEFAULT_EXPIRY,
+            heartbeat=DEFAULT_HEARTBEAT
+        ):
+        self._folder = Path(folder)
+        self._folder.mkdir(parents=True, exist_ok=True)
+        if worker is None:
+            worker = '{0}-{1}-{2}'.format(
+                socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6]
+            )
+        self._worker = worker
+        self._expiry = expiry
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._beat, args=(heartbeat,), daemon=True
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def worker(self):
+        return self._worker
+
+    def _path(self, name, suffix):
+        return self._folder / (name + suffix)
+
+    def claim(self, name):
+        """Claims the case.
+
+        Parameters
+        ----------
+        name : str
+            Name of the case.
+
+        Returns
+        -------
+        claimed : bool
+            True, if the case is claimed by this worker. False, if the case
+            is finished or is claimed by other alive worker.
+        """
+        if self.status(name) in ('done', 'failed'):
+            return False
+        lease = self._path(name, '.lease')
+        if self._create_lease(lease):
+            return self._hold(name)
+        if not self._is_stale(lease) or not self._break_lease(lease):
+            return False
+        if self._create_lease(lease):
+            return self._hold(name)
+        return False
+
+    def _hold(self, name):
+        if self.status(name) in ('done', 'failed'):
+            self._path(name, '.lease').unlink()
+            return False
+        with self._lock:
+            self._held.add(name)
+        return True
+
+    def _create_lease(self, lease):
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        item = {'worker': self._worker, 'time': time.time()}
+        with os.fdopen(fd, 'w') as f:
+            json.dump(item, f)
+        return True
+
+    def _is_stale(self, lease):
+        try:
+            return time.time() - lease.stat().st_mtime > self._expiry
+        except FileNotFoundError:
+            return True
+
+    def _break_lease(self, lease):
+        # Only one worker can move the stale lease away. If the lease was
+        # renewed in the meantime, it is put back.
+        moved = lease.with_name(
+            '{0}.{1}.stale'.format(lease.name, self._worker)
+        )
+        try:
+            os.rename(lease, moved)
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+        if not self._is_stale(moved):
+            try:
+                os.link(moved, lease)
+            except OSError:
+                pass
+            moved.unlink()
+            return False
+        moved.unlink()
+        return True
+
+    def release(self, name, failures=None):
+        """Finishes the case and records its result.
+
+        Parameters
+        ----------
+        name : str
+            Name of the case.
+        failures : list
+            Failures of the case (see run.failure_item). Default: None -
+            the case is completed successfully.
+        """
+        suffix = '.failed' if failures else '.done'
+        marker = self._path(name, suffix)
+        tmp = self._path(name, '.{0}.tmp'.format(self._worker))
+        with open(tmp, 'w') as f:
+            json.dump({'worker': self._worker, 'failures': failures or []}, f)
+        os.replace(tmp, marker)
+        with self._lock:
+            self._held.discard(name)
+        lease = self._path(name, '.lease')
+        if self._owns(lease):
+            try:
+                lease.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _owns(self, lease):
+        # The lease may be broken by other worker, while this worker is 
+        # stalled, and claimed again. Such lease must not be touched.
+        try:
+            with open(lease) as f:
+                return json.load(f)['worker'] == self._worker
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def reopen(self, name, failed=False):
+        """Allows the finished case to be claimed again.
+
+        It is used, when outputs of the case are missing or stale, although
+        the case is marked as done, or to retry the failed case.
+
+        Parameters
+        ----------
+        name : str
+            Name of the case.
+        failed : bool
+            Whether to reopen the failed case too. Default: False - only 
+            the successfully finished case is reopened.
+        """
+        suffixes = ('.done', '.failed') if failed else ('.done',)
+        for suffix in suffixes:
+            try:
+                self._path(name, suffix).unlink()
+            except FileNotFoundError:
+                pass
+
+    def status(self, name):
+        """Gets status of the case.
+
+        Parameters
+        ----------
+        name : str
+            Name of the case.
+
+        Returns
+        -------
+        status : str
+            'done', 'failed', 'claimed' or None - the case is not claimed.
+        """
+        for suffix in ('done', 'failed', 'lease'):
+            if self._path(name, '.' + suffix).exists():
+                return 'claimed' if suffix == 'lease' else suffix
+        return None
+
+    def failures(self):
+        """Gets failures of all finished cases.
+
+        Returns
+        -------
+        failures : list
+            List of failures, recorded by all workers.
+        """
+        failures = []
+        for marker in sorted(self._folder.glob('*.failed')):
+            with open(marker) as f:
+                failures.extend(json.load(f)['failures'])
+        return failures
+
+    def _beat(self, period):
+        while not self._stop.wait(period):
+            with self._lock:
+                held = list(self._held)
+            for name in held:
+                lease = self._path(name, '.lease')
+                if not self._owns(lease):
+                    with self._lock:
+                        self._held.discard(name)
+                    continue
+                try:
+                    os.utime(lease)
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """Stops heartbeat."""
+        self._stop.set()
+        self._thread.join()
@@ -11,7 +11,8 @@ setup(
         'sparse',
         'pypact',
         'mckit==0.1.2',
-        'numpy'
+        'numpy',
+        'click>=8'
     ],
     test_requires=[
         'pytest',
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+from collections import namedtuple
+
+import pytest
+
+from r2s_rfda import cache
+
+
+Voxel = namedtuple('Voxel', ['corners'])
+
+
+@pytest.fixture
+def volume_cache(tmp_path):
+    with cache.VolumeCache(tmp_path / 'volumes.db', max_entries=3) as vc:
+        yield vc
+
+
+@pytest.mark.parametrize('items, keys, answer', [
+    ({'a': 1.0, 'b': 0.0, 'c': 2.5}, ['a', 'b', 'd'], {'a': 1.0, 'b': 0.0}),
+    ({}, ['a'], {}),
+])
+def test_get_put(volume_cache, items, keys, answer):
+    volume_cache.put_many(items)
+    assert volume_cache.get_many(keys) == answer
+    assert len(volume_cache) == len(items)
+
+
+def test_persistence(tmp_path):
+    with cache.VolumeCache(tmp_path / 'volumes.db') as vc:
+        vc.put_many({'a': 1.5})
+    with cache.VolumeCache(tmp_path / 'volumes.db') as vc:
+        assert vc.get_many(['a']) == {'a': 1.5}
+
+
+def test_prune(volume_cache, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(cache.time, 'time', lambda: next(clock))
+    volume_cache.put_many({'a': 1.0, 'b': 2.0})
+    volume_cache.put_many({'c': 3.0, 'd': 4.0})
+    volume_cache.get_many(['a'])
+    assert volume_cache.prune() == 1
+    assert set(volume_cache.get_many('abcd').keys()) == {'a', 'c', 'd'}
+    assert volume_cache.prune(1) == 2
+    assert volume_cache.info()['entries'] == 1
+
+
+@pytest.mark.parametrize('corners1, min_vol1, corners2, min_vol2, equal', [
+    ([[0, 0, 0], [1, 1, 1]], 1.e-3, [[0, 0, 0], [1, 1, 1]], 1.e-3, True),
+    ([[0, 0, 0], [1, 1, 1]], 1.e-3, [[0, 0, 0], [1, 1, 2]], 1.e-3, False),
+    ([[0, 0, 0], [1, 1, 1]], 1.e-3, [[0, 0, 0], [1, 1, 1]], 1.e-4, False),
+])
+def test_volume_key(corners1, min_vol1, corners2, min_vol2, equal):
+    key1 = cache.volume_key('cell', Voxel(corners1), min_vol1)
+    key2 = cache.volume_key('cell', Voxel(corners2), min_vol2)
+    assert (key1 == key2) == equal
+    assert key1 != cache.volume_key('other', Voxel(corners1), min_vol1)
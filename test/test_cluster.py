@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from r2s_rfda import cluster
+
+
+@pytest.mark.parametrize('points, k, weights, answer', [
+    ([[1, 0], [0.9, 0.1], [0, 1], [0.1, 0.9]], 2, None, [0, 0, 1, 1]),
+    ([[1, 0], [0.9, 0.1], [0, 1]], 3, None, [0, 1, 2]),
+    ([[1, 0], [0.9, 0.1], [0, 1]], 5, [1, 2, 3], [0, 1, 2]),
+    ([[1, 0], [0, 1], [0, 1], [0.5, 0.5]], 2, [1, 1, 1, 0], [0, 1, 1, None]),
+])
+def test_kmeans(points, k, weights, answer):
+    labels, centroids = cluster.kmeans(np.array(points), k, weights=weights)
+    assert centroids.shape == (min(k, len(points)), len(points[0]))
+    groups = {}
+    for lab, ans in zip(labels, answer):
+        if ans is not None:
+            groups.setdefault(ans, set()).add(lab)
+    assert all(len(g) == 1 for g in groups.values())
+    assert len(set.union(*groups.values())) == len(groups)
+
+
+@pytest.mark.parametrize('points, centroids, labels, dist', [
+    ([[0, 0], [1, 1], [3, 3]], [[0, 0], [3, 3]], [0, 0, 1], [0, 2, 0]),
+    ([[1, 2]], [[0, 0], [1, 1], [2, 2]], [1], [1]),
+])
+def test_nearest_centroids(points, centroids, labels, dist):
+    lab, d = cluster.nearest_centroids(
+        np.array(points, dtype=float), np.array(centroids, dtype=float)
+    )
+    np.testing.assert_array_equal(lab, labels)
+    np.testing.assert_array_almost_equal(d, dist)
+
+
+@pytest.mark.parametrize('spectra, centroids, labels, answer', [
+    ([[1, 0], [0.5, 0.5]], [[1, 0]], [0, 0], [0, 1]),
+    ([[1, 0], [0, 1]], [[0, 1], [1, 0]], [1, 1], [0, 2]),
+])
+def test_spectrum_errors(spectra, centroids, labels, answer):
+    errors = cluster.spectrum_errors(
+        np.array(spectra), np.array(centroids), np.array(labels)
+    )
+    np.testing.assert_array_almost_equal(errors, answer)
+
+
+@pytest.mark.parametrize('n_clusters, tolerance', [
+    (2, None), (None, 0.1), (None, 0.0), (1, 0.5)
+])
+def test_cluster_spectra(n_clusters, tolerance):
+    rnd = np.random.RandomState(1)
+    spectra = rnd.random_sample((40, 5))
+    spectra = np.vstack((spectra, spectra[:10]))
+    spectra /= np.sum(spectra, axis=1)[:, np.newaxis]
+    labels, centroids, errors = cluster.cluster_spectra(
+        spectra, n_clusters=n_clusters, tolerance=tolerance
+    )
+    assert labels.shape == (50,)
+    assert errors.shape == (50,)
+    if tolerance is None:
+        assert centroids.shape[0] == n_clusters
+    np.testing.assert_array_equal(labels[:10], labels[40:])
+    np.testing.assert_array_almost_equal(
+        errors, cluster.spectrum_errors(spectra, centroids, labels)
+    )
+    if tolerance is not None:
+        assert np.max(errors) <= tolerance or centroids.shape[0] == 40
+
+
+def test_cluster_spectra_no_params():
+    with pytest.raises(ValueError):
+        cluster.cluster_spectra(np.ones((2, 2)))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 import pytest
 import numpy as np
 
@@ -70,3 +72,121 @@ def test_flux_coeffs(sindex, flux_coeffs, answer):
 def test_produce_slice_array(data_dict, labels, answer):
     result = fetch.produce_slice_array(data_dict, labels)
     np.testing.assert_array_equal(result, answer)
+
+
+@pytest.mark.parametrize('data, labels, flux, mass, answer', [
+    ([[1, 2], [3, 4]], [0, 1, 1], [1, 0.5, 2], [[1, 0, 1], [0, 1, 1]],
+     [1, 2, 4 + 8]),
+    ([[2]], [0, 0], [1, 0], [[1, 1]], [2, 0]),
+])
+def test_apply_clusters(data, labels, flux, mass, answer):
+    result = fetch.apply_clusters(
+        np.array(data), np.array(labels), np.array(flux), np.array(mass)
+    )
+    np.testing.assert_array_almost_equal(result, answer)
+
+
+def test_get_hybrid_frame():
+    pieces = [(1, 0, 0, 0), (2, 1, 0, 0), (1, 1, 0, 0)]
+    sindex = data.SpatialIndex(pieces)
+    q = [sindex.indices(c=c, i=i, j=j, k=k)[0] for c, i, j, k in pieces]
+    flux = np.zeros((2, 3))
+    flux[:, q] = [[0, 1, 0.5], [1, 0, 1]]
+    mass = np.zeros((2, 3))
+    mass[:, q] = [[0, 0, 2], [0, 1, 0]]
+    coeffs = {
+        'approach': 'hybrid', 'mat_labels': ['m1', 'm2'],
+        'flux': flux, 'mass': mass
+    }
+    frame_dict = {
+        0: {(1, 0, 0, 0): 5.0, (0, 'm1'): 1.0, (1, 'm1'): 2.0},
+        1: {(0, 'm2'): 3.0},
+    }
+    frame = fetch.get_frame(frame_dict, sindex, [0, 1], coeffs)
+    answer = np.zeros((2, 3))
+    answer[:, q] = [[5.0, 0, 2 * (0.5 * 1 + 1 * 2)], [0, 3.0, 0]]
+    np.testing.assert_array_almost_equal(frame, answer)
+
+
+def fake_fispact_output(calls):
+    def read_fispact_output(path):
+        calls.append(path)
+        v = float(path.parent.name[-1]) + 1
+        gamma = np.array([v, 2 * v])
+        return [10], np.array([0, 1, 2]), {(10, 'H1'): v}, \
+            {(10, 'H1'): 3 * v}, {10: gamma}
+    return read_fispact_output
+
+
+@pytest.mark.parametrize('delete, failures', [
+    (False, None), (True, None), (True, [{'input': 'inventory_2'}]),
+    (False, [{'input': 'inventory_1'}])
+])
+def test_output_collector(monkeypatch, tmp_path, delete, failures):
+    calls = []
+    read_output = fake_fispact_output(calls)
+    monkeypatch.setattr(fetch, 'read_fispact_output', read_output)
+    outputs = []
+    for i in range(2):
+        folder = tmp_path / 'case-{0}'.format(i)
+        folder.mkdir()
+        outputs.append(folder / 'inventory_1.out')
+        outputs[-1].write_text('output')
+    config = {
+        'index_output': {(0, 'c'): outputs[0], (1, 'c'): outputs[0], 
+                         (2, 'c'): outputs[1]},
+        'scales': {(1, 'c'): 0.5}
+    }
+    with fetch.OutputCollector(config, delete=delete) as collector:
+        collector.add_case(outputs[0].parent, failures)
+        collector.wait()
+        failed = {f['input'] for f in failures or []}
+        assert len(collector) == int('inventory_1' not in failed)
+        assert outputs[0].exists()
+        collector.finish()
+        assert len(collector) == 2
+        collector.save(tmp_path / 'collected.pkl')
+        assert outputs[0].exists() == (not delete or bool(failures))
+        assert collector.parsed() == set(outputs)
+    assert sorted(calls) == outputs
+    data = fetch.load_data(tmp_path / 'collected.pkl')
+    assert data['nuclides'] == {'H1'}
+    assert data['time_labels'] == [10]
+    assert data['activity'][10]['H1'] == {(0, 'c'): 3, (1, 'c'): 1.5, (2, 'c'): 6}
+    assert data['atoms'][10]['H1'] == {(0, 'c'): 1, (1, 'c'): 0.5, (2, 'c'): 2}
+    assert data['gamma'][10][1] == {(0, 'c'): 2, (1, 'c'): 1, (2, 'c'): 4}
+
+    with fetch.OutputCollector(config) as collector:
+        collector.load(tmp_path / 'collected.pkl')
+        outputs[1].write_text('new output')
+        os.utime(outputs[1], (1, 1))
+        collector.finish()
+    assert sorted(calls) == outputs + [outputs[1]]
+
+
+def test_output_collector_periodic_save(monkeypatch, tmp_path):
+    calls = []
+    monkeypatch.setattr(
+        fetch, 'read_fispact_output', fake_fispact_output(calls)
+    )
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    output = folder / 'inventory_1.out'
+    output.write_text('output')
+    config = {'index_output': {(0, 'c'): output}}
+    filename = tmp_path / 'collected.pkl'
+    with fetch.OutputCollector(
+            config, delete=True, filename=filename, save_period=0
+        ) as collector:
+        assert fetch.parsed_outputs(filename) == set()
+        collector.add_case(folder)
+        assert fetch.parsed_outputs(filename) == {output}
+        assert not output.exists()
+
+
+@pytest.mark.parametrize('parsers', [1, 2])
+def test_output_collector_error(tmp_path, parsers):
+    config = {'index_output': {(0, 'c'): tmp_path / 'inventory_1.out'}}
+    with fetch.OutputCollector(config, parsers=parsers) as collector:
+        with pytest.raises(FileNotFoundError):
+            collector.finish()
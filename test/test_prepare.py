@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import copy
+
 import pytest
+import numpy as np
 from mckit import Composition, read_mcnp
 from mckit.fmesh import RectMesh
 
-from r2s_rfda import prepare
+from r2s_rfda import prepare, template
+from r2s_rfda.cache import VolumeCache
 
 
 materials = [
@@ -12,6 +16,7 @@ materials = [
     'DENSITY 2.0000e+00\nFUEL 5\n  H1 1.3370e+26\n  H2 1.5377e+22\n  O16 6.6693e+25\n  O17 2.5405e+22\n  O18 1.3705e+23'
 ]
 
+
 @pytest.mark.parametrize('material, mass, density, mat_index', [
     (Composition(atomic=[('H', 2), ('O', 1)]), 2.e+3, 1.0, 0),
     (Composition(atomic=[('H', 2), ('O', 1)]), 2.e+3, 2.0, 1),
@@ -22,6 +27,16 @@ def test_material_description(material, mass, density, mat_index):
     assert result == answer
 
 
+def test_expanded_material():
+    mat = Composition(atomic=[('H', 2), ('O', 1)])
+    names, conc, molar_mass = prepare.expanded_material(mat)
+    assert names == ('H1', 'H2', 'O16', 'O17', 'O18')
+    assert np.sum(conc) == pytest.approx(1.0)
+    hits = prepare.expanded_material.cache_info().hits
+    prepare.expanded_material(Composition(atomic=[('H', 2), ('O', 1)]))
+    assert prepare.expanded_material.cache_info().hits == hits + 1
+
+
 @pytest.fixture
 def mesh():
     return RectMesh([2, 4, 6, 8, 10], [1, 3, 5], [0, 3])
@@ -37,14 +52,72 @@ def cells(model, mesh):
     return prepare.select_cells(model, mesh.bounding_box())
 
 
+@pytest.mark.parametrize('threads', [1, 2])
 @pytest.mark.parametrize('cell_names', [
     [1, 2, 10, 21]
 ])
-def test_select_cells(model, mesh, cell_names):
-    cells = prepare.select_cells(model, mesh.bounding_box())
+def test_select_cells(model, mesh, cell_names, threads):
+    cells = prepare.select_cells(model, mesh.bounding_box(), threads=threads)
     assert set(cell_names) == set(c.name() for c in cells)
 
 
+@pytest.mark.parametrize('threads', [1, 2])
+@pytest.mark.parametrize('answer', [
+    {
+        (1, 0, 1, 0): 3, (1, 1, 1, 0): 6, (1, 2, 1, 0): 3, (2, 1, 0, 0): 3,
+        (2, 1, 1, 0): 3, (2, 2, 0, 0): 3, (2, 2, 1, 0): 3, (10, 0, 0, 0): 3,
+        (10, 1, 0, 0): 1.5, (10, 0, 1, 0): 3, (10, 1, 1, 0): 1.5,
+        (21, 2, 0, 0): 1.047, (21, 2, 1, 0): 1.047, (21, 3, 0, 0): 1.047, 
+        (21, 3, 1, 0): 1.047
+    }
+])
+def test_calculate_volumes(cells, mesh, answer, threads):
+    volumes = prepare.calculate_volumes(
+        cells, mesh, min_volume=1.e-6, threads=threads
+    )
+    assert len(answer) == len(volumes)
+    for k, v in volumes.items():
+        assert v == pytest.approx(answer[k], 0.02)
+
+
+@pytest.mark.parametrize('answer', [
+    {
+        (1, 0, 1, 0): 3, (1, 1, 1, 0): 6, (1, 2, 1, 0): 3, (2, 1, 0, 0): 3,
+        (2, 1, 1, 0): 3, (2, 2, 0, 0): 3, (2, 2, 1, 0): 3, (10, 0, 0, 0): 3,
+        (10, 1, 0, 0): 1.5, (10, 0, 1, 0): 3, (10, 1, 1, 0): 1.5,
+        (21, 2, 0, 0): 1.047, (21, 2, 1, 0): 1.047, (21, 3, 0, 0): 1.047, 
+        (21, 3, 1, 0): 1.047
+    }
+])
+def test_calculate_volumes_stochastic(cells, mesh, answer):
+    errors = {}
+    volumes = prepare.calculate_volumes(
+        cells, mesh, min_volume=1.e-6, method='stochastic', rel_error=0.01,
+        errors=errors
+    )
+    assert set(answer.keys()) == set(volumes.keys())
+    for k, v in volumes.items():
+        assert v == pytest.approx(answer[k], abs=5 * errors.get(k, 0) + 1.e-9)
+        assert errors.get(k, 0) <= 0.01 * v * 1.001
+
+
+@pytest.mark.parametrize('hits, total, answer', [
+    ([0, 100, 2500], 10000, [0, np.sqrt(0.99 / 100), np.sqrt(0.75 / 2500)]),
+    ([10000], 10000, [0])
+])
+def test_sampling_errors(hits, total, answer):
+    result = prepare.sampling_errors(hits, total)
+    np.testing.assert_array_almost_equal(result, answer)
+
+
+def test_calculate_volumes_cache(cells, mesh, tmp_path):
+    with VolumeCache(tmp_path / 'volumes.db') as cache:
+        volumes = prepare.calculate_volumes(cells, mesh, 1.e-6, cache=cache)
+        assert len(cache) > 0
+        cached = prepare.calculate_volumes(cells, mesh, 1.e-6, cache=cache)
+    assert cached == volumes
+
+
 @pytest.mark.parametrize('answer', [
     {
         (1, 0, 1, 0): 3, (1, 1, 1, 0): 6, (1, 2, 1, 0): 3, (2, 1, 0, 0): 3,
@@ -54,11 +127,98 @@ def test_select_cells(model, mesh, cell_names):
         (21, 3, 1, 0): 1.047
     }
 ])
-def test_calculate_volumes(cells, mesh, answer):
-    volumes = prepare.calculate_volumes(cells, mesh, min_volume=1.e-6)
+def test_calculate_volumes_checkpoint(cells, mesh, tmp_path, monkeypatch, 
+                                      answer):
+    checkpoint = tmp_path / 'checkpoint'
+    volumes = prepare.calculate_volumes(
+        cells, mesh, 1.e-6, checkpoint=checkpoint
+    )
+    voxel_cells, _ = prepare.select_voxel_cells(cells, mesh)
+    slabs = {i for i, j, k in voxel_cells.keys()}
+    assert len(list(checkpoint.glob('slab-*.pkl'))) == len(slabs)
     assert len(answer) == len(volumes)
     for k, v in volumes.items():
         assert v == pytest.approx(answer[k], 0.02)
+    calls = []
+    chunk_volumes = prepare.chunk_volumes
+
+    def counted(*args):
+        calls.append(args)
+        return chunk_volumes(*args)
+
+    monkeypatch.setattr(prepare, 'chunk_volumes', counted)
+    resumed = prepare.calculate_volumes(
+        cells, mesh, 1.e-6, checkpoint=checkpoint
+    )
+    assert calls == []
+    assert resumed == volumes
+
+
+def test_calculate_volumes_checkpoint_cache(cells, mesh, tmp_path):
+    volumes = prepare.calculate_volumes(cells, mesh, 1.e-6)
+    checkpoint = tmp_path / 'checkpoint'
+    with VolumeCache(tmp_path / 'volumes.db') as cache:
+        prepare.calculate_volumes(cells[:2], mesh, 1.e-6, cache=cache)
+        partial = prepare.calculate_volumes(
+            cells, mesh, 1.e-6, cache=cache, checkpoint=checkpoint
+        )
+        resumed = prepare.calculate_volumes(
+            cells, mesh, 1.e-6, cache=cache, checkpoint=checkpoint
+        )
+    assert partial == pytest.approx(volumes)
+    assert resumed == pytest.approx(volumes)
+
+
+@pytest.mark.parametrize('header, other, data', [
+    ({'min_volume': 1.e-3}, {'min_volume': 1.e-4}, {(0, 1, 0, 0): 1.5})
+])
+def test_checkpoint(tmp_path, header, other, data):
+    prepare.save_checkpoint(tmp_path, 1, header, data)
+    assert prepare.load_checkpoint(tmp_path, header) == {1: data}
+    assert prepare.load_checkpoint(tmp_path, other) == {}
+
+
+@pytest.mark.parametrize('answer', [
+    {
+        (1, 0, 1, 0), (1, 1, 1, 0), (1, 2, 1, 0), (2, 1, 0, 0), (2, 1, 1, 0),
+        (2, 2, 0, 0), (2, 2, 1, 0), (10, 0, 0, 0), (10, 1, 0, 0), 
+        (10, 0, 1, 0), (10, 1, 1, 0), (21, 2, 0, 0), (21, 2, 1, 0), 
+        (21, 3, 0, 0), (21, 3, 1, 0)
+    }
+])
+def test_select_voxel_cells(cells, mesh, answer):
+    voxel_cells, filled = prepare.select_voxel_cells(cells, mesh)
+    assert not set(voxel_cells.keys()).intersection(filled.keys())
+    selected = set()
+    for (i, j, k), candidates in voxel_cells.items():
+        for q in candidates:
+            selected.add((cells[q].name(), i, j, k))
+    for (i, j, k), q in filled.items():
+        selected.add((cells[q].name(), i, j, k))
+    assert answer.issubset(selected)
+
+
+@pytest.mark.parametrize('block, center, dims', [
+    ((0, 1, 0, 1, 0, 1), [3, 2, 1.5], [2, 2, 3]),
+    ((0, 4, 0, 2, 0, 1), [6, 3, 1.5], [8, 4, 3]),
+    ((1, 3, 1, 2, 0, 1), [6, 4, 1.5], [4, 2, 3])
+])
+def test_block_box(mesh, block, center, dims):
+    box = prepare.block_box(mesh, *block)
+    np.testing.assert_array_almost_equal(box.center, center)
+    np.testing.assert_array_almost_equal(box.dimensions, dims)
+
+
+@pytest.mark.parametrize('block, center, dims', [
+    ((0, 2, 0, 1, 0, 1), [2, 1, 1.5], [4, 2, 3]),
+    ((0, 3, 0, 2, 0, 2), [5, 2.5, 4], [10, 5, 8]),
+    ((1, 3, 1, 2, 1, 2), [7, 3.5, 5.5], [6, 3, 5])
+])
+def test_block_box_nonuniform(block, center, dims):
+    mesh = RectMesh([0, 1, 4, 10], [0, 2, 5], [0, 3, 8])
+    box = prepare.block_box(mesh, *block)
+    np.testing.assert_array_almost_equal(box.center, center)
+    np.testing.assert_array_almost_equal(box.dimensions, dims)
 
 
 @pytest.mark.parametrize('answer', [
@@ -89,6 +249,155 @@ def test_get_masses(vol_dict, den_dict, answer):
     assert answer == pytest.approx(masses, 1.e-3)
 
 
+@pytest.mark.parametrize('bins1, bins2, answer', [
+    (([2, 4, 6], [1, 3], [0, 3]), ([2, 4, 6], [1, 3], [0, 3]), True),
+    (([2, 4, 6], [1, 3], [0, 3]), ([2, 4, 7], [1, 3], [0, 3]), False),
+    (([2, 4, 6], [1, 3], [0, 3]), ([2, 4], [1, 3], [0, 3]), False)
+])
+def test_same_mesh(bins1, bins2, answer):
+    assert prepare.same_mesh(RectMesh(*bins1), RectMesh(*bins2)) == answer
+
+
+def test_update_file(tmp_path):
+    filename = tmp_path / 'files'
+    assert prepare.update_file(filename, 'text')
+    assert not prepare.update_file(filename, 'text')
+    assert prepare.update_file(filename, 'new text')
+    assert filename.read_text() == 'new text'
+
+
+@pytest.fixture
+def case_folder(tmp_path):
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    for name in [
+        'files', 'arb_flux', 'collapse.i', 'collapse.out', 'COLLAPX', 
+        'inventory_1.i', 'inventory_1.out', 'inventory_1.log', 
+        'inventory_2.i', 'inventory_2.out'
+    ]:
+        (folder / name).write_text('')
+    return folder
+
+
+@pytest.mark.parametrize('name, answer', [
+    (None, {'files', 'arb_flux', 'collapse.i', 'inventory_1.i', 'inventory_2.i'}),
+    ('inventory_1', {
+        'files', 'arb_flux', 'collapse.i', 'collapse.out', 'COLLAPX', 
+        'inventory_1.i', 'inventory_2.i', 'inventory_2.out'
+    })
+])
+def test_remove_outputs(case_folder, name, answer):
+    prepare.remove_outputs(case_folder, name)
+    assert {f.name for f in case_folder.iterdir()} == answer
+
+
+def test_remove_stale_tasks(tmp_path, case_folder):
+    (tmp_path / 'case-1').mkdir()
+    (tmp_path / 'scratch').mkdir()
+    (tmp_path / 'case-2.txt').write_text('')
+    (tmp_path / 'run.state').write_text('')
+    prepare.remove_stale_tasks(tmp_path, [(case_folder, ['inventory_2'])])
+    assert {f.name for f in tmp_path.iterdir()} == \
+        {'case-0', 'scratch', 'case-2.txt', 'run.state'}
+    assert not (case_folder / 'inventory_1.i').exists()
+    assert (case_folder / 'inventory_2.out').exists()
+
+
+def test_pending_tasks(case_folder):
+    (case_folder / 'inventory_2.out').unlink()
+    task_list = [(case_folder, ['collapse', 'inventory_1', 'inventory_2'])]
+    assert prepare.pending_tasks(task_list) == [(case_folder, ['inventory_2'])]
+    (case_folder / 'COLLAPX').unlink()
+    assert prepare.pending_tasks(task_list) == task_list
+    (case_folder / 'COLLAPX').write_text('')
+    (case_folder / 'collapse.out').unlink()
+    assert prepare.pending_tasks(task_list) == task_list
+
+
+def test_prepare_condense(tmp_path):
+    templates = template.TemplateSet(
+        'files', 'collapse', '{material}', [], condense='condense'
+    )
+    folder = prepare.prepare_condense(tmp_path, templates)
+    assert (folder / 'condense.i').read_text() == 'condense'
+    (folder / 'condense.out').write_text('')
+    prepare.prepare_condense(tmp_path, templates)
+    assert (folder / 'condense.out').exists()
+    templates = template.TemplateSet(
+        'files', 'collapse', '{material}', [], condense='other'
+    )
+    prepare.prepare_condense(tmp_path, templates)
+    assert not (folder / 'condense.out').exists()
+
+
+@pytest.fixture
+def specs(tmp_path):
+    templates = template.TemplateSet(
+        'files', 'collapse', 'FLUX {0}\n{material}', [1.0]
+    )
+    specs = prepare.new_specs(np.array([0, 1, 2]), templates, deferred=True)
+    mat = Composition(atomic=[('H', 2), ('O', 1)])
+    for name, spectrum in [('case-0', [1, 0]), ('case-1', [0, 2])]:
+        task_item = prepare.prepare_folder(
+            tmp_path, templates, name, specs['ebins'], spectrum, specs=specs
+        )
+        prepare.add_inventory_case(
+            task_item, templates, 'inventory_1', 1.0, mat, 2.e+3, specs=specs
+        )
+        prepare.add_inventory_case(
+            task_item, templates, 'inventory_2', 1.0, mat, 2.e+3, 
+            density=2.0, specs=specs
+        )
+    prepare.finish_specs(specs)
+    return specs
+
+
+def test_deferred_specs(tmp_path, specs):
+    assert list(tmp_path.iterdir()) == []
+    assert len(specs['materials']) == 1
+    np.testing.assert_array_equal(specs['spectra'], [[1, 0], [0, 2]])
+    assert specs['cases']['case-1'] == (1, {
+        'inventory_1': (1.0, 0, 2.e+3, 1.0), 
+        'inventory_2': (1.0, 0, 2.e+3, 2.0)
+    })
+
+
+@pytest.mark.parametrize('cases, answer', [
+    (['collapse', 'inventory_1'], 
+     {'files', 'collapse.i', 'arb_flux', 'inventory_1.i'}),
+    (['inventory_2'], {'files', 'inventory_2.i'}),
+])
+def test_write_case_inputs(tmp_path, specs, cases, answer):
+    folder = tmp_path / 'case-1'
+    filenames = prepare.write_case_inputs(folder, cases, specs)
+    assert {f.name for f in filenames} == answer
+    assert {f.name for f in folder.iterdir()} == answer
+    if 'inventory_2' in cases:
+        text = (folder / 'inventory_2.i').read_text()
+        assert text == 'FLUX 1.0000e+00\n' + materials[1]
+
+
+@pytest.mark.parametrize('change, answer', [
+    (lambda s: None, {'collapse.out', 'inventory_1.out', 'inventory_2.out'}),
+    (lambda s: s['cases']['case-0'][1].update(
+        {'inventory_1': (2.0, 0, 2.e+3, 1.0)}
+    ), {'collapse.out', 'inventory_2.out'}),
+    (lambda s: s['spectra'].__setitem__(0, [1, 1]), set()),
+    (lambda s: s.update({'templates': template.TemplateSet(
+        'other', 'collapse', 'FLUX {0}\n{material}', [1.0]
+    )}), set()),
+])
+def test_remove_changed_outputs(tmp_path, specs, change, answer):
+    previous = copy.deepcopy(specs)
+    change(specs)
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    for name in ['collapse.out', 'inventory_1.out', 'inventory_2.out']:
+        (folder / name).write_text('')
+    prepare.remove_changed_outputs(tmp_path, specs, previous)
+    assert {f.name for f in folder.iterdir()} == answer
+
+
 # @pytest.mark.skip
 # @pytest.mark.parametrize('clabs, mlabs, matdict, answer', [
 #     (
@@ -111,3 +420,68 @@ def test_get_masses(vol_dict, den_dict, answer):
 #     assert result.data.nnz == len(answer[2])
 #     for index, value in answer[2].items():
 #         assert value == result.data[index]
+
+
+@pytest.mark.parametrize('masses, fraction, threshold, answer', [
+    ({(1, 0, 0, 0): 1, (2, 1, 0, 0): 1, (3, 1, 0, 0): 4}, 0.9, None,
+     {(3, 1, 0, 0), (2, 1, 0, 0)}),
+    ({(1, 0, 0, 0): 1, (2, 1, 0, 0): 1, (3, 1, 0, 0): 4}, 0.5, None,
+     {(3, 1, 0, 0)}),
+    ({(1, 0, 0, 0): 1, (2, 1, 0, 0): 1, (3, 1, 0, 0): 4}, 1.0, None,
+     {(1, 0, 0, 0), (2, 1, 0, 0), (3, 1, 0, 0)}),
+    ({(1, 0, 0, 0): 1, (2, 1, 0, 0): 1, (3, 1, 0, 0): 4}, 0, None, set()),
+    ({(1, 0, 0, 0): 1, (2, 1, 0, 0): 1, (3, 1, 0, 0): 4}, None, 0.2,
+     {(3, 1, 0, 0), (2, 1, 0, 0)}),
+    ({(1, 0, 0, 0): 1, (4, 0, 1, 0): 5}, 1.0, None, {(1, 0, 0, 0)}),
+    ({}, 0.9, None, set()),
+])
+def test_select_important(masses, fraction, threshold, answer):
+    fluxes = np.array([[[1.0], [0.0]], [[2.0], [0.0]]])
+    result = prepare.select_important(
+        masses, fluxes, fraction=fraction, threshold=threshold
+    )
+    assert result == answer
+
+
+
+def test_select_important_no_criterion():
+    with pytest.raises(ValueError):
+        prepare.select_important({(1, 0, 0, 0): 1}, np.ones((1, 1, 1)))
+
+
+@pytest.mark.parametrize('fdata, indices', [
+    (np.zeros((2, 2, 1, 1)), [(1, 0, 0, 0), (2, 1, 0, 0)]),
+    (np.array([[[[1.0]], [[0.0]]], [[[1.0]], [[0.0]]]]), [(2, 1, 0, 0)]),
+    (np.ones((2, 2, 1, 1)), []),
+])
+def test_cluster_voxel_spectra_no_flux(fdata, indices):
+    with pytest.raises(ValueError):
+        prepare.cluster_voxel_spectra(fdata, indices, n_clusters=2)
+
+@pytest.mark.parametrize('deferred', [True, False])
+def test_change_scenario(tmp_path, deferred):
+    templates = template.TemplateSet('files', 'collapse', 'FLUX {0}\n{material}', [1.0])
+    specs = prepare.new_specs(np.array([0, 1, 2]), templates, deferred=deferred)
+    task_item = prepare.prepare_folder(
+        tmp_path, templates, 'case-0', specs['ebins'], [1, 0], specs=specs
+    )
+    prepare.add_inventory_case(
+        task_item, templates, 'inventory_1', 1.0, 
+        Composition(atomic=[('H', 2), ('O', 1)]), 2.e+3, specs=specs
+    )
+    prepare.finish_specs(specs)
+    folder = tmp_path / 'case-0'
+    folder.mkdir(exist_ok=True)
+    for name in ['collapse.out', 'COLLAPX', 'inventory_1.out']:
+        (folder / name).write_text('')
+
+    assert prepare.change_scenario(tmp_path, specs, templates) == 0
+    new_templates = templates.replace_scenario('FLUX 2.0\n{material}', 1.0)
+    assert prepare.change_scenario(tmp_path, specs, new_templates) == 1
+    assert specs['templates'] == new_templates
+    assert (folder / 'collapse.out').exists()
+    assert (folder / 'COLLAPX').exists()
+    assert not (folder / 'inventory_1.out').exists()
+    if not deferred:
+        text = (folder / 'inventory_1.i').read_text()
+        assert text == 'FLUX 2.0000e+00\n' + materials[0]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from r2s_rfda import report
+
+
+def record(case, input_file, start, wall, status='ok', cpu=None, rss=None):
+    return {
+        'case': case, 'input': input_file, 'start': start, 'wall': wall,
+        'cpu': cpu, 'rss': rss, 'status': status
+    }
+
+
+@pytest.fixture
+def metrics_folder(tmp_path):
+    lines = {
+        'metrics.jsonl': [
+            {'run': 0, 'threads': 1, 'host': 'a'},
+            record('case-0', 'collapse', 0, 5),
+            {'run': 100, 'threads': 2, 'host': 'a'},
+            record('case-0', 'collapse', 100, 2, cpu=1.5, rss=2048),
+            record('case-0', 'inventory_1', 102, 8, cpu=7.0, rss=1024),
+            record('case-1', 'collapse', 100, 4, status='fispact'),
+        ],
+        'metrics-w0.jsonl': [
+            {'run': 10, 'threads': 3, 'host': 'c'},
+            record('case-3', 'inventory_1', 10, 3),
+        ],
+        'metrics-w1.jsonl': [
+            {'run': 101, 'threads': 2, 'host': 'b'},
+            record('case-2', 'inventory_1', 101, 9),
+        ],
+    }
+    for name, items in lines.items():
+        with open(tmp_path / name, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+    return tmp_path
+
+
+@pytest.mark.parametrize('all_runs, n_runs, n_records', [
+    (False, 2, 4), (True, 4, 6)
+])
+def test_load_metrics(metrics_folder, all_runs, n_runs, n_records):
+    runs, records = report.load_metrics(metrics_folder, all_runs=all_runs)
+    assert len(runs) == n_runs
+    assert len(records) == n_records
+
+
+def test_summarize(metrics_folder):
+    runs, records = report.load_metrics(metrics_folder)
+    summary = report.summarize(runs, records, top=2, bins=5)
+    assert summary['inputs'] == 4
+    assert summary['status'] == {'ok': 3, 'fispact': 1}
+    assert summary['span'] == pytest.approx(10)
+    assert summary['threads'] == 4
+    assert summary['throughput'] == pytest.approx(3 / 10 * 3600)
+    assert summary['kinds']['collapse'] == \
+        {'count': 2, 'wall': 6, 'cpu': 1.5}
+    assert summary['kinds']['inventory'] == \
+        {'count': 2, 'wall': 17, 'cpu': 7.0}
+    assert summary['cases'] == [('case-0', 10, 2), ('case-2', 9, 1)]
+    assert [r['case'] for r in summary['slowest']] == ['case-2', 'case-0']
+    assert summary['peak_rss'] == 2048
+    busy = [b for _, b, _ in summary['timeline']]
+    assert busy == pytest.approx([2.5, 3, 2, 2, 2])
+    assert sum(busy) * 2 == pytest.approx(2 + 8 + 4 + 9)
+    text = report.format_report(summary)
+    assert 'case-2' in text
+
+
+@pytest.mark.parametrize('runs, answer', [
+    ([{'run': 0, 'end': 5, 'threads': 2}, {'run': 5, 'end': 9, 'threads': 3}],
+     3),
+    ([{'run': 0, 'end': 5, 'threads': 2}, {'run': 4, 'end': 9, 'threads': 3}],
+     5),
+    ([{'run': 0, 'threads': 2}, {'run': 10, 'end': 12}], 3),
+    ([], 0),
+])
+def test_max_threads(runs, answer):
+    assert report.max_threads(runs) == answer
+
+
+def test_summarize_all_runs(metrics_folder):
+    runs, records = report.load_metrics(metrics_folder, all_runs=True)
+    summary = report.summarize(runs, records)
+    assert summary['inputs'] == 6
+    assert summary['threads'] == 4
+
+
+def test_empty_report(tmp_path):
+    runs, records = report.load_metrics(tmp_path)
+    summary = report.summarize(runs, records)
+    assert report.format_report(summary) == 'No FISPACT runs are recorded.'
+
+
+def test_report_without_usage():
+    runs = [{'run': 0, 'end': 5, 'threads': 2}]
+    records = [
+        record('case-0', 'collapse', 0, 2),
+        record('case-0', 'inventory_1', 2, 3),
+    ]
+    summary = report.summarize(runs, records)
+    assert summary['kinds']['collapse']['cpu'] is None
+    assert summary['kinds']['inventory']['cpu'] is None
+    assert summary['peak_rss'] is None
+    text = report.format_report(summary)
+    assert 'Peak RSS:      n/a' in text
+    assert text.count('n/a') == 3
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import subprocess
+import threading
+
+import pytest
+
+from r2s_rfda import run
+from r2s_rfda.workqueue import WorkQueue
+
+
+@pytest.mark.parametrize('existing', [None, 'file', 'link'])
+def test_share_file(tmp_path, existing):
+    source = tmp_path / 'condense' / 'ARRAYX'
+    source.parent.mkdir()
+    source.write_text('decay data')
+    target = tmp_path / 'case-0' / 'ARRAYX'
+    target.parent.mkdir()
+    if existing == 'file':
+        target.write_text('old data')
+    elif existing == 'link':
+        target.symlink_to(tmp_path / 'missing')
+    run.share_file(source, target)
+    assert target.read_text() == 'decay data'
+
+
+@pytest.fixture
+def case_folder(tmp_path):
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    for name in ['collapse.i', 'inventory_1.i', 'inventory_2.i']:
+        (folder / name).write_text('input')
+    (folder / 'collapse.out').write_text('collapse done')
+    (folder / 'inventory_1.out').write_text('inventory done')
+    (folder / 'inventory_2.out').write_text(
+        'output\n  run  terminated by fatal error\n'
+    )
+    (folder / 'inventory_3.out').write_text('output cut by walltime')
+    (folder / 'COLLAPX').write_text('cross sections')
+    for name in ['collapse', 'inventory_1']:
+        (folder / (name + '.done')).write_text('')
+    return folder
+
+
+@pytest.mark.parametrize('name, touch_input, answer', [
+    ('collapse', False, True),
+    ('collapse', True, False),
+    ('inventory_1', False, True),
+    ('inventory_2', False, False),
+    ('inventory_3', False, False),
+    ('inventory_4', False, False),
+])
+def test_is_completed(case_folder, name, touch_input, answer):
+    if touch_input:
+        os.utime(case_folder / (name + '.i'), (2.e+9, 2.e+9))
+    assert run.is_completed(case_folder, name) == answer
+
+
+def test_remaining_tasks(case_folder):
+    tasks = ['collapse', 'inventory_1', 'inventory_2']
+    assert run.remaining_tasks([(case_folder, tasks)]) == \
+        [(case_folder, ['inventory_2'])]
+    (case_folder / 'COLLAPX').unlink()
+    assert run.remaining_tasks([(case_folder, tasks)]) == \
+        [(case_folder, tasks)]
+    (case_folder / 'COLLAPX').write_text('cross sections')
+    (case_folder / 'collapse.out').write_text('')
+    assert run.remaining_tasks([(case_folder, tasks)]) == \
+        [(case_folder, tasks)]
+    (case_folder / 'inventory_2.out').write_text('ok')
+    assert run.remaining_tasks([(case_folder, ['inventory_2'])]) == \
+        [(case_folder, ['inventory_2'])]
+    (case_folder / 'inventory_2.done').write_text('')
+    assert run.remaining_tasks([(case_folder, ['inventory_2'])]) == []
+
+
+def test_remaining_tasks_collected(case_folder):
+    tasks = ['collapse', 'inventory_1', 'inventory_2']
+    (case_folder / 'inventory_1.out').unlink()
+    collected = {case_folder / 'inventory_1.out'}
+    assert run.remaining_tasks([(case_folder, tasks)], collected) == \
+        [(case_folder, ['inventory_2'])]
+    collected.add(case_folder / 'inventory_2.out')
+    assert run.remaining_tasks([(case_folder, tasks)], collected) == []
+    (case_folder / 'COLLAPX').unlink()
+    assert run.remaining_tasks([(case_folder, tasks)], collected) == []
+    collected.remove(case_folder / 'inventory_2.out')
+    assert run.remaining_tasks([(case_folder, tasks)], collected) == \
+        [(case_folder, ['collapse', 'inventory_2'])]
+
+
+def test_run_state(tmp_path):
+    filename = tmp_path / 'run.state'
+    with run.RunState(filename) as state:
+        state.record('case-0', run.FispactError('terminated'))
+        state.record('case-1', run.FispactError('terminated'))
+        state.record('case-2')
+    with run.RunState(filename) as state:
+        assert len(state) == 3
+        assert state.failed() == {'case-0': 'terminated', 'case-1': 'terminated'}
+        state.record('case-1')
+    with run.RunState(filename) as state:
+        assert state.failed() == {'case-0': 'terminated'}
+
+
+def fake_fispact(errors):
+    calls = []
+
+    def run_fispact(input_file, files='files', cwd=None, verbose=False,
+                    usage=None):
+        calls.append((cwd.name, input_file))
+        error = errors.get((cwd.name, input_file))
+        if error:
+            raise error.pop(0) if isinstance(error, list) else error
+        (cwd / (input_file + '.out')).write_text('ok')
+        run.completion_marker(cwd, input_file).write_text('')
+        return 'ok'
+    return run_fispact, calls
+
+
+@pytest.mark.parametrize('errors, retries, answer', [
+    ({}, 0, []),
+    ({('case-0', 'inventory_1'): run.FispactError('terminated')}, 2,
+     [('inventory_1', 'fispact', 1)]),
+    ({('case-0', 'inventory_1'): [OSError('crash')]}, 1, []),
+    ({('case-0', 'inventory_1'): [OSError('crash'), OSError('crash')]}, 1,
+     [('inventory_1', 'process', 2)]),
+    ({('case-0', 'collapse'): run.FispactError('terminated')}, 0,
+     [('collapse', 'fispact', 1), ('inventory_1', 'skipped', 0),
+      ('inventory_2', 'skipped', 0)]),
+])
+def test_run_case(monkeypatch, tmp_path, errors, retries, answer):
+    run_fispact, calls = fake_fispact(errors)
+    monkeypatch.setattr(run, 'run_fispact', run_fispact)
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    tasks = ['collapse', 'inventory_1', 'inventory_2']
+    failures = run.run_case((folder, tasks), retries=retries)
+    assert [(f['input'], f['kind'], f['attempts']) for f in failures] == answer
+    if not answer:
+        assert all((folder / (t + '.out')).exists() for t in tasks)
+    else:
+        assert (folder / 'inventory_2.out').exists() == (answer[0][0] != 'collapse')
+
+
+@pytest.mark.parametrize('scheduled', [False, True])
+def test_share_arrayx(monkeypatch, tmp_path, scheduled):
+    run_fispact, calls = fake_fispact({})
+    monkeypatch.setattr(run, 'run_fispact', run_fispact)
+    condense = tmp_path / 'condense'
+    condense.mkdir()
+    (condense / 'ARRAYX').write_text('decay')
+    run.completion_marker(condense, 'condense').write_text('')
+    (condense / 'condense.out').write_text('ok')
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    task_list = [(folder, ['inventory_1'])]
+    if scheduled:
+        run.run_tasks(task_list, condense=condense)
+    else:
+        run.run_case(task_list[0], condense=condense)
+    assert (folder / 'ARRAYX').read_text() == 'decay'
+
+
+@pytest.mark.parametrize('fail_fast', [False, True])
+def test_run_tasks(monkeypatch, tmp_path, fail_fast):
+    errors = {('case-0', 'collapse'): run.FispactError('terminated')}
+    run_fispact, calls = fake_fispact(errors)
+    monkeypatch.setattr(run, 'run_fispact', run_fispact)
+    task_list = []
+    for i in range(5):
+        folder = tmp_path / 'case-{0}'.format(i)
+        folder.mkdir()
+        task_list.append((folder, ['collapse', 'inventory_1']))
+    with run.RunState(tmp_path / 'run.state') as state:
+        failures = run.run_tasks(task_list, state=state, fail_fast=fail_fast)
+        failed = state.failed()
+    assert failures[0]['case'] == 'case-0'
+    assert list(failed.keys()) == ['case-0']
+    if fail_fast:
+        assert {f['kind'] for f in failures[2:]} <= {'cancelled'}
+    else:
+        assert len(failures) == 2
+        assert len(calls) == 9
+
+
+def test_run_tasks_condense_failed(tmp_path, fispact_script):
+    condense = tmp_path / 'condense'
+    condense.mkdir()
+    (condense / 'fail_condense').write_text('')
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    with run.MetricsLog(tmp_path / 'metrics.jsonl') as metrics:
+        failures = run.run_tasks(
+            [(folder, ['collapse'])], condense=condense, metrics=metrics
+        )
+    assert [(f['case'], f['input'], f['kind']) for f in failures] == \
+        [('condense', 'condense', 'fispact')]
+    assert not (folder / 'runs').exists()
+    with open(tmp_path / 'metrics.jsonl') as f:
+        assert json.loads(f.readlines()[-1])['status'] == 'fispact'
+
+
+@pytest.mark.parametrize('timings, sizes, answer', [
+    ({}, None, {('a', 'collapse'): 1.0, ('a', 'inv_1'): 1.0, ('b', 'inv_1'): 1.0}),
+    ({('a', 'collapse'): 4.0, ('c', 'inv_1'): 2.0}, None,
+     {('a', 'collapse'): 4.0, ('a', 'inv_1'): 2.0, ('b', 'inv_1'): 2.0}),
+    ({('a', 'inv_1'): 3.0}, {('a', 'inv_1'): 10, ('b', 'inv_1'): 30},
+     {('a', 'collapse'): 1.0, ('a', 'inv_1'): 3.0, ('b', 'inv_1'): 4.5}),
+])
+def test_estimate_costs(tmp_path, timings, sizes, answer):
+    task_list = [
+        (tmp_path / 'a', ['collapse', 'inv_1']), (tmp_path / 'b', ['inv_1'])
+    ]
+    costs = run.estimate_costs(task_list, timings=timings, sizes=sizes)
+    assert costs == pytest.approx(answer)
+
+
+def test_scheduler_order(monkeypatch, tmp_path):
+    run_fispact, calls = fake_fispact({})
+    monkeypatch.setattr(run, 'run_fispact', run_fispact)
+    task_list = []
+    for name, tasks in [
+        ('small', ['collapse', 'inv_1']), ('single', ['inv_1']),
+        ('large', ['collapse', 'inv_1', 'inv_2', 'inv_3'])
+    ]:
+        (tmp_path / name).mkdir()
+        task_list.append((tmp_path / name, tasks))
+    costs = run.estimate_costs(task_list, sizes={('single', 'inv_1'): 3.5})
+    failures = run.Scheduler(task_list, costs).run(1)
+    assert failures == []
+    assert calls[0] == ('large', 'collapse')
+    assert [c[0] for c in calls] == ['large'] * 4 + ['small'] * 2 + ['single']
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_scheduler_finishes_cases(monkeypatch, tmp_path, threads):
+    run_fispact, calls = fake_fispact({})
+    monkeypatch.setattr(run, 'run_fispact', run_fispact)
+    task_list = []
+    for i in range(6):
+        folder = tmp_path / 'case-{0}'.format(i)
+        folder.mkdir()
+        task_list.append((folder, ['collapse', 'inv_1', 'inv_2']))
+    finished = []
+    scheduler = run.Scheduler(
+        task_list, run.estimate_costs(task_list), 
+        on_case=lambda cwd, f: finished.append(len(calls))
+    )
+    assert scheduler.run(threads) == []
+    assert len(calls) == 18
+    # At most one case per worker is in progress at any time.
+    for n, done in enumerate(finished):
+        assert done <= 3 * (n + threads)
+
+
+def test_scheduler_status(monkeypatch, tmp_path):
+    errors = {('case-0', 'collapse'): run.FispactError('terminated')}
+    run_fispact, calls = fake_fispact(errors)
+    monkeypatch.setattr(run, 'run_fispact', run_fispact)
+    task_list = []
+    for i in range(3):
+        (tmp_path / 'case-{0}'.format(i)).mkdir()
+        task_list.append(
+            (tmp_path / 'case-{0}'.format(i), ['collapse', 'inv_1', 'inv_2'])
+        )
+    scheduler = run.Scheduler(task_list, run.estimate_costs(task_list))
+    assert len(scheduler.run(2, progress=True)) == 3
+    assert scheduler._status() == 'running 0, failed 3'
+
+
+def test_run_state_timings(tmp_path):
+    filename = tmp_path / 'run.state'
+    with run.RunState(filename) as state:
+        state.record_time('case-0', 'collapse', 2.0)
+        state.record_time('case-0', 'collapse', 3.0)
+        state.record('case-0')
+    with run.RunState(filename) as state:
+        assert state.timings() == {('case-0', 'collapse'): 3.0}
+        assert state.failed() == {}
+
+
+@pytest.fixture
+def fispact_script(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'fispact'
+    script.write_text(
+        '#!/bin/sh\n'
+        'echo "start $1"\n'
+        'echo $1 >> runs\n'
+        'if [ -e fail_$1 ]; then echo " run  terminated"; exit 0; fi\n'
+        'if [ -e crash_$1 ]; then exit 3; fi\n'
+        'if [ -e kill_$1 ]; then kill -9 $$; fi\n'
+        'echo ok > $1.out\n'
+        'echo log > $1.log\n'
+        'if [ "$1" = collapse ]; then echo x > COLLAPX; fi\n'
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    return script
+
+
+def _run_sync(*args, **kwargs):
+    run.run_fispact(*args, **kwargs)
+
+
+def _run_async(*args, **kwargs):
+    asyncio.run(run.run_fispact_async(*args, **kwargs))
+
+
+@pytest.mark.parametrize('runner', [_run_sync, _run_async])
+@pytest.mark.parametrize('flag, error', [
+    (None, None), ('fail', run.FispactError), 
+    ('crash', subprocess.CalledProcessError)
+])
+def test_run_fispact_stdout(tmp_path, fispact_script, runner, flag, error):
+    if flag:
+        (tmp_path / '{0}_collapse'.format(flag)).write_text('')
+    if error:
+        with pytest.raises(error):
+            runner('collapse', cwd=tmp_path)
+    else:
+        runner('collapse', cwd=tmp_path)
+        assert (tmp_path / 'collapse.out').exists()
+    assert (tmp_path / 'collapse.stdout').read_text().startswith(
+        'start collapse'
+    )
+
+
+@pytest.mark.parametrize('flag, returncode', [('crash', 3), ('kill', -9)])
+def test_run_fispact_returncode(tmp_path, fispact_script, flag, returncode):
+    (tmp_path / '{0}_collapse'.format(flag)).write_text('')
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        run.run_fispact('collapse', cwd=tmp_path)
+    assert error.value.returncode == returncode
+
+
+@pytest.mark.parametrize('backend', ['sync', 'asyncio'])
+@pytest.mark.parametrize('flag', [None, 'fail', 'crash'])
+def test_completion_marker(tmp_path, fispact_script, backend, flag):
+    (tmp_path / 'collapse.done').write_text('')
+    if flag:
+        (tmp_path / '{0}_collapse'.format(flag)).write_text('')
+    try:
+        if backend == 'sync':
+            run.run_fispact('collapse', cwd=tmp_path)
+        else:
+            asyncio.run(run.run_fispact_async('collapse', cwd=tmp_path))
+    except (run.FispactError, subprocess.CalledProcessError):
+        pass
+    assert (tmp_path / 'collapse.done').exists() == (flag is None)
+    assert run.is_completed(tmp_path, 'collapse') == (flag is None)
+
+
+@pytest.mark.parametrize('threads', [1, 3])
+def test_run_tasks_asyncio(tmp_path, fispact_script, threads):
+    task_list = []
+    for i in range(4):
+        folder = tmp_path / 'case-{0}'.format(i)
+        folder.mkdir()
+        task_list.append((folder, ['collapse', 'inventory_1', 'inventory_2']))
+    (tmp_path / 'case-0' / 'fail_collapse').write_text('')
+    (tmp_path / 'case-1' / 'crash_inventory_2').write_text('')
+    with run.RunState(tmp_path / 'run.state') as state:
+        failures = run.run_tasks(
+            task_list, threads=threads, state=state, backend='asyncio'
+        )
+        failed = state.failed()
+        assert len(state.timings()) == 8
+    answer = {
+        ('case-0', 'collapse', 'fispact'), ('case-0', 'inventory_1', 'skipped'),
+        ('case-0', 'inventory_2', 'skipped'), 
+        ('case-1', 'inventory_2', 'process')
+    }
+    assert {(f['case'], f['input'], f['kind']) for f in failures} == answer
+    assert set(failed.keys()) == {'case-0', 'case-1'}
+    assert all(
+        (tmp_path / 'case-{0}'.format(i) / 'inventory_2.out').exists()
+        for i in (2, 3)
+    )
+
+
+def test_run_worker(tmp_path, fispact_script):
+    task_list = []
+    for i in range(6):
+        folder = tmp_path / 'case-{0}'.format(i)
+        folder.mkdir()
+        task_list.append((folder, ['collapse', 'inventory_1']))
+    (tmp_path / 'case-2' / 'fail_inventory_1').write_text('')
+    condense = tmp_path / 'condense'
+    condense.mkdir()
+    results = {}
+
+    def worker(n):
+        with WorkQueue(tmp_path / 'leases', worker=str(n)) as queue:
+            results[n] = run.run_worker(
+                task_list, queue, threads=2, condense=condense, poll=0.05
+            )
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert (condense / 'runs').read_text() == 'condense\n'
+    for folder, tasks in task_list:
+        assert (folder / 'runs').read_text().split() == tasks
+    failures = [f for r in results.values() for f in r]
+    assert [(f['case'], f['input']) for f in failures] == \
+        [('case-2', 'inventory_1')]
+    with WorkQueue(tmp_path / 'leases') as queue:
+        assert queue.failures() == failures
+        assert queue.status('case-0') == 'done'
+
+
+def test_run_worker_reopen(tmp_path, fispact_script):
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    condense = tmp_path / 'condense'
+    condense.mkdir()
+    with WorkQueue(tmp_path / 'leases', worker='old') as queue:
+        queue.claim('condense')
+        queue.release('condense')
+        queue.claim('case-0')
+        queue.release('case-0')
+    with WorkQueue(tmp_path / 'leases') as queue:
+        failures = run.run_worker(
+            [(folder, ['collapse'])], queue, condense=condense, poll=0.05
+        )
+        assert queue.status('case-0') == 'done'
+    assert failures == []
+    assert (condense / 'runs').read_text() == 'condense\n'
+    assert (folder / 'runs').read_text() == 'collapse\n'
+
+
+@pytest.mark.parametrize('keep', [True, False])
+@pytest.mark.parametrize('backend', ['threads', 'asyncio'])
+def test_run_tasks_scratch(tmp_path, fispact_script, keep, backend):
+    scratch = tmp_path / 'scratch'
+    scratch.mkdir()
+    condense = tmp_path / 'condense'
+    condense.mkdir()
+    (condense / 'ARRAYX').write_text('decay')
+    task_list = []
+    for i in range(3):
+        folder = tmp_path / 'case-{0}'.format(i)
+        folder.mkdir()
+        (folder / 'files').write_text('files')
+        (folder / 'collapse.log').write_text('old')
+        task_list.append((folder, ['collapse', 'inventory_1']))
+    (tmp_path / 'case-1' / 'fail_inventory_1').write_text('')
+
+    def render(cwd, tasks):
+        assert cwd.parent.parent == scratch
+        filenames = [cwd / (t + '.i') for t in tasks]
+        for filename in filenames:
+            filename.write_text('input')
+        return filenames
+
+    with run.ScratchArea(
+            scratch, condense=condense, keep_intermediates=keep
+        ) as area:
+        finished = {}
+        failures = run.run_tasks(
+            task_list, threads=2, render=render, condense=condense,
+            backend=backend, scratch=area, 
+            on_case=lambda cwd, f: finished.update({cwd.name: len(f)})
+        )
+        assert finished == {'case-0': 0, 'case-1': 1, 'case-2': 0}
+        assert [p.name for p in area.root.iterdir()] == ['ARRAYX']
+    assert not list(scratch.iterdir())
+    assert [(f['case'], f['input']) for f in failures] == \
+        [('case-1', 'inventory_1')]
+    for i in (0, 2):
+        names = {p.name for p in (tmp_path / 'case-{0}'.format(i)).iterdir()}
+        answer = {
+            'files', 'collapse.log', 'collapse.out', 'collapse.done',
+            'inventory_1.out', 'inventory_1.done'
+        }
+        if keep:
+            answer.add('COLLAPX')
+        assert names == answer
+    failed = {p.name for p in (tmp_path / 'case-1').iterdir()}
+    assert {'collapse.i', 'inventory_1.i', 'COLLAPX', 'runs'} <= failed
+    assert (tmp_path / 'case-0' / 'collapse.log').read_text() == 'old'
+
+
+def test_metrics_log(tmp_path, fispact_script):
+    folder = tmp_path / 'case-0'
+    folder.mkdir()
+    (folder / 'crash_inventory_1').write_text('')
+    with run.MetricsLog(tmp_path / 'metrics.jsonl', threads=2) as metrics:
+        run.run_case(
+            (folder, ['collapse', 'inventory_1']), retries=1, metrics=metrics
+        )
+    with open(tmp_path / 'metrics.jsonl') as f:
+        items = [json.loads(line) for line in f]
+    assert items[0]['threads'] == 2
+    assert [(i['input'], i['status']) for i in items[1:]] == [
+        ('collapse', 'ok'), ('inventory_1', 'process'), 
+        ('inventory_1', 'process')
+    ]
+    for item in items[1:]:
+        assert item['case'] == 'case-0'
+        assert item['wall'] >= 0
+        if hasattr(os, 'wait4'):
+            assert item['cpu'] >= 0
+            assert item['rss'] > 0
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import pickle
+
 import pytest
 import numpy as np
 from pkg_resources import resource_filename
@@ -20,9 +22,11 @@ def load_file(filename):
 def test_init_inventory_template(input, norm_flux, templ, coeffs):
     input = load_file(input)
     templ = load_file(templ)
-    template.init_inventory_template(input, norm_flux)
-    assert template.inventory_temp == templ
-    np.testing.assert_array_almost_equal(template.flux_coeffs, coeffs)
+    inventory_temp, flux_coeffs = template.init_inventory_template(
+        input, norm_flux
+    )
+    assert inventory_temp == templ
+    np.testing.assert_array_almost_equal(flux_coeffs, coeffs)
 
 
 @pytest.mark.parametrize('datalib, answer', [
@@ -32,8 +36,7 @@ def test_init_inventory_template(input, norm_flux, templ, coeffs):
 ])
 def test_fispact_files(datalib, answer):
     answer = load_file(answer)
-    template.init_files_template(datalib)
-    result = template.fispact_files()
+    result = template.init_files_template(datalib)
     assert result == answer
 
 
@@ -43,15 +46,14 @@ def test_fispact_files(datalib, answer):
 ])
 def test_fispact_collapse(libxs, nestrc, answer):
     answer = load_file(answer)
-    template.init_collapse_template(libxs, nestrc)
-    result = template.fispact_collapse()
+    result = template.init_collapse_template(libxs, nestrc)
     assert result == answer
 
 
 @pytest.fixture
 def temp():
     inp = load_file('input_0.i')
-    template.init_inventory_template(inp, 1.0e+10)
+    return template.TemplateSet.create(inp, 1.0e+10, {'ind_nuc': 'a'}, 1, 175)
 
 
 inventory_mats = [
@@ -71,7 +73,7 @@ inventory_mats = [
 def test_fispact_inventory(temp, flux, mat_index, answer):
     material = inventory_mats[mat_index]
     answer = load_file(answer)
-    result = template.fispact_inventory(flux, material)
+    result = temp.fispact_inventory(flux, material)
     assert result == answer
 
 
@@ -84,3 +86,56 @@ def test_fispact_arbflux(ebins, flux, answer):
     answer = load_file(answer)
     result = template.create_arbflux_text(ebins, flux)
     assert result == answer
+
+
+def test_template_set_pickle(temp):
+    restored = pickle.loads(pickle.dumps(temp))
+    assert restored == temp
+    assert restored.fispact_files() == temp.fispact_files()
+    assert restored.fispact_collapse() == temp.fispact_collapse()
+    assert restored.fispact_inventory(1.0e+10, inventory_mats[0]) == \
+        temp.fispact_inventory(1.0e+10, inventory_mats[0])
+    other = template.TemplateSet(
+        temp.fispact_files(), temp.fispact_collapse(), temp.inventory_temp,
+        temp.flux_coeffs * 2
+    )
+    assert other != temp
+
+
+@pytest.mark.parametrize('ebins, spectra, answers', [
+    ([1.e-11, 1.0, 10.0], [[1, 90], [0, 0]], ['arb_flux_1', None]),
+    ([1.e-11, 1.0, 10.0], [], []),
+])
+def test_create_arbflux_texts(ebins, spectra, answers):
+    result = template.create_arbflux_texts(ebins, spectra)
+    assert len(result) == len(answers)
+    for text, spectrum, answer in zip(result, spectra, answers):
+        if answer:
+            assert text == load_file(answer)
+        assert text == template.create_arbflux_text(ebins, spectrum)
+
+
+def test_compile_inventory_template():
+    inventory_temp, flux_coeffs = template.init_inventory_template(
+        '* 100% {material}\nFLUX 2.0\n', 1.0
+    )
+    inventory_format, inventory_fields = \
+        template.compile_inventory_template(inventory_temp)
+    assert inventory_fields == (None, 0)
+    temp = template.TemplateSet('', '', inventory_temp, flux_coeffs)
+    assert temp.fispact_inventory(3.0, 'M') == \
+        '* 100% M\nFLUX 6.0000e+00\n'
+
+
+def test_template_set_condense(temp):
+    assert 'GETDECAY 0' in temp.fispact_collapse()
+    assert temp.fispact_condense() == template.read_template('condense.temp')
+
+
+def test_replace_scenario(temp):
+    new = temp.replace_scenario('FLUX 3.0\n{material}\n', 1.0)
+    assert new != temp
+    assert new.fispact_files() == temp.fispact_files()
+    assert new.fispact_collapse() == temp.fispact_collapse()
+    assert new.fispact_condense() == temp.fispact_condense()
+    assert new.fispact_inventory(2.0, 'M') == 'FLUX 6.0000e+00\nM\n'
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import pytest
+
+from r2s_rfda.workqueue import WorkQueue
+
+
+@pytest.fixture
+def queues(tmp_path):
+    q1 = WorkQueue(tmp_path / 'leases', worker='w1', expiry=60, heartbeat=60)
+    q2 = WorkQueue(tmp_path / 'leases', worker='w2', expiry=60, heartbeat=60)
+    yield q1, q2
+    q1.close()
+    q2.close()
+
+
+def test_claim(queues):
+    q1, q2 = queues
+    assert q1.claim('case-0')
+    assert not q2.claim('case-0')
+    assert q2.claim('case-1')
+    assert q1.status('case-0') == 'claimed'
+    assert q1.status('case-2') is None
+
+
+@pytest.mark.parametrize('failures, status', [
+    (None, 'done'), ([{'case': 'case-0', 'input': 'collapse'}], 'failed')
+])
+def test_release(queues, failures, status):
+    q1, q2 = queues
+    q1.claim('case-0')
+    q1.release('case-0', failures)
+    assert q2.status('case-0') == status
+    assert not q2.claim('case-0')
+    assert q2.failures() == (failures or [])
+
+
+@pytest.mark.parametrize('failed', [False, True])
+@pytest.mark.parametrize('failures, status', [
+    (None, None), ([{'case': 'case-0', 'input': 'collapse'}], 'failed')
+])
+def test_reopen(queues, failures, status, failed):
+    q1, q2 = queues
+    q1.claim('case-0')
+    q1.release('case-0', failures)
+    q2.reopen('case-0', failed=failed)
+    if failed:
+        status = None
+    assert q2.status('case-0') == status
+    assert q2.claim('case-0') == (status is None)
+
+
+def test_foreign_lease(tmp_path, queues):
+    q1, q2 = queues
+    q1.claim('case-0')
+    lease = tmp_path / 'leases' / 'case-0.lease'
+    past = time.time() - 120
+    os.utime(lease, (past, past))
+    assert q2.claim('case-0')
+    q1.release('case-0')
+    assert lease.exists()
+    assert q2.status('case-0') == 'done'
+
+
+def test_heartbeat_foreign_lease(tmp_path):
+    with WorkQueue(tmp_path, worker='w', expiry=1, heartbeat=0.05) as q:
+        q.claim('case-0')
+        lease = tmp_path / 'case-0.lease'
+        lease.write_text('{"worker": "other", "time": 0}')
+        past = time.time() - 100
+        os.utime(lease, (past, past))
+        time.sleep(0.3)
+        assert time.time() - lease.stat().st_mtime > 50
+
+
+@pytest.mark.parametrize('age, claimed', [(10, False), (120, True)])
+def test_stale_lease(tmp_path, queues, age, claimed):
+    q1, q2 = queues
+    q1.claim('case-0')
+    lease = tmp_path / 'leases' / 'case-0.lease'
+    past = time.time() - age
+    os.utime(lease, (past, past))
+    assert q2.claim('case-0') == claimed
+    assert lease.exists()
+    assert [p.name for p in (tmp_path / 'leases').iterdir()] == ['case-0.lease']
+
+
+def test_heartbeat(tmp_path):
+    with WorkQueue(tmp_path, worker='w', expiry=1, heartbeat=0.05) as q:
+        q.claim('case-0')
+        lease = tmp_path / 'case-0.lease'
+        past = time.time() - 100
+        os.utime(lease, (past, past))
+        time.sleep(0.3)
+        assert time.time() - lease.stat().st_mtime < 1